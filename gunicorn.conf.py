@@ -0,0 +1,26 @@
+# gunicorn.conf.py
+import os
+
+# Gunicorn settings for the Notion proxy (used by the Procfile)
+bind = "0.0.0.0:" + os.environ.get("PORT", "8080")
+
+# Every request spends almost all of its time waiting on Notion, so by default
+# workers are cooperative (gevent): each one keeps thousands of requests in
+# flight instead of blocking on a single Notion call. Set
+# GUNICORN_WORKER_CLASS=sync to fall back to one request per worker.
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gevent")
+# Workers share the Notion rate limit through NOTION_RATE_LIMIT_DB (SQLite), so
+# adding workers does not multiply the calls each workspace makes per second, and
+# query-cache invalidations through NOTION_QUERY_CACHE_DB, so a write handled by
+# one worker is not followed by stale reads from another.
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", "1000")) # Concurrent requests per gevent worker
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120")) # Rate-limit retries and streamed queries can run long
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", "5"))
+
+
+def child_exit(server, worker):
+    # Drop a dead worker's live gauges from the aggregated /metrics
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
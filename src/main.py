@@ -1,8 +1,27 @@
 # src/main.py
 import os
+import hashlib
+import json
+import random
+import secrets
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+import httpx
 import requests
-from flask import Flask, request, jsonify, redirect, session
+from flask import Flask, request, jsonify, redirect, session, g, Response, stream_with_context
 from notion_client import Client
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+try:
+    import gevent
+    import gevent.monkey
+except ImportError: # Only needed under the gevent workers (gunicorn.conf.py)
+    gevent = None
 
 app = Flask(__name__)
 # Secret key for session management (replace with a strong secret in production)
@@ -28,22 +47,1631 @@ NOTION_REDIRECT_URI = base_url + "/notion/oauth-callback"
 NOTION_AUTH_URL = "https://api.notion.com/v1/oauth/authorize"
 NOTION_TOKEN_URL = "https://api.notion.com/v1/oauth/token"
 
-# Global variable to store the access token (temporary solution for v1)
-# In production, this should be stored securely per user (e.g., database)
-notion_access_token = None
-notion_workspace_id = None
-notion_workspace_name = None
-notion_workspace_icon = None
-notion_bot_id = None
+# --- Token Store Configuration ---
+# SQLite file shared by every worker (point it at a persistent volume in production)
+NOTION_TOKEN_DB = os.environ.get(
+    "NOTION_TOKEN_DB",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "instance", "notion_tokens.db"),
+)
+NOTION_TOKEN_CACHE_TTL = float(os.environ.get("NOTION_TOKEN_CACHE_TTL", "60")) # Seconds a looked-up key stays in memory
+NOTION_TOKEN_CACHE_SIZE = int(os.environ.get("NOTION_TOKEN_CACHE_SIZE", "1024"))
+
+# --- Notion Client Cache Configuration ---
+# Clients are reused across requests so their httpx connection pools (and TLS sessions) stay warm
+NOTION_CLIENT_CACHE_SIZE = int(os.environ.get("NOTION_CLIENT_CACHE_SIZE", "64"))
+NOTION_CLIENT_IDLE_TTL = float(os.environ.get("NOTION_CLIENT_IDLE_TTL", "300")) # Seconds without use before a client is closed
+# Per-token connection pool; under gevent workers one client can serve many concurrent requests
+NOTION_HTTP_MAX_CONNECTIONS = int(os.environ.get("NOTION_HTTP_MAX_CONNECTIONS", "100"))
+NOTION_HTTP_MAX_KEEPALIVE = int(os.environ.get("NOTION_HTTP_MAX_KEEPALIVE", "20"))
+
+# --- Query Streaming Configuration ---
+NOTION_STREAM_MAX_ROWS = int(os.environ.get("NOTION_STREAM_MAX_ROWS", "50000")) # Hard cap for auto-paginated queries
+NOTION_MAX_PAGE_SIZE = 100 # Largest page_size accepted by the Notion API
+
+# --- Batch Creation Configuration ---
+NOTION_BATCH_MAX_ITEMS = int(os.environ.get("NOTION_BATCH_MAX_ITEMS", "1000"))
+NOTION_BATCH_WORKERS = int(os.environ.get("NOTION_BATCH_WORKERS", "3"))
+
+# --- Query Cache Configuration ---
+# Short-lived cache for identical queries (dashboards polling the same filters)
+NOTION_QUERY_CACHE_SIZE = int(os.environ.get("NOTION_QUERY_CACHE_SIZE", "256"))
+NOTION_QUERY_CACHE_TTL = float(os.environ.get("NOTION_QUERY_CACHE_TTL", "15")) # Seconds; 0 disables the cache
+NOTION_QUERY_CACHE_MAX_ENTRY_BYTES = int(os.environ.get("NOTION_QUERY_CACHE_MAX_ENTRY_BYTES", str(1024 * 1024))) # Larger results are not cached
+# Per-database write generations shared by every worker process, so a write through
+# one worker invalidates the entries cached by all of them. Set to "" for per-process
+# generations (single worker only).
+NOTION_QUERY_CACHE_DB = os.environ.get(
+    "NOTION_QUERY_CACHE_DB",
+    os.path.join(os.path.dirname(NOTION_TOKEN_DB), "notion_query_cache.db"),
+)
+
+# --- Local Mirror Configuration ---
+NOTION_MIRROR_DB = os.environ.get(
+    "NOTION_MIRROR_DB",
+    os.path.join(os.path.dirname(NOTION_TOKEN_DB), "notion_mirror.db"),
+)
+NOTION_MIRROR_SYNC_INTERVAL = float(os.environ.get("NOTION_MIRROR_SYNC_INTERVAL", "0")) # Seconds between background syncs; 0 = sync only on request
+# Incremental syncs only see pages that still exist, so the background loop re-reads
+# each database this often to drop pages archived or deleted in Notion; 0 = never
+NOTION_MIRROR_FULL_SYNC_INTERVAL = float(os.environ.get("NOTION_MIRROR_FULL_SYNC_INTERVAL", "3600"))
+
+# --- Write-behind Queue Configuration ---
+NOTION_WRITE_QUEUE_DB = os.environ.get(
+    "NOTION_WRITE_QUEUE_DB",
+    os.path.join(os.path.dirname(NOTION_TOKEN_DB), "notion_jobs.db"),
+)
+NOTION_WRITE_COALESCE_SECONDS = float(os.environ.get("NOTION_WRITE_COALESCE_SECONDS", "1")) # Window in which PATCHes to a page are merged
+NOTION_WRITE_STALE_SECONDS = float(os.environ.get("NOTION_WRITE_STALE_SECONDS", "300")) # A 'running' job older than this is retried
+NOTION_WRITE_JOB_RETENTION = float(os.environ.get("NOTION_WRITE_JOB_RETENTION", "86400")) # How long finished jobs can be looked up
+
+# --- Rate Limiting Configuration ---
+# Applied per workspace, since Notion enforces its limit per integration
+NOTION_RATE_LIMIT_PER_SECOND = float(os.environ.get("NOTION_RATE_LIMIT_PER_SECOND", "3")) # Notion's documented average limit
+# Bucket state shared by every worker process, so the limit holds for the whole
+# deployment rather than per worker. Set to "" for per-process buckets (single worker).
+NOTION_RATE_LIMIT_DB = os.environ.get(
+    "NOTION_RATE_LIMIT_DB",
+    os.path.join(os.path.dirname(NOTION_TOKEN_DB), "notion_rate_limits.db"),
+)
+NOTION_RATE_LIMIT_BURST = int(os.environ.get("NOTION_RATE_LIMIT_BURST", "3"))
+NOTION_MAX_RETRIES = int(os.environ.get("NOTION_MAX_RETRIES", "4")) # Retries for 429s (and 5xx on idempotent calls)
+NOTION_RETRY_BASE_DELAY = float(os.environ.get("NOTION_RETRY_BASE_DELAY", "0.5")) # Seconds, doubled on each attempt
+NOTION_RETRY_MAX_DELAY = float(os.environ.get("NOTION_RETRY_MAX_DELAY", "30"))
+
+# --- Metrics ---
+# Exposed in Prometheus format at /metrics. With several gunicorn workers set
+# PROMETHEUS_MULTIPROC_DIR so the numbers of every worker are aggregated.
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN") # If set, /metrics requires "Authorization: Bearer <token>"
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "Time spent handling a request", ["route", "method"]
+)
+HTTP_REQUESTS_TOTAL = Counter(
+    "http_requests_total", "Requests handled, by response status", ["route", "method", "status"]
+)
+HTTP_REQUESTS_IN_FLIGHT = Gauge(
+    "http_requests_in_flight", "Requests currently being handled", ["route"], multiprocess_mode="livesum"
+)
+NOTION_CALL_SECONDS = Histogram(
+    "notion_api_call_duration_seconds", "Duration of each Notion API attempt", ["method", "outcome"]
+)
+NOTION_QUEUE_DEPTH = Gauge(
+    "notion_rate_limit_queue_depth", "Notion calls waiting for a rate limit token", multiprocess_mode="livesum"
+)
+NOTION_THROTTLED_SECONDS = Counter(
+    "notion_rate_limit_throttled_seconds", "Time Notion calls spent waiting for a rate limit token"
+)
+NOTION_RETRIES_TOTAL = Counter(
+    "notion_retries_total", "Notion calls retried, by the status that caused it", ["status"]
+)
+NOTION_QUERY_CACHE_TOTAL = Counter(
+    "notion_query_cache_total", "Query cache lookups", ["result"]
+)
+
+def notion_method_name(func):
+    """Turns a bound endpoint method (client.pages.create) into a metric label ("pages.create")."""
+    endpoint = type(getattr(func, "__self__", None)).__name__.replace("Endpoint", "").lower()
+    return f"{endpoint}.{getattr(func, '__name__', 'call')}"
+
+# --- In-process LRU/TTL Cache ---
+class LRUCache:
+    """Thread-safe LRU cache with a per-entry TTL.
+
+    With `sliding=True` the TTL is an idle timeout (refreshed on every hit),
+    otherwise entries expire a fixed time after they were stored.
+    `on_evict(key, value)` is called outside the lock for every entry that
+    leaves the cache (expired, pushed out by size, replaced or popped).
+    """
+
+    def __init__(self, max_size, ttl, on_evict=None, sliding=False):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.sliding = sliding
+        self._entries = OrderedDict() # key -> (value, expires_at)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        evicted = []
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            now = time.monotonic()
+            if expires_at <= now:
+                del self._entries[key]
+                evicted.append((key, value))
+                value = default
+            else:
+                self._entries.move_to_end(key)
+                if self.sliding:
+                    self._entries[key] = (value, now + self.ttl)
+        self._notify(evicted)
+        return value
+
+    def set(self, key, value):
+        evicted = []
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None and previous[0] is not value:
+                evicted.append((key, previous[0]))
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            evicted.extend(self._prune_locked())
+        self._notify(evicted)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        if entry is None:
+            return default
+        self._notify([(key, entry[0])])
+        return entry[0]
+
+    def clear(self):
+        with self._lock:
+            evicted = [(key, entry[0]) for key, entry in self._entries.items()]
+            self._entries.clear()
+        self._notify(evicted)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def _prune_locked(self):
+        """Drops expired entries, then the least recently used ones over max_size."""
+        now = time.monotonic()
+        evicted = [(key, entry[0]) for key, entry in self._entries.items() if entry[1] <= now]
+        for key, _ in evicted:
+            del self._entries[key]
+        while len(self._entries) > self.max_size:
+            key, entry = self._entries.popitem(last=False)
+            evicted.append((key, entry[0]))
+        return evicted
+
+    def _notify(self, evicted):
+        if not self.on_evict:
+            return
+        for key, value in evicted:
+            try:
+                self.on_evict(key, value)
+            except Exception as e:
+                print(f"ERROR in cache eviction callback: {e}")
+
+# --- Rate Limiting ---
+class TokenBucket:
+    """Token bucket that makes callers wait for their turn instead of failing.
+
+    Tokens refill at `rate` per second up to `capacity`. A caller that finds
+    the bucket empty reserves the next token (the balance goes negative) and
+    sleeps until it is due, so concurrent callers are served in arrival order.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Takes one token, blocking until it is available. Returns the seconds waited."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def penalize(self, seconds):
+        """Holds back every caller for `seconds` (e.g. after a Retry-After from the server)."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            self._tokens = min(self._tokens, 0.0) - seconds * self.rate
+
+# --- Shared Worker State ---
+def run_off_event_loop(func, *args):
+    """Runs a blocking call (SQLite I/O) in gevent's threadpool when the worker is cooperative.
+
+    Under monkey-patched gevent workers a lock wait or fsync inside SQLite would
+    otherwise stall every greenlet of the process; elsewhere it just calls func.
+    """
+    if gevent is not None and gevent.monkey.is_module_patched("socket"):
+        return gevent.get_hub().threadpool.apply(func, args)
+    return func(*args)
+
+class SharedStateDB:
+    """Small SQLite file for state every worker process must agree on.
+
+    Each process keeps one connection (WAL, synchronous=NORMAL, so a commit
+    does not fsync) and uses it for one short transaction at a time, run
+    through run_off_event_loop so waiting on another worker's lock never
+    blocks the event loop.
+    """
+
+    def __init__(self, db_path, schema):
+        self.db_path = db_path
+        self.schema = schema
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock() # Greenlet-aware under gevent: callers queue cooperatively
+
+    def _connection(self):
+        # A forked worker must not share its parent's connection
+        if self._conn is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            # Autocommit mode: transactions are opened explicitly with BEGIN IMMEDIATE
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(self.schema)
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def transaction(self, func):
+        """Runs func(conn) in one IMMEDIATE transaction and returns its result."""
+        def run():
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(conn)
+                conn.execute("COMMIT")
+            except Exception:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+            return result
+
+        with self._lock:
+            return run_off_event_loop(run)
+
+    def read(self, func):
+        """Runs func(conn) outside a transaction (a single statement reads a consistent snapshot)."""
+        with self._lock:
+            return run_off_event_loop(lambda: func(self._connection()))
+
+RATE_LIMIT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS notion_rate_limit_buckets (
+    bucket_key TEXT PRIMARY KEY,
+    tokens REAL NOT NULL, -- Balance at updated_at; negative while callers wait for reserved tokens
+    updated_at REAL NOT NULL -- Unix time
+);
+"""
+
+class SQLiteTokenBucket:
+    """TokenBucket whose balance lives in a SharedStateDB used by every worker process.
+
+    Each gunicorn worker has its own limiter, so in-memory buckets would let a
+    workspace make WEB_CONCURRENCY times the configured rate. Here the refill,
+    reservation and Retry-After penalties happen in one IMMEDIATE transaction on
+    a row per workspace, timed with the wall clock so all processes agree.
+    """
+
+    def __init__(self, shared_db, key, rate, capacity):
+        self.shared_db = shared_db
+        self.key = key
+        self.rate = rate
+        self.capacity = capacity
+
+    def _update(self, change):
+        """Refills the shared balance, applies change(tokens) to it and returns the new balance."""
+        def update(conn):
+            now = time.time()
+            row = conn.execute(
+                "SELECT tokens, updated_at FROM notion_rate_limit_buckets WHERE bucket_key = ?", (self.key,)
+            ).fetchone()
+            tokens = float(self.capacity) if row is None else min(self.capacity, row[0] + max(0.0, now - row[1]) * self.rate)
+            tokens = change(tokens)
+            conn.execute(
+                """
+                INSERT INTO notion_rate_limit_buckets (bucket_key, tokens, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT (bucket_key) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at
+                """,
+                (self.key, tokens, now),
+            )
+            return tokens
+
+        return self.shared_db.transaction(update)
+
+    def acquire(self):
+        """Takes one token, blocking until it is available. Returns the seconds waited."""
+        tokens = self._update(lambda tokens: tokens - 1)
+        wait = -tokens / self.rate if tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def penalize(self, seconds):
+        """Holds back every caller, in every worker, for `seconds`."""
+        self._update(lambda tokens: min(tokens, 0.0) - seconds * self.rate)
+
+def retry_after_seconds(e):
+    """Parses the Retry-After header of a failed Notion response (seconds or HTTP date)."""
+    headers = getattr(e, 'headers', None)
+    value = headers.get('retry-after') if headers is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class NotionRateLimiter:
+    """Shared scheduler for Notion calls: one token bucket per workspace plus retries.
+
+    Every call waits for a token from its workspace's bucket. 429 responses are
+    retried after Retry-After (or a jittered exponential backoff) and also hold
+    back the rest of that workspace's queue; 5xx responses are only retried for
+    idempotent calls, so a create is never sent twice after a server error.
+    With `db_path` the buckets are SQLiteTokenBuckets shared by all workers;
+    retries and the counters in snapshot() are still per process.
+    """
+
+    def __init__(self, rate, burst, max_retries, base_delay, max_delay, db_path=None):
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._shared_db = SharedStateDB(db_path, RATE_LIMIT_SCHEMA) if db_path else None
+        self._buckets = {}
+        self._queue_depth = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            "calls": 0,
+            "retries": 0,
+            "rate_limited": 0,
+            "server_errors": 0,
+            "failures": 0,
+            "throttled_seconds": 0.0, # Time spent waiting for a token (includes Retry-After pauses)
+            "backoff_seconds": 0.0, # Time spent sleeping before retrying a server error
+            "max_queue_depth": 0,
+        }
+
+    def _bucket(self, workspace_key):
+        with self._lock:
+            bucket = self._buckets.get(workspace_key)
+            if bucket is None:
+                if self._shared_db:
+                    bucket = SQLiteTokenBucket(self._shared_db, workspace_key, self.rate, self.burst)
+                else:
+                    bucket = TokenBucket(self.rate, self.burst)
+                self._buckets[workspace_key] = bucket
+            return bucket
+
+    def _acquire(self, workspace_key, bucket):
+        with self._lock:
+            depth = self._queue_depth.get(workspace_key, 0) + 1
+            self._queue_depth[workspace_key] = depth
+            self._stats["max_queue_depth"] = max(self._stats["max_queue_depth"], depth)
+        NOTION_QUEUE_DEPTH.inc()
+        waited = 0.0
+        try:
+            waited = bucket.acquire()
+        finally:
+            NOTION_QUEUE_DEPTH.dec()
+            NOTION_THROTTLED_SECONDS.inc(waited)
+            with self._lock:
+                self._queue_depth[workspace_key] -= 1
+                self._stats["throttled_seconds"] += waited
+
+    def _backoff(self, attempt):
+        delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+        # Equal jitter: keep half the delay, randomize the rest to spread out retry storms
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def call(self, workspace_key, func, *args, idempotent=True, **kwargs):
+        """Runs func(*args, **kwargs) under the workspace's rate limit, retrying throttled calls."""
+        bucket = self._bucket(workspace_key)
+        method = notion_method_name(func)
+        attempt = 0
+        while True:
+            self._acquire(workspace_key, bucket)
+            with self._lock:
+                self._stats["calls"] += 1
+            started = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+                NOTION_CALL_SECONDS.labels(method=method, outcome="ok").observe(time.perf_counter() - started)
+                return result
+            except Exception as e:
+                status = getattr(e, 'status', None)
+                NOTION_CALL_SECONDS.labels(method=method, outcome=str(status or "error")).observe(time.perf_counter() - started)
+                rate_limited = status == 429
+                server_error = isinstance(status, int) and status >= 500
+                with self._lock:
+                    self._stats["rate_limited"] += int(rate_limited)
+                    self._stats["server_errors"] += int(server_error)
+                retry_after = retry_after_seconds(e)
+                delay = min(self.max_delay, retry_after) if retry_after is not None else self._backoff(attempt)
+                if rate_limited:
+                    # The whole workspace is over the limit, not just this call
+                    bucket.penalize(delay)
+                retryable = rate_limited or (server_error and idempotent)
+                if not retryable or attempt >= self.max_retries:
+                    with self._lock:
+                        self._stats["failures"] += 1
+                    raise
+                attempt += 1
+                print(f"DEBUG: Notion returned {status} for workspace {workspace_key}, retry {attempt}/{self.max_retries} in {delay:.2f}s")
+                NOTION_RETRIES_TOTAL.labels(status=str(status)).inc()
+                with self._lock:
+                    self._stats["retries"] += 1
+                    if not rate_limited:
+                        self._stats["backoff_seconds"] += delay
+                if not rate_limited:
+                    # A penalized bucket already makes the next acquire wait
+                    time.sleep(delay)
+
+    def snapshot(self):
+        """Returns a copy of the counters plus the current queue depth per workspace."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["queue_depth"] = {key: depth for key, depth in self._queue_depth.items() if depth}
+            stats["workspaces"] = len(self._buckets)
+        return stats
+
+notion_limiter = NotionRateLimiter(
+    rate=NOTION_RATE_LIMIT_PER_SECOND,
+    burst=NOTION_RATE_LIMIT_BURST,
+    max_retries=NOTION_MAX_RETRIES,
+    base_delay=NOTION_RETRY_BASE_DELAY,
+    max_delay=NOTION_RETRY_MAX_DELAY,
+    db_path=NOTION_RATE_LIMIT_DB or None,
+)
+
+# --- Query Result Cache ---
+def normalize_notion_id(notion_id):
+    """Notion accepts ids with or without dashes; compare them in one form."""
+    return (notion_id or "").replace("-", "").lower()
+
+class NotionQueryCache:
+    """Read-through cache of database query responses, invalidated by writes.
+
+    Entries are keyed by workspace, bot, database, a per-database generation and
+    the canonical JSON of the query. The bot is part of the key because two
+    integrations in one workspace can be shared with different pages, so one
+    must never be served what the other read. Generations are per database, not
+    per bot: a write through any integration bumps it instead of scanning the
+    cache, so older entries of every bot become unreachable and age out of the
+    LRU, and a query that was in flight during the write stores its result under
+    the old generation, so it can never be served after the write.
+
+    With a db_path the generations live in a SharedStateDB, so a write handled
+    by any worker (or by any worker's write-queue drainer) invalidates the
+    entries every worker holds; without one they are per process.
+    """
+
+    def __init__(self, max_size, ttl, max_entry_bytes, db_path=None):
+        self.enabled = ttl > 0 and max_size > 0
+        self.max_entry_bytes = max_entry_bytes
+        self._entries = LRUCache(max_size=max_size, ttl=ttl)
+        self._shared_db = SharedStateDB(db_path, QUERY_CACHE_SCHEMA) if db_path else None
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def _generation(self, database_key):
+        if self._shared_db is None:
+            with self._lock:
+                return self._generations.get(database_key, 0)
+        row = self._shared_db.read(lambda conn: conn.execute(
+            "SELECT generation FROM notion_query_cache_generations WHERE workspace_id = ? AND database_id = ?",
+            database_key,
+        ).fetchone())
+        return row[0] if row else 0
+
+    def key(self, workspace_key, bot_key, database_id, query):
+        """Builds the cache key for a query; capture it before calling Notion."""
+        database_key = (workspace_key, normalize_notion_id(database_id))
+        generation = self._generation(database_key) if self.enabled else 0
+        canonical = json.dumps(query, sort_keys=True, separators=(",", ":"))
+        return database_key + (bot_key, generation, canonical)
+
+    def get(self, key):
+        return self._entries.get(key) if self.enabled else None
+
+    def set(self, key, body):
+        if self.enabled and len(body) <= self.max_entry_bytes:
+            self._entries.set(key, body)
+
+    def invalidate(self, workspace_key, database_id):
+        if not self.enabled:
+            return
+        database_key = (workspace_key, normalize_notion_id(database_id))
+        if self._shared_db is None:
+            with self._lock:
+                self._generations[database_key] = self._generations.get(database_key, 0) + 1
+            return
+        self._shared_db.transaction(lambda conn: conn.execute(
+            """
+            INSERT INTO notion_query_cache_generations (workspace_id, database_id, generation) VALUES (?, ?, 1)
+            ON CONFLICT (workspace_id, database_id) DO UPDATE SET generation = generation + 1
+            """,
+            database_key,
+        ))
+
+QUERY_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS notion_query_cache_generations (
+    workspace_id TEXT NOT NULL,
+    database_id TEXT NOT NULL,
+    generation INTEGER NOT NULL, -- Bumped by every write to the database
+    PRIMARY KEY (workspace_id, database_id)
+);
+"""
+
+notion_query_cache = NotionQueryCache(
+    max_size=NOTION_QUERY_CACHE_SIZE,
+    ttl=NOTION_QUERY_CACHE_TTL,
+    max_entry_bytes=NOTION_QUERY_CACHE_MAX_ENTRY_BYTES,
+    db_path=NOTION_QUERY_CACHE_DB or None,
+)
+
+# --- Token Store ---
+class NotionTokenStore:
+    """Server-side store of Notion OAuth tokens, one row per (workspace, bot).
+
+    Callers authenticate with a short opaque API key issued at the end of the
+    OAuth flow; only its SHA-256 is stored. Lookups go through an in-process
+    cache first, so a hot key costs no SQLite round trip, and since the store
+    is a file shared by all workers any worker can resolve any key.
+    """
+
+    def __init__(self, db_path, cache_ttl, cache_size):
+        self.db_path = db_path
+        self._cache = LRUCache(max_size=cache_size, ttl=cache_ttl)
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+
+    @staticmethod
+    def hash_key(api_key):
+        return hashlib.sha256(api_key.encode()).hexdigest()
+
+    def connect(self):
+        """Opens a connection to the store, creating the schema on first use."""
+        os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        if not self._schema_ready:
+            with self._schema_lock:
+                if not self._schema_ready:
+                    self._create_schema(conn)
+                    self._schema_ready = True
+        return conn
+
+    def _create_schema(self, conn):
+        conn.execute("PRAGMA journal_mode=WAL") # Readers in other workers don't block on writes
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS notion_tokens (
+            workspace_id TEXT NOT NULL,
+            bot_id TEXT NOT NULL,
+            access_token TEXT NOT NULL,
+            workspace_name TEXT NULL,
+            workspace_icon TEXT NULL,
+            api_key_hash TEXT NOT NULL UNIQUE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (workspace_id, bot_id)
+        );
+        """)
+        conn.commit()
+
+    def save(self, token_data):
+        """Stores (or replaces) the token for a workspace/bot and returns a fresh API key."""
+        api_key = secrets.token_urlsafe(24)
+        key_hash = self.hash_key(api_key)
+        conn = self.connect()
+        try:
+            previous = conn.execute(
+                "SELECT api_key_hash FROM notion_tokens WHERE workspace_id = ? AND bot_id = ?",
+                (token_data["workspace_id"], token_data["bot_id"]),
+            ).fetchone()
+            conn.execute(
+                """
+                INSERT INTO notion_tokens (workspace_id, bot_id, access_token, workspace_name, workspace_icon, api_key_hash)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (workspace_id, bot_id) DO UPDATE SET
+                    access_token = excluded.access_token,
+                    workspace_name = excluded.workspace_name,
+                    workspace_icon = excluded.workspace_icon,
+                    api_key_hash = excluded.api_key_hash,
+                    updated_at = CURRENT_TIMESTAMP
+                """,
+                (
+                    token_data["workspace_id"],
+                    token_data["bot_id"],
+                    token_data["access_token"],
+                    token_data.get("workspace_name"),
+                    token_data.get("workspace_icon"),
+                    key_hash,
+                ),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+        if previous:
+            # Re-authorizing rotates the key; the old one stops working in this worker right away
+            self._cache.pop(previous["api_key_hash"])
+        return api_key
+
+    def get_by_api_key(self, api_key):
+        """Returns the token record for an API key, or None."""
+        key_hash = self.hash_key(api_key)
+        record = self._cache.get(key_hash)
+        if record is not None:
+            return record
+        conn = self.connect()
+        try:
+            row = conn.execute(
+                "SELECT workspace_id, bot_id, access_token, workspace_name FROM notion_tokens WHERE api_key_hash = ?",
+                (key_hash,),
+            ).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        record = dict(row)
+        self._cache.set(key_hash, record)
+        return record
+
+    def get_by_bot(self, workspace_id, bot_id):
+        """Returns the token record of one bot in a workspace, or None."""
+        conn = self.connect()
+        try:
+            row = conn.execute(
+                "SELECT workspace_id, bot_id, access_token, workspace_name FROM notion_tokens WHERE workspace_id = ? AND bot_id = ?",
+                (workspace_id, bot_id),
+            ).fetchone()
+        finally:
+            conn.close()
+        return dict(row) if row else None
+
+notion_token_store = NotionTokenStore(
+    db_path=NOTION_TOKEN_DB,
+    cache_ttl=NOTION_TOKEN_CACHE_TTL,
+    cache_size=NOTION_TOKEN_CACHE_SIZE,
+)
+
+# --- Local Mirror ---
+class MirrorUnsupported(Exception):
+    """Raised when a query uses a filter or sort the mirror cannot answer; the caller falls back to Notion."""
+
+def _mirror_date(value):
+    """Normalizes a Notion date/datetime string so that string order matches time order.
+
+    Datetimes become naive UTC 'YYYY-MM-DDTHH:MM:SS', dates stay 'YYYY-MM-DD'.
+    """
+    if not value:
+        return None
+    if "T" not in value:
+        return value[:10]
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed.strftime("%Y-%m-%dT%H:%M:%S")
+
+def _mirror_next_day(value):
+    return (datetime.strptime(value[:10], "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+
+def _plain_text(rich_text):
+    return "".join(part.get("plain_text", "") for part in rich_text or [])
+
+def mirror_property_values(prop):
+    """Flattens a Notion property value into (text, number, date_start, date_end) rows.
+
+    Multi-valued properties (multi_select, people, relation) give one row per
+    value; empty properties give no rows.
+    """
+    prop_type = prop.get("type")
+    value = prop.get(prop_type)
+    if prop_type == "formula" and value:
+        # Index the formula result as if it were a property of its own type
+        return mirror_property_values({"type": value.get("type"), value.get("type"): value.get(value.get("type"))})
+    if value is None or value == [] or value == "":
+        return []
+    if prop_type in ("title", "rich_text"):
+        text = _plain_text(value)
+        return [(text, None, None, None)] if text else []
+    if prop_type in ("select", "status"):
+        return [(value.get("name"), None, None, None)]
+    if prop_type == "multi_select":
+        return [(option.get("name"), None, None, None) for option in value]
+    if prop_type in ("people", "relation"):
+        return [(item.get("id"), None, None, None) for item in value]
+    if prop_type in ("url", "email", "phone_number", "string"):
+        return [(value, None, None, None)]
+    if prop_type == "number":
+        return [(None, value, None, None)]
+    if prop_type in ("checkbox", "boolean"):
+        return [(None, 1 if value else 0, None, None)]
+    if prop_type == "date":
+        return [(None, None, _mirror_date(value.get("start")), _mirror_date(value.get("end")))]
+    if prop_type in ("created_time", "last_edited_time"):
+        return [(None, None, _mirror_date(value), None)]
+    if prop_type == "unique_id":
+        return [(None, value.get("number"), None, None)]
+    return []
+
+class NotionMirror:
+    """Local SQLite copy of selected Notion databases, synced incrementally.
+
+    Each mirror belongs to the bot that registered it: it is synced with that
+    bot's token and only answers that bot's queries, since two integrations in
+    one workspace can be shared with different pages. Pages are stored whole (as returned by Notion) and each property value is
+    also flattened into `mirrored_values`, indexed per (database, property,
+    value), so the common Notion filter JSON can be answered with indexed SQL.
+    Syncs only fetch pages edited since the last one, using last_edited_time
+    filters and sorts. Archived and deleted pages are not returned by such a
+    query, so only a full sync (which also drops pages Notion no longer
+    returns) removes them; the background loop runs one every
+    NOTION_MIRROR_FULL_SYNC_INTERVAL.
+    """
+
+    # Filter operators per property type -> how they map onto mirrored_values
+    TEXT_TYPES = ("title", "rich_text", "url", "email", "phone_number", "select", "status")
+    LIST_TYPES = ("multi_select", "people", "relation")
+    DATE_TYPES = ("date", "created_time", "last_edited_time")
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+
+    def connect(self):
+        """Opens a connection to the mirror, creating the schema on first use."""
+        os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        if not self._schema_ready:
+            with self._schema_lock:
+                if not self._schema_ready:
+                    self._create_schema(conn)
+                    self._schema_ready = True
+        return conn
+
+    def _create_schema(self, conn):
+        conn.execute("PRAGMA journal_mode=WAL")
+        columns = [row["name"] for row in conn.execute("PRAGMA table_info(mirrored_databases)")]
+        if columns and "bot_id" not in columns:
+            # Mirrors from before they were owned by a bot can't be told apart; drop them and let them be re-registered
+            print("WARNING: Dropping local Notion mirrors without an owning bot; POST /mirror again to re-create them")
+            conn.executescript("""
+            DROP TABLE IF EXISTS mirrored_values;
+            DROP TABLE IF EXISTS mirrored_pages;
+            DROP TABLE IF EXISTS mirrored_databases;
+            """)
+        conn.executescript("""
+        CREATE TABLE IF NOT EXISTS mirrored_databases (
+            workspace_id TEXT NOT NULL,
+            bot_id TEXT NOT NULL, -- Integration whose token syncs the mirror and who may query it
+            database_id TEXT NOT NULL,
+            last_edited_cursor TEXT NULL, -- Newest last_edited_time seen, where the next sync resumes
+            last_synced_at REAL NULL, -- Unix time the last successful sync started
+            last_full_sync_at REAL NULL, -- Unix time the last successful full sync started
+            PRIMARY KEY (workspace_id, bot_id, database_id)
+        );
+        CREATE TABLE IF NOT EXISTS mirrored_pages (
+            workspace_id TEXT NOT NULL,
+            bot_id TEXT NOT NULL,
+            database_id TEXT NOT NULL,
+            page_id TEXT NOT NULL,
+            created_time TEXT NULL,
+            last_edited_time TEXT NULL,
+            archived INTEGER NOT NULL DEFAULT 0,
+            synced_at REAL NOT NULL,
+            data TEXT NOT NULL, -- Page JSON exactly as Notion returned it
+            PRIMARY KEY (workspace_id, bot_id, database_id, page_id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_mirrored_pages_created ON mirrored_pages (workspace_id, bot_id, database_id, created_time);
+        CREATE INDEX IF NOT EXISTS idx_mirrored_pages_edited ON mirrored_pages (workspace_id, bot_id, database_id, last_edited_time);
+        CREATE TABLE IF NOT EXISTS mirrored_values (
+            workspace_id TEXT NOT NULL,
+            bot_id TEXT NOT NULL,
+            database_id TEXT NOT NULL,
+            page_id TEXT NOT NULL,
+            property TEXT NOT NULL,
+            text_value TEXT NULL,
+            number_value REAL NULL,
+            date_start TEXT NULL,
+            date_end TEXT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_mirrored_values_text ON mirrored_values (workspace_id, bot_id, database_id, property, text_value);
+        CREATE INDEX IF NOT EXISTS idx_mirrored_values_number ON mirrored_values (workspace_id, bot_id, database_id, property, number_value);
+        CREATE INDEX IF NOT EXISTS idx_mirrored_values_date ON mirrored_values (workspace_id, bot_id, database_id, property, date_start);
+        CREATE INDEX IF NOT EXISTS idx_mirrored_values_page ON mirrored_values (page_id, property);
+        """)
+        if "last_full_sync_at" not in [row["name"] for row in conn.execute("PRAGMA table_info(mirrored_databases)")]:
+            conn.execute("ALTER TABLE mirrored_databases ADD COLUMN last_full_sync_at REAL NULL")
+        conn.commit()
+
+    # --- Registration and status ---
+    def status(self, workspace_id, bot_id, database_id):
+        conn = self.connect()
+        try:
+            row = conn.execute(
+                "SELECT last_edited_cursor, last_synced_at, last_full_sync_at, (SELECT COUNT(*) FROM mirrored_pages p WHERE p.workspace_id = d.workspace_id AND p.bot_id = d.bot_id AND p.database_id = d.database_id AND p.archived = 0) AS pages FROM mirrored_databases d WHERE workspace_id = ? AND bot_id = ? AND database_id = ?",
+                (workspace_id, bot_id, normalize_notion_id(database_id)),
+            ).fetchone()
+        finally:
+            conn.close()
+        return dict(row) if row else None
+
+    def registered(self):
+        """Lists every mirrored (workspace_id, bot_id, database_id)."""
+        conn = self.connect()
+        try:
+            return [tuple(row) for row in conn.execute("SELECT workspace_id, bot_id, database_id FROM mirrored_databases")]
+        finally:
+            conn.close()
+
+    def remove(self, workspace_id, bot_id, database_id):
+        database_key = (workspace_id, bot_id, normalize_notion_id(database_id))
+        conn = self.connect()
+        try:
+            with conn:
+                for table in ("mirrored_values", "mirrored_pages", "mirrored_databases"):
+                    conn.execute(f"DELETE FROM {table} WHERE workspace_id = ? AND bot_id = ? AND database_id = ?", database_key)
+        finally:
+            conn.close()
+
+    # --- Sync ---
+    def _store_pages(self, conn, workspace_id, bot_id, database_id, pages, synced_at):
+        page_rows = []
+        value_rows = []
+        for page in pages:
+            page_rows.append((
+                workspace_id,
+                bot_id,
+                database_id,
+                page["id"],
+                _mirror_date(page.get("created_time")),
+                _mirror_date(page.get("last_edited_time")),
+                1 if page.get("archived") or page.get("in_trash") else 0,
+                synced_at,
+                json.dumps(page),
+            ))
+            for name, prop in (page.get("properties") or {}).items():
+                for text, number, date_start, date_end in mirror_property_values(prop):
+                    value_rows.append((workspace_id, bot_id, database_id, page["id"], name, text, number, date_start, date_end))
+        with conn:
+            conn.executemany(
+                "DELETE FROM mirrored_values WHERE page_id = ? AND workspace_id = ? AND bot_id = ? AND database_id = ?",
+                [(row[3], workspace_id, bot_id, database_id) for row in page_rows],
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO mirrored_pages (workspace_id, bot_id, database_id, page_id, created_time, last_edited_time, archived, synced_at, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                page_rows,
+            )
+            conn.executemany(
+                "INSERT INTO mirrored_values (workspace_id, bot_id, database_id, page_id, property, text_value, number_value, date_start, date_end) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                value_rows,
+            )
+
+    def sync(self, query_page, workspace_id, bot_id, database_id, full=False):
+        """Pulls pages edited since the last sync (or every page when `full`) into the mirror.
+
+        `query_page(**kwargs)` performs one databases.query call with `bot_id`'s
+        token (already rate limited by the caller). Registers the database for
+        that bot on first use. Returns the number of pages fetched.
+        """
+        database_id = normalize_notion_id(database_id)
+        started_at = time.time()
+        conn = self.connect()
+        try:
+            mirror_key = (workspace_id, bot_id, database_id)
+            conn.execute(
+                "INSERT OR IGNORE INTO mirrored_databases (workspace_id, bot_id, database_id) VALUES (?, ?, ?)",
+                mirror_key,
+            )
+            conn.commit()
+            row = conn.execute(
+                "SELECT last_edited_cursor FROM mirrored_databases WHERE workspace_id = ? AND bot_id = ? AND database_id = ?",
+                mirror_key,
+            ).fetchone()
+            edited_cursor = None if full else row["last_edited_cursor"]
+            # Without a cursor every page is read anyway, so treat it as a full sync
+            full = edited_cursor is None
+            query = {"sorts": [{"timestamp": "last_edited_time", "direction": "ascending"}]}
+            if edited_cursor:
+                # Notion rounds last_edited_time to the minute, so re-read the boundary minute
+                query["filter"] = {"timestamp": "last_edited_time", "last_edited_time": {"on_or_after": edited_cursor}}
+
+            fetched = 0
+            newest = edited_cursor
+            start_cursor = None
+            while True:
+                page = query_page(database_id=database_id, start_cursor=start_cursor, page_size=NOTION_MAX_PAGE_SIZE, **query)
+                results = page.get("results", [])
+                self._store_pages(conn, workspace_id, bot_id, database_id, results, started_at)
+                fetched += len(results)
+                for result in results:
+                    if result.get("last_edited_time") and (newest is None or result["last_edited_time"] > newest):
+                        newest = result["last_edited_time"]
+                if not page.get("has_more"):
+                    break
+                start_cursor = page.get("next_cursor")
+
+            with conn:
+                if full:
+                    # Whatever a full sync did not see was deleted (or moved) in Notion
+                    conn.execute(
+                        "DELETE FROM mirrored_values WHERE workspace_id = ? AND bot_id = ? AND database_id = ? AND page_id IN "
+                        "(SELECT page_id FROM mirrored_pages WHERE workspace_id = ? AND bot_id = ? AND database_id = ? AND synced_at < ?)",
+                        mirror_key + mirror_key + (started_at,),
+                    )
+                    conn.execute(
+                        "DELETE FROM mirrored_pages WHERE workspace_id = ? AND bot_id = ? AND database_id = ? AND synced_at < ?",
+                        mirror_key + (started_at,),
+                    )
+                    conn.execute(
+                        "UPDATE mirrored_databases SET last_full_sync_at = ? WHERE workspace_id = ? AND bot_id = ? AND database_id = ?",
+                        (started_at,) + mirror_key,
+                    )
+                conn.execute(
+                    "UPDATE mirrored_databases SET last_edited_cursor = ?, last_synced_at = ? WHERE workspace_id = ? AND bot_id = ? AND database_id = ?",
+                    (newest, started_at) + mirror_key,
+                )
+            print(f"DEBUG: Mirror sync of DB {database_id} fetched {fetched} pages (full={full})")
+            return fetched
+        finally:
+            conn.close()
+
+    def store_page_if_mirrored(self, workspace_id, bot_id, page):
+        """Writes a page a bot just created/updated through the proxy into that bot's mirror of its database, if any."""
+        database_id = normalize_notion_id((page.get("parent") or {}).get("database_id"))
+        if not database_id:
+            return
+        conn = self.connect()
+        try:
+            mirrored = conn.execute(
+                "SELECT 1 FROM mirrored_databases WHERE workspace_id = ? AND bot_id = ? AND database_id = ?",
+                (workspace_id, bot_id, database_id),
+            ).fetchone()
+            if mirrored:
+                self._store_pages(conn, workspace_id, bot_id, database_id, [page], time.time())
+        finally:
+            conn.close()
+
+    # --- Query ---
+    def _values_subquery(self, property_name, condition, params):
+        sql = "SELECT page_id FROM mirrored_values WHERE workspace_id = ? AND bot_id = ? AND database_id = ? AND property = ?"
+        if condition:
+            sql += " AND " + condition
+        return sql, [property_name] + params
+
+    def _date_condition(self, column, operator, value):
+        """Translates a date operator into an index-friendly range over normalized strings."""
+        if not isinstance(value, str):
+            raise MirrorUnsupported(f"date {operator}")
+        if "T" in value:
+            value = _mirror_date(value)
+            comparisons = {"equals": "=", "before": "<", "after": ">", "on_or_before": "<=", "on_or_after": ">="}
+            if operator not in comparisons:
+                raise MirrorUnsupported(f"date {operator}")
+            return f"{column} {comparisons[operator]} ?", [value]
+        # Date-only values compare whole days, whatever the time stored
+        day, next_day = value[:10], _mirror_next_day(value)
+        if operator == "equals":
+            return f"{column} >= ? AND {column} < ?", [day, next_day]
+        if operator == "before":
+            return f"{column} < ?", [day]
+        if operator == "after":
+            return f"{column} >= ?", [next_day]
+        if operator == "on_or_before":
+            return f"{column} < ?", [next_day]
+        if operator == "on_or_after":
+            return f"{column} >= ?", [day]
+        raise MirrorUnsupported(f"date {operator}")
+
+    def _filter_sql(self, filter_data):
+        """Returns (sql, params) for a Notion filter, with '?' placeholders for the values.
+
+        Property conditions become IN / NOT IN over `mirrored_values`, whose
+        leading workspace/bot/database placeholders are filled in by query().
+        """
+        if "and" in filter_data or "or" in filter_data:
+            joiner = " AND " if "and" in filter_data else " OR "
+            parts, params = [], []
+            for sub_filter in filter_data.get("and") or filter_data.get("or") or []:
+                sql, sub_params = self._filter_sql(sub_filter)
+                parts.append(f"({sql})")
+                params.extend(sub_params)
+            return (joiner.join(parts) or "1"), params
+
+        if "timestamp" in filter_data:
+            column = filter_data["timestamp"]
+            if column not in ("created_time", "last_edited_time"):
+                raise MirrorUnsupported(f"timestamp {column}")
+            ((operator, value),) = filter_data[column].items()
+            sql, params = self._date_condition(f"p.{column}", operator, value)
+            return sql, params
+
+        property_name = filter_data.get("property")
+        types = [key for key in filter_data if key != "property"]
+        if not property_name or len(types) != 1 or not isinstance(filter_data[types[0]], dict) or len(filter_data[types[0]]) != 1:
+            raise MirrorUnsupported(f"filter {filter_data}")
+        prop_type = types[0]
+        ((operator, value),) = filter_data[prop_type].items()
+
+        if operator in ("is_empty", "is_not_empty"):
+            sql, params = self._values_subquery(property_name, None, [])
+            return ("p.page_id NOT IN (" if operator == "is_empty" else "p.page_id IN (") + sql + ")", ["$scope"] + params
+        negate = operator in ("does_not_equal", "does_not_contain")
+
+        if prop_type in self.TEXT_TYPES:
+            if not isinstance(value, str):
+                raise MirrorUnsupported(f"{prop_type} {operator}")
+            escaped = value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            conditions = {
+                "equals": ("text_value = ?", value),
+                "does_not_equal": ("text_value = ?", value),
+                "contains": ("text_value LIKE ? ESCAPE '\\'", f"%{escaped}%"),
+                "does_not_contain": ("text_value LIKE ? ESCAPE '\\'", f"%{escaped}%"),
+                "starts_with": ("text_value LIKE ? ESCAPE '\\'", f"{escaped}%"),
+                "ends_with": ("text_value LIKE ? ESCAPE '\\'", f"%{escaped}"),
+            }
+            if operator not in conditions:
+                raise MirrorUnsupported(f"{prop_type} {operator}")
+            condition, param = conditions[operator]
+            condition_params = [param]
+        elif prop_type in self.LIST_TYPES:
+            if operator not in ("contains", "does_not_contain") or not isinstance(value, str):
+                raise MirrorUnsupported(f"{prop_type} {operator}")
+            condition, condition_params = "text_value = ?", [value]
+        elif prop_type in ("number", "unique_id"):
+            comparisons = {
+                "equals": "=", "does_not_equal": "=",
+                "greater_than": ">", "less_than": "<",
+                "greater_than_or_equal_to": ">=", "less_than_or_equal_to": "<=",
+            }
+            if operator not in comparisons or isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise MirrorUnsupported(f"{prop_type} {operator}")
+            condition, condition_params = f"number_value {comparisons[operator]} ?", [value]
+        elif prop_type == "checkbox":
+            if operator not in ("equals", "does_not_equal") or not isinstance(value, bool):
+                raise MirrorUnsupported(f"checkbox {operator}")
+            checked = value if operator == "equals" else not value
+            # Match unchecked as "not checked" so pages without a stored value count as unchecked
+            condition, condition_params, negate = "number_value = 1", [], not checked
+        elif prop_type in self.DATE_TYPES:
+            condition, condition_params = self._date_condition("date_start", operator, value)
+        else:
+            raise MirrorUnsupported(f"property type {prop_type}")
+
+        sql, params = self._values_subquery(property_name, condition, condition_params)
+        return ("p.page_id NOT IN (" if negate else "p.page_id IN (") + sql + ")", ["$scope"] + params
+
+    def _order_sql(self, sorts_data):
+        """Returns (sql, params) for Notion sorts; like Notion, pages without a value sort last either way."""
+        if not sorts_data:
+            return "p.created_time DESC, p.page_id", []
+        parts, params = [], []
+        for sort in sorts_data:
+            direction = {"ascending": "ASC", "descending": "DESC"}.get(sort.get("direction", "ascending"))
+            if direction is None:
+                raise MirrorUnsupported(f"sort {sort}")
+            if sort.get("timestamp") in ("created_time", "last_edited_time"):
+                parts.append(f"p.{sort['timestamp']} {direction}")
+            elif sort.get("property"):
+                parts.append(
+                    "(SELECT COALESCE(number_value, date_start, text_value) FROM mirrored_values v "
+                    "WHERE v.workspace_id = p.workspace_id AND v.bot_id = p.bot_id AND v.database_id = p.database_id "
+                    f"AND v.page_id = p.page_id AND v.property = ? ORDER BY 1 LIMIT 1) {direction} NULLS LAST"
+                )
+                params.append(sort["property"])
+            else:
+                raise MirrorUnsupported(f"sort {sort}")
+        parts.append("p.page_id") # Stable order for offset cursors
+        return ", ".join(parts), params
+
+    def query(self, workspace_id, bot_id, database_id, filter_data=None, sorts_data=None, start_cursor=None, page_size=NOTION_MAX_PAGE_SIZE):
+        """Answers a databases.query call from the mirror, in Notion's response shape.
+
+        Raises MirrorUnsupported for filters, sorts or cursors it cannot handle.
+        """
+        database_id = normalize_notion_id(database_id)
+        scope = [workspace_id, bot_id, database_id]
+        offset = 0
+        if start_cursor:
+            if not str(start_cursor).startswith("mirror:"):
+                raise MirrorUnsupported("cursor from Notion")
+            try:
+                offset = int(start_cursor[len("mirror:"):])
+            except ValueError:
+                raise MirrorUnsupported(f"cursor {start_cursor}")
+        page_size = max(1, min(int(page_size or NOTION_MAX_PAGE_SIZE), NOTION_MAX_PAGE_SIZE))
+
+        try:
+            where, where_params = self._filter_sql(filter_data) if filter_data else ("1", [])
+            order, order_params = self._order_sql(sorts_data)
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            # Malformed or unexpected shapes: let Notion answer (and validate) instead
+            raise MirrorUnsupported(str(e))
+        # "$scope" marks where a values subquery needs its workspace/bot/database
+        params = []
+        for param in where_params:
+            if param == "$scope":
+                params.extend(scope)
+            else:
+                params.append(param)
+        sql = (
+            "SELECT p.data FROM mirrored_pages p "
+            f"WHERE p.workspace_id = ? AND p.bot_id = ? AND p.database_id = ? AND p.archived = 0 AND ({where}) "
+            f"ORDER BY {order} LIMIT ? OFFSET ?"
+        )
+        conn = self.connect()
+        try:
+            rows = conn.execute(sql, scope + params + order_params + [page_size + 1, offset]).fetchall()
+        finally:
+            conn.close()
+        has_more = len(rows) > page_size
+        return {
+            "object": "list",
+            "results": [json.loads(row["data"]) for row in rows[:page_size]],
+            "next_cursor": f"mirror:{offset + page_size}" if has_more else None,
+            "has_more": has_more,
+            "type": "page_or_database",
+            "page_or_database": {},
+        }
+
+notion_mirror = NotionMirror(NOTION_MIRROR_DB)
+
+def sync_mirrored_databases():
+    """Brings every mirrored database up to date, each with the token of the bot that owns it.
+
+    A database whose last full sync is older than NOTION_MIRROR_FULL_SYNC_INTERVAL
+    is re-read in full, which drops the pages archived or deleted since.
+    """
+    for workspace_id, bot_id, database_id in notion_mirror.registered():
+        try:
+            credentials = notion_token_store.get_by_bot(workspace_id, bot_id)
+            status = notion_mirror.status(workspace_id, bot_id, database_id)
+            if not credentials or not status:
+                continue
+            last_full = status["last_full_sync_at"]
+            full = NOTION_MIRROR_FULL_SYNC_INTERVAL > 0 and (last_full is None or time.time() - last_full >= NOTION_MIRROR_FULL_SYNC_INTERVAL)
+            client = lease_notion_client(credentials["access_token"])
+            try:
+                notion_mirror.sync(
+                    lambda **kwargs: notion_limiter.call(workspace_id, client.databases.query, **kwargs),
+                    workspace_id,
+                    bot_id,
+                    database_id,
+                    full=full,
+                )
+            finally:
+                release_notion_client(client)
+        except Exception as e:
+            print(f"ERROR in background mirror sync of DB {database_id}: {e}")
+
+def sync_mirrored_databases_forever():
+    """Background loop that keeps every mirrored database in sync (NOTION_MIRROR_SYNC_INTERVAL > 0)."""
+    while True:
+        time.sleep(NOTION_MIRROR_SYNC_INTERVAL)
+        sync_mirrored_databases()
+
+if NOTION_MIRROR_SYNC_INTERVAL > 0:
+    threading.Thread(target=sync_mirrored_databases_forever, name="notion-mirror-sync", daemon=True).start()
+
+# --- Write-behind Queue ---
+class NotionWriteQueue:
+    """Durable write-behind queue for page property updates.
+
+    Jobs live in SQLite (NOTION_WRITE_QUEUE_DB), so any worker can report a
+    job's status and any worker's drainer can flush it. A job only becomes
+    due NOTION_WRITE_COALESCE_SECONDS after it was queued; until a drainer
+    claims it, further updates to the same page are merged into it (later
+    values win per property), so a burst of PATCHes costs one Notion call.
+    Each job remembers the bot that queued it: it is sent with that bot's
+    token, only merged with that bot's updates and only visible to it.
+    Jobs for a page are never run concurrently, which keeps them in order.
+    """
+
+    def __init__(self, db_path, coalesce_seconds, stale_seconds, retention_seconds):
+        self.db_path = db_path
+        self.coalesce_seconds = coalesce_seconds
+        self.stale_seconds = stale_seconds
+        self.retention_seconds = retention_seconds
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+        self._wakeup = threading.Event()
+        self._drainer = None
+        self._drainer_lock = threading.Lock()
+
+    def connect(self):
+        """Opens a connection to the queue, creating the schema on first use."""
+        os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+        # Autocommit mode: transactions are opened explicitly with BEGIN IMMEDIATE
+        conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        if not self._schema_ready:
+            with self._schema_lock:
+                if not self._schema_ready:
+                    self._create_schema(conn)
+                    self._schema_ready = True
+        return conn
+
+    def _create_schema(self, conn):
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript("""
+        CREATE TABLE IF NOT EXISTS notion_write_jobs (
+            id TEXT PRIMARY KEY,
+            workspace_id TEXT NOT NULL,
+            bot_id TEXT NULL, -- Integration that queued the job and whose token sends it
+            page_id TEXT NOT NULL,
+            properties TEXT NOT NULL, -- JSON of the merged properties to send
+            status TEXT NOT NULL, -- 'pending', 'running', 'done', 'failed'
+            requests INTEGER NOT NULL DEFAULT 1, -- PATCHes coalesced into this job
+            result TEXT NULL,
+            error TEXT NULL,
+            created_at REAL NOT NULL,
+            due_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        """)
+        if "bot_id" not in [row["name"] for row in conn.execute("PRAGMA table_info(notion_write_jobs)")]:
+            # Jobs queued before this column existed have no bot and fail instead of borrowing another bot's token
+            conn.execute("ALTER TABLE notion_write_jobs ADD COLUMN bot_id TEXT NULL")
+        conn.executescript("""
+        CREATE INDEX IF NOT EXISTS idx_notion_write_jobs_due ON notion_write_jobs (status, due_at);
+        DROP INDEX IF EXISTS idx_notion_write_jobs_pending_page;
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_notion_write_jobs_pending_bot_page
+            ON notion_write_jobs (workspace_id, bot_id, page_id) WHERE status = 'pending';
+        CREATE INDEX IF NOT EXISTS idx_notion_write_jobs_page ON notion_write_jobs (workspace_id, page_id, status);
+        """)
+
+    def enqueue(self, workspace_id, bot_id, page_id, properties):
+        """Queues a bot's update, merging it into that bot's pending job for the page if there is one.
+
+        Returns (job_id, coalesced).
+        """
+        now = time.time()
+        conn = self.connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            pending = conn.execute(
+                "SELECT id, properties FROM notion_write_jobs WHERE workspace_id = ? AND bot_id = ? AND page_id = ? AND status = 'pending'",
+                (workspace_id, bot_id, page_id),
+            ).fetchone()
+            if pending:
+                merged = json.loads(pending["properties"])
+                merged.update(properties)
+                conn.execute(
+                    "UPDATE notion_write_jobs SET properties = ?, requests = requests + 1, updated_at = ? WHERE id = ?",
+                    (json.dumps(merged), now, pending["id"]),
+                )
+                job_id, coalesced = pending["id"], True
+            else:
+                job_id, coalesced = uuid.uuid4().hex, False
+                conn.execute(
+                    "INSERT INTO notion_write_jobs (id, workspace_id, bot_id, page_id, properties, status, created_at, due_at, updated_at) VALUES (?, ?, ?, ?, ?, 'pending', ?, ?, ?)",
+                    (job_id, workspace_id, bot_id, page_id, json.dumps(properties), now, now + self.coalesce_seconds, now),
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        self.ensure_drainer()
+        self._wakeup.set()
+        return job_id, coalesced
+
+    def get(self, workspace_id, bot_id, job_id):
+        """Returns a job queued by this bot, or None (also for other bots' jobs)."""
+        conn = self.connect()
+        try:
+            row = conn.execute(
+                "SELECT id, page_id, properties, status, requests, result, error, created_at, updated_at FROM notion_write_jobs WHERE id = ? AND workspace_id = ? AND bot_id = ?",
+                (job_id, workspace_id, bot_id),
+            ).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        job = dict(row)
+        job["properties"] = json.loads(job["properties"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def claim(self):
+        """Marks the oldest due job as running and returns it, or None if nothing is due."""
+        now = time.time()
+        conn = self.connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            # Jobs left 'running' by a worker that died are picked up again
+            conn.execute(
+                "UPDATE notion_write_jobs SET status = 'pending' WHERE status = 'running' AND updated_at < ?",
+                (now - self.stale_seconds,),
+            )
+            row = conn.execute(
+                """
+                SELECT j.id, j.workspace_id, j.bot_id, j.page_id, j.properties FROM notion_write_jobs j
+                WHERE j.status = 'pending' AND j.due_at <= ?
+                  AND NOT EXISTS (
+                      SELECT 1 FROM notion_write_jobs r
+                      WHERE r.workspace_id = j.workspace_id AND r.page_id = j.page_id AND r.status = 'running'
+                  )
+                ORDER BY j.due_at LIMIT 1
+                """,
+                (now,),
+            ).fetchone()
+            if row:
+                conn.execute("UPDATE notion_write_jobs SET status = 'running', updated_at = ? WHERE id = ?", (now, row["id"]))
+            conn.execute("COMMIT")
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        return dict(row) if row else None
+
+    def finish(self, job_id, result=None, error=None):
+        conn = self.connect()
+        try:
+            conn.execute(
+                "UPDATE notion_write_jobs SET status = ?, result = ?, error = ?, updated_at = ? WHERE id = ?",
+                ("failed" if error else "done", json.dumps(result) if result is not None else None, error, time.time(), job_id),
+            )
+        finally:
+            conn.close()
+
+    def purge(self):
+        """Deletes finished jobs older than the retention period."""
+        conn = self.connect()
+        try:
+            conn.execute(
+                "DELETE FROM notion_write_jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+                (time.time() - self.retention_seconds,),
+            )
+        finally:
+            conn.close()
+
+    def run_job(self, job):
+        """Sends one claimed job to Notion with the token of the bot that queued it, under its workspace's rate limit."""
+        workspace_id = job["workspace_id"]
+        try:
+            credentials = notion_token_store.get_by_bot(workspace_id, job["bot_id"]) if job["bot_id"] else None
+            if not credentials:
+                raise RuntimeError(f"No Notion token stored for bot {job['bot_id']} of workspace {workspace_id}")
+            client = lease_notion_client(credentials["access_token"])
+            try:
+                updated_item = notion_limiter.call(
+                    workspace_id,
+                    client.pages.update,
+                    page_id=job["page_id"],
+                    properties=json.loads(job["properties"]),
+                )
+            finally:
+                release_notion_client(client)
+        except Exception as e:
+            print(f"ERROR in queued update {job['id']} of Notion page {job['page_id']}: {e}")
+            self.finish(job["id"], error=notion_error_details(e))
+            return
+        record_notion_write(workspace_id, credentials["bot_id"], updated_item)
+        self.finish(job["id"], result=updated_item)
+
+    def drain_forever(self):
+        last_purge = 0.0
+        while True:
+            try:
+                job = self.claim()
+                if job:
+                    self.run_job(job)
+                    continue
+                if time.time() - last_purge > 3600:
+                    self.purge()
+                    last_purge = time.time()
+            except Exception as e:
+                print(f"ERROR in Notion write queue drainer: {e}")
+            # Sleep until the next coalescing window closes or a new job arrives
+            self._wakeup.wait(timeout=max(self.coalesce_seconds, 0.1))
+            self._wakeup.clear()
+
+    def ensure_drainer(self):
+        """Starts this worker's drainer thread on first use."""
+        if self._drainer is not None:
+            return
+        with self._drainer_lock:
+            if self._drainer is None:
+                self._drainer = threading.Thread(target=self.drain_forever, name="notion-write-queue", daemon=True)
+                self._drainer.start()
+
+notion_write_queue = NotionWriteQueue(
+    db_path=NOTION_WRITE_QUEUE_DB,
+    coalesce_seconds=NOTION_WRITE_COALESCE_SECONDS,
+    stale_seconds=NOTION_WRITE_STALE_SECONDS,
+    retention_seconds=NOTION_WRITE_JOB_RETENTION,
+)
+
+# --- Notion Client Cache ---
+# Guards client creation and the lease counts; reentrant because evictions
+# triggered while creating a client call back into _close_notion_client
+notion_clients_lock = threading.RLock()
+notion_client_leases = {} # id(client) -> requests/jobs currently using it
+retired_notion_clients = {} # id(client) -> client evicted while leased, closed by its last release
+
+def _close_notion_client(access_token, notion_client):
+    """Closes the httpx transport of a Notion client that left the cache, once nobody is using it.
+
+    Eviction (LRU or idle TTL) can hit a client that is still serving a
+    request, e.g. a long NDJSON export; that client is only retired here and
+    closed by release_notion_client() when its last lease ends.
+    """
+    with notion_clients_lock:
+        if notion_client_leases.get(id(notion_client)):
+            retired_notion_clients[id(notion_client)] = notion_client
+            return
+    notion_client.close()
+
+# One client per access token, shared by every request this worker serves
+notion_clients = LRUCache(
+    max_size=NOTION_CLIENT_CACHE_SIZE,
+    ttl=NOTION_CLIENT_IDLE_TTL,
+    on_evict=_close_notion_client,
+    sliding=True,
+)
+
+def get_cached_notion_client(access_token):
+    """Returns the pooled Notion client for a token, creating it on first use.
+
+    The client may be closed once it leaves the cache; code that keeps using
+    it should hold a lease (lease_notion_client) instead.
+    """
+    notion_client = notion_clients.get(access_token)
+    if notion_client is not None:
+        return notion_client
+    with notion_clients_lock:
+        # Another thread may have created it while we waited for the lock
+        notion_client = notion_clients.get(access_token)
+        if notion_client is None:
+            http_client = httpx.Client(limits=httpx.Limits(
+                max_connections=NOTION_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=NOTION_HTTP_MAX_KEEPALIVE,
+            ))
+            notion_client = Client(auth=access_token, client=http_client)
+            notion_clients.set(access_token, notion_client)
+    return notion_client
+
+def lease_notion_client(access_token):
+    """Returns the pooled client for a token, kept open until release_notion_client() even if evicted."""
+    with notion_clients_lock:
+        notion_client = get_cached_notion_client(access_token)
+        notion_client_leases[id(notion_client)] = notion_client_leases.get(id(notion_client), 0) + 1
+    return notion_client
+
+def release_notion_client(notion_client):
+    """Ends a lease; closes the client if it was evicted while leased and this was the last lease."""
+    with notion_clients_lock:
+        remaining = notion_client_leases.pop(id(notion_client), 0) - 1
+        if remaining > 0:
+            notion_client_leases[id(notion_client)] = remaining
+            return
+        retired = retired_notion_clients.pop(id(notion_client), None)
+    if retired is not None:
+        retired.close()
 
 # --- Helper Function to get Notion Client ---
+def request_api_key():
+    """Returns the API key sent with the request (Authorization/X-API-Key header, or browser session)."""
+    auth_header = request.headers.get("Authorization", "")
+    if auth_header.startswith("Bearer "):
+        return auth_header[len("Bearer "):].strip()
+    return request.headers.get("X-API-Key") or session.get("notion_api_key")
+
+def current_notion_credentials():
+    """Resolves the token record for the current request, once per request."""
+    if "notion_credentials" not in g:
+        api_key = request_api_key()
+        g.notion_credentials = notion_token_store.get_by_api_key(api_key) if api_key else None
+    return g.notion_credentials
+
 def get_notion_client():
-    """Returns an initialized Notion client if token exists in session."""
-    access_token = session.get("notion_access_token") # Get from session
-    if not access_token:
-        print("Warning: Notion token not available in session.")
+    """Returns a pooled Notion client for the request's API key, leased until the request (or its stream) ends."""
+    credentials = current_notion_credentials()
+    if not credentials:
+        print("Warning: Notion token not available for this request.")
         return None
-    return Client(auth=access_token)
+    if "notion_client" not in g:
+        g.notion_client = lease_notion_client(credentials["access_token"])
+    return g.notion_client
+
+@app.teardown_request
+def release_request_notion_client(exc):
+    # With stream_with_context this runs after the last streamed row, not when the view returns
+    notion_client = g.pop("notion_client", None)
+    if notion_client is not None:
+        release_notion_client(notion_client)
+
+def notion_workspace_key():
+    """Identifies the workspace the current request belongs to (rate limits and cache invalidation)."""
+    credentials = current_notion_credentials()
+    return credentials["workspace_id"] if credentials else "anonymous"
+
+def notion_bot_key():
+    """Identifies the integration (bot) the current request acts as; what Notion returns depends on it."""
+    credentials = current_notion_credentials()
+    return credentials["bot_id"] if credentials else "anonymous"
+
+def notion_error_response(message, e):
+    """Builds the JSON error response for a failed Notion call.
+
+    Rate limits that outlived our retries are passed on as 429 with Retry-After
+    so callers back off too; everything else stays a 500.
+    """
+    body = {"error": message, "details": notion_error_details(e)}
+    if getattr(e, 'status', None) == 429:
+        retry_after = retry_after_seconds(e)
+        headers = {"Retry-After": str(int(retry_after) if retry_after is not None else 1)}
+        return jsonify(body), 429, headers
+    return jsonify(body), 500
+
+def record_notion_write(workspace_key, bot_key, page, database_id=None):
+    """Keeps the query cache and the writing bot's local mirror consistent with a page the proxy just wrote."""
+    database_id = database_id or (page.get('parent') or {}).get('database_id')
+    if database_id:
+        notion_query_cache.invalidate(workspace_key, database_id)
+    try:
+        notion_mirror.store_page_if_mirrored(workspace_key, bot_key, page)
+    except Exception as e:
+        print(f"ERROR updating local mirror after write to page {page.get('id')}: {e}")
+
+def notion_error_details(e):
+    """Builds the 'details' string for a failed Notion call, including the response body if any."""
+    error_message = str(e)
+    try:
+        # Notion errors often have a JSON body
+        error_body = getattr(e, 'body', None)
+        if error_body:
+            error_message = f"{e} - Body: {error_body}"
+    except Exception:
+        pass # Keep original error message
+    return error_message
+
+# --- Request Instrumentation ---
+def _metrics_route():
+    # The URL rule (not the raw path) keeps label cardinality bounded
+    return request.url_rule.rule if request.url_rule else "unmatched"
+
+@app.before_request
+def start_request_metrics():
+    g.metrics_started = time.perf_counter()
+    HTTP_REQUESTS_IN_FLIGHT.labels(route=_metrics_route()).inc()
+
+@app.after_request
+def record_request_metrics(response):
+    route = _metrics_route()
+    if "metrics_started" in g:
+        HTTP_REQUEST_SECONDS.labels(route=route, method=request.method).observe(time.perf_counter() - g.metrics_started)
+    HTTP_REQUESTS_TOTAL.labels(route=route, method=request.method, status=str(response.status_code)).inc()
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    if "metrics_started" in g:
+        HTTP_REQUESTS_IN_FLIGHT.labels(route=_metrics_route()).dec()
+
+@app.route("/metrics")
+def metrics():
+    """Prometheus scrape endpoint."""
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return jsonify({"error": "Not authorized"}), 401
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
 
 # --- OAuth Routes ---
 @app.route("/notion/authorize")
@@ -85,31 +1713,27 @@ def notion_oauth_callback():
         )
         response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
         token_data = response.json()
-        print(f"DEBUG: Token data received: {token_data}")
-
-        notion_access_token = token_data.get("access_token")
-        notion_workspace_id = token_data.get("workspace_id")
-        notion_workspace_name = token_data.get("workspace_name")
-        notion_workspace_icon = token_data.get("workspace_icon")
-        notion_bot_id = token_data.get("bot_id")
+        print(f"DEBUG: Token data received for workspace: {token_data.get('workspace_id')}")
 
-        if not notion_access_token:
+        if not token_data.get("access_token"):
             return "Access token not found in Notion response.", 500
-        # Store token in session
-        session["notion_access_token"] = notion_access_token
-        # Store other potentially useful info in session too
-        session["notion_workspace_id"] = notion_workspace_id
-        session["notion_workspace_name"] = notion_workspace_name
-        session["notion_bot_id"] = notion_bot_id
+        if not token_data.get("workspace_id") or not token_data.get("bot_id"):
+            return "Workspace or bot ID not found in Notion response.", 500
 
-        print(f"Access Token received and stored in session: {session['notion_access_token'][:10]}...")
+        # Keep the token server-side; the browser session and API clients only carry the opaque key
+        api_key = notion_token_store.save(token_data)
+        session["notion_api_key"] = api_key
+
+        print(f"Access Token stored for workspace {token_data['workspace_id']} (bot {token_data['bot_id']})")
 
         return jsonify({
             "message": "Notion authorization successful! Token obtained.",
-            "workspace_id": notion_workspace_id,
-            "workspace_name": notion_workspace_name,
-            "workspace_icon": notion_workspace_icon,
-            "bot_id": notion_bot_id
+            # Shown only once: send it as "Authorization: Bearer <api_key>" from API clients
+            "api_key": api_key,
+            "workspace_id": token_data.get("workspace_id"),
+            "workspace_name": token_data.get("workspace_name"),
+            "workspace_icon": token_data.get("workspace_icon"),
+            "bot_id": token_data.get("bot_id")
         })
 
     except requests.exceptions.RequestException as e:
@@ -137,32 +1761,76 @@ def create_database_item(database_id):
         return jsonify({"error": "Not authorized. Please go to /notion/authorize"}), 401
 
     data = request.json
-    if not data or 'properties' not in data:
-        return jsonify({"error": "Missing 'properties' in request body"}), 400
+    error = validate_create_payload(database_id, data)
+    if error:
+        return jsonify({"error": error}), 400
 
     try:
-        # Ensure parent is correctly formatted if not provided
-        if 'parent' not in data:
-             data['parent'] = {'database_id': database_id}
-        elif data['parent'].get('database_id') != database_id:
-             # Prevent creating in a different DB than the URL specifies
-             return jsonify({"error": "Parent database ID mismatch"}), 400
-
         print(f"DEBUG: Creating item in DB {database_id} with properties: {data['properties']}")
-        new_item = client.pages.create(**data)
+        new_item = notion_limiter.call(notion_workspace_key(), client.pages.create, idempotent=False, **data)
+        record_notion_write(notion_workspace_key(), notion_bot_key(), new_item, database_id)
         return jsonify(new_item), 201
     except Exception as e:
         print(f"ERROR creating Notion item: {e}")
-        # Attempt to parse NotionClientError if possible
-        error_message = str(e)
+        return notion_error_response(f"Failed to create item in Notion database {database_id}", e)
+
+def validate_create_payload(database_id, data):
+    """Checks a page creation payload and fills in its parent. Returns an error message or None."""
+    if not isinstance(data, dict) or 'properties' not in data:
+        return "Missing 'properties' in request body"
+    # Ensure parent is correctly formatted if not provided
+    if 'parent' not in data:
+        data['parent'] = {'database_id': database_id}
+    elif not isinstance(data['parent'], dict) or data['parent'].get('database_id') != database_id:
+        # Prevent creating in a different DB than the URL specifies
+        return "Parent database ID mismatch"
+    return None
+
+@app.route("/notion/databases/<string:database_id>/items:batch", methods=["POST"])
+def create_database_items_batch(database_id):
+    """Creates several items in a Notion database, returning one result per item in input order."""
+    client = get_notion_client()
+    if not client:
+        return jsonify({"error": "Not authorized. Please go to /notion/authorize"}), 401
+
+    data = request.get_json(silent=True)
+    # Accept either {"items": [...]} or a bare list of page payloads
+    items = data.get('items') if isinstance(data, dict) else data
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "Request body must contain a non-empty 'items' list"}), 400
+    if len(items) > NOTION_BATCH_MAX_ITEMS:
+        return jsonify({"error": f"Too many items in batch (max {NOTION_BATCH_MAX_ITEMS})"}), 400
+
+    # Workers overlap Notion's latency while the workspace's bucket keeps the pace under the rate limit
+    workspace_key = notion_workspace_key()
+    bot_key = notion_bot_key()
+
+    def create_one(index, item):
+        error = validate_create_payload(database_id, item)
+        if error:
+            return {"index": index, "status": 400, "error": error}
         try:
-            # Notion errors often have a JSON body
-            error_body = getattr(e, 'body', None)
-            if error_body:
-                error_message = f"{e} - Body: {error_body}"
-        except Exception:
-            pass # Keep original error message
-        return jsonify({"error": f"Failed to create item in Notion database {database_id}", "details": error_message}), 500
+            new_item = notion_limiter.call(workspace_key, client.pages.create, idempotent=False, **item)
+            record_notion_write(workspace_key, bot_key, new_item, database_id)
+            return {"index": index, "status": 201, "item": new_item}
+        except Exception as e:
+            print(f"ERROR creating item {index} of batch in DB {database_id}: {e}")
+            return {
+                "index": index,
+                "status": 429 if getattr(e, 'status', None) == 429 else 500,
+                "error": f"Failed to create item in Notion database {database_id}",
+                "details": notion_error_details(e),
+            }
+
+    print(f"DEBUG: Creating {len(items)} items in DB {database_id} with {NOTION_BATCH_WORKERS} workers")
+    with ThreadPoolExecutor(max_workers=NOTION_BATCH_WORKERS) as executor:
+        futures = [executor.submit(create_one, index, item) for index, item in enumerate(items)]
+        results = [future.result() for future in futures]
+
+    failed = sum(1 for result in results if result["status"] != 201)
+    body = {"results": results, "succeeded": len(results) - failed, "failed": failed}
+    # 207 tells the caller to look at the per-item statuses
+    return jsonify(body), (207 if failed else 200)
 
 @app.route("/notion/pages/<string:page_id>", methods=["PATCH"])
 def update_database_item(page_id):
@@ -175,20 +1843,36 @@ def update_database_item(page_id):
     if not data or 'properties' not in data:
         return jsonify({"error": "Missing 'properties' in request body"}), 400
 
+    # Write-behind mode: acknowledge now, merge with other pending updates and flush in the background
+    if request.args.get('async') in ('1', 'true') or 'respond-async' in request.headers.get('Prefer', ''):
+        if not isinstance(data['properties'], dict):
+            return jsonify({"error": "'properties' must be an object"}), 400
+        job_id, coalesced = notion_write_queue.enqueue(notion_workspace_key(), notion_bot_key(), page_id, data['properties'])
+        print(f"DEBUG: Queued update of page {page_id} as job {job_id} (coalesced={coalesced})")
+        status_url = f"/notion/jobs/{job_id}"
+        return jsonify({"job_id": job_id, "status": "pending", "coalesced": coalesced, "status_url": status_url}), 202, {"Location": status_url}
+
     try:
         print(f"DEBUG: Updating page {page_id} with properties: {data['properties']}")
-        updated_item = client.pages.update(page_id=page_id, properties=data['properties'])
+        updated_item = notion_limiter.call(notion_workspace_key(), client.pages.update, page_id=page_id, properties=data['properties'])
+        # The page id alone does not say which database to invalidate; the response's parent does
+        record_notion_write(notion_workspace_key(), notion_bot_key(), updated_item)
         return jsonify(updated_item)
     except Exception as e:
         print(f"ERROR updating Notion page {page_id}: {e}")
-        error_message = str(e)
-        try:
-            error_body = getattr(e, 'body', None)
-            if error_body:
-                error_message = f"{e} - Body: {error_body}"
-        except Exception:
-            pass
-        return jsonify({"error": f"Failed to update Notion page {page_id}", "details": error_message}), 500
+        return notion_error_response(f"Failed to update Notion page {page_id}", e)
+
+@app.route("/notion/jobs/<string:job_id>")
+def get_write_job(job_id):
+    """Reports the status of a queued page update."""
+    if not current_notion_credentials():
+        return jsonify({"error": "Not authorized. Please go to /notion/authorize"}), 401
+    # Make sure someone is draining, e.g. jobs left behind by a restarted worker
+    notion_write_queue.ensure_drainer()
+    job = notion_write_queue.get(notion_workspace_key(), notion_bot_key(), job_id)
+    if not job:
+        return jsonify({"error": f"Job {job_id} not found"}), 404
+    return jsonify(job)
 
 @app.route("/notion/databases/<string:database_id>/query", methods=["POST"])
 def query_database(database_id):
@@ -197,33 +1881,167 @@ def query_database(database_id):
     if not client:
         return jsonify({"error": "Not authorized. Please go to /notion/authorize"}), 401
 
-    query_params = request.json or {}
+    query_params = request.get_json(silent=True) or {}
     # Default to empty filter if not provided
     filter_data = query_params.get('filter')
     sorts_data = query_params.get('sorts')
     start_cursor = query_params.get('start_cursor')
-    page_size = query_params.get('page_size', 100) # Default page size
+    page_size = query_params.get('page_size', NOTION_MAX_PAGE_SIZE)
+    if not isinstance(page_size, int) or isinstance(page_size, bool) or page_size < 1:
+        return jsonify({"error": "'page_size' must be a positive integer"}), 400
+    page_size = min(page_size, NOTION_MAX_PAGE_SIZE)
+
+    # Opt-in auto-pagination: follow next_cursor here and stream rows as NDJSON
+    if query_params.get('all') is True or request.args.get('stream') == 'ndjson':
+        max_rows = query_params.get('max_rows', NOTION_STREAM_MAX_ROWS)
+        if not isinstance(max_rows, int) or isinstance(max_rows, bool) or max_rows < 1:
+            return jsonify({"error": "'max_rows' must be a positive integer"}), 400
+        rows = stream_database_rows(
+            client,
+            notion_workspace_key(),
+            database_id,
+            filter_data=filter_data,
+            sorts_data=sorts_data,
+            start_cursor=start_cursor,
+            page_size=page_size,
+            max_rows=min(max_rows, NOTION_STREAM_MAX_ROWS),
+        )
+        return Response(stream_with_context(rows), mimetype="application/x-ndjson")
+
+    # Callers that tolerate stale data can be served from the local mirror;
+    # "allow_stale": true accepts any age, a number is the max age in seconds
+    allow_stale = query_params.get('allow_stale')
+    if allow_stale:
+        mirrored = query_local_mirror(database_id, allow_stale, filter_data, sorts_data, start_cursor, page_size)
+        if mirrored is not None:
+            return mirrored
+
+    cache_key = notion_query_cache.key(notion_workspace_key(), notion_bot_key(), database_id, {
+        "filter": filter_data,
+        "sorts": sorts_data,
+        "start_cursor": start_cursor,
+        "page_size": page_size,
+    })
+    # "Cache-Control: no-cache" skips the lookup but still refreshes the entry
+    if "no-cache" not in request.headers.get("Cache-Control", ""):
+        cached_body = notion_query_cache.get(cache_key)
+        NOTION_QUERY_CACHE_TOTAL.labels(result="hit" if cached_body is not None else "miss").inc()
+        if cached_body is not None:
+            return Response(cached_body, mimetype="application/json", headers={"X-Cache": "HIT"})
 
     try:
         print(f"DEBUG: Querying DB {database_id} with filter: {filter_data}")
-        results = client.databases.query(
+        results = notion_limiter.call(
+            notion_workspace_key(),
+            client.databases.query,
             database_id=database_id,
             filter=filter_data,
             sorts=sorts_data,
             start_cursor=start_cursor,
             page_size=page_size
         )
-        return jsonify(results)
+        body = json.dumps(results)
+        notion_query_cache.set(cache_key, body)
+        return Response(body, mimetype="application/json", headers={"X-Cache": "MISS"})
     except Exception as e:
         print(f"ERROR querying Notion database {database_id}: {e}")
-        error_message = str(e)
+        return notion_error_response(f"Failed to query Notion database {database_id}", e)
+
+def query_local_mirror(database_id, allow_stale, filter_data, sorts_data, start_cursor, page_size):
+    """Answers a query from the local mirror, or returns None when Notion must be asked instead."""
+    workspace_key, bot_key = notion_workspace_key(), notion_bot_key()
+    status = notion_mirror.status(workspace_key, bot_key, database_id)
+    if not status or status["last_synced_at"] is None:
+        return None
+    age = time.time() - status["last_synced_at"]
+    if allow_stale is not True and (not isinstance(allow_stale, (int, float)) or age > allow_stale):
+        return None
+    try:
+        results = notion_mirror.query(workspace_key, bot_key, database_id, filter_data, sorts_data, start_cursor, page_size)
+    except MirrorUnsupported as e:
+        print(f"DEBUG: Mirror cannot answer query on DB {database_id} ({e}), asking Notion")
+        return None
+    return Response(json.dumps(results), mimetype="application/json", headers={
+        "X-Notion-Mirror": "hit",
+        "X-Notion-Mirror-Age": str(int(age)),
+    })
+
+@app.route("/notion/databases/<string:database_id>/mirror", methods=["GET", "POST", "DELETE"])
+def database_mirror(database_id):
+    """Shows (GET), syncs (POST, {"full": true} to re-read everything) or drops (DELETE) a local mirror."""
+    client = get_notion_client()
+    if not client:
+        return jsonify({"error": "Not authorized. Please go to /notion/authorize"}), 401
+    workspace_key, bot_key = notion_workspace_key(), notion_bot_key()
+
+    if request.method == "DELETE":
+        notion_mirror.remove(workspace_key, bot_key, database_id)
+        return "", 204
+
+    if request.method == "POST":
+        full = bool((request.get_json(silent=True) or {}).get('full'))
         try:
-            error_body = getattr(e, 'body', None)
-            if error_body:
-                error_message = f"{e} - Body: {error_body}"
-        except Exception:
-            pass
-        return jsonify({"error": f"Failed to query Notion database {database_id}", "details": error_message}), 500
+            fetched = notion_mirror.sync(
+                lambda **kwargs: notion_limiter.call(workspace_key, client.databases.query, **kwargs),
+                workspace_key,
+                bot_key,
+                database_id,
+                full=full,
+            )
+        except Exception as e:
+            print(f"ERROR syncing mirror of Notion database {database_id}: {e}")
+            return notion_error_response(f"Failed to sync mirror of Notion database {database_id}", e)
+        return jsonify({"database_id": database_id, "fetched": fetched, **notion_mirror.status(workspace_key, bot_key, database_id)})
+
+    status = notion_mirror.status(workspace_key, bot_key, database_id)
+    if not status:
+        return jsonify({"error": f"Database {database_id} is not mirrored"}), 404
+    return jsonify({"database_id": database_id, **status})
+
+def stream_database_rows(client, workspace_key, database_id, filter_data=None, sorts_data=None, start_cursor=None, page_size=NOTION_MAX_PAGE_SIZE, max_rows=NOTION_STREAM_MAX_ROWS):
+    """Yields NDJSON lines for every row of a database query, fetching one page at a time.
+
+    Only the current page is held in memory. The last line is always a summary
+    object ({"object": "summary", ...}) with the number of rows sent and the
+    cursor to resume from when the row cap was hit, or an {"object": "error"}
+    line if Notion failed mid-stream.
+    """
+    sent = 0
+    cursor = start_cursor
+    has_more = True
+    while has_more and sent < max_rows:
+        try:
+            print(f"DEBUG: Streaming DB {database_id} page from cursor {cursor}")
+            page = notion_limiter.call(
+                workspace_key,
+                client.databases.query,
+                database_id=database_id,
+                filter=filter_data,
+                sorts=sorts_data,
+                start_cursor=cursor,
+                page_size=min(page_size, max_rows - sent)
+            )
+        except Exception as e:
+            print(f"ERROR streaming Notion database {database_id}: {e}")
+            yield json.dumps({
+                "object": "error",
+                "error": f"Failed to query Notion database {database_id}",
+                "details": notion_error_details(e),
+                "rows": sent,
+                "next_cursor": cursor,
+            }) + "\n"
+            return
+        for row in page.get("results", []):
+            yield json.dumps(row) + "\n"
+            sent += 1
+        has_more = page.get("has_more", False)
+        cursor = page.get("next_cursor")
+    yield json.dumps({
+        "object": "summary",
+        "rows": sent,
+        "has_more": has_more,
+        "next_cursor": cursor if has_more else None,
+    }) + "\n"
 
 # --- Add other endpoints as needed (GET page, GET database etc.) ---
 
@@ -238,17 +2056,23 @@ if __name__ == "__main__":
 # --- Debug Endpoint ---
 @app.route("/notion/check-token")
 def notion_check_token():
-    """Checks if the Notion token exists in the current session."""
-    access_token = session.get("notion_access_token")
-    if access_token:
+    """Checks if the request's API key resolves to a stored Notion token."""
+    credentials = current_notion_credentials()
+    if credentials:
         return jsonify({
-            "status": "Token found in session!",
-            "token_start": access_token[:10] + "...",
-            "workspace_id": session.get("notion_workspace_id"),
-            "workspace_name": session.get("notion_workspace_name")
+            "status": "Token found!",
+            "token_start": credentials["access_token"][:10] + "...",
+            "workspace_id": credentials["workspace_id"],
+            "workspace_name": credentials["workspace_name"],
+            "bot_id": credentials["bot_id"]
         })
     else:
-        return jsonify({"status": "Token NOT found in session."}), 404
+        return jsonify({"status": "Token NOT found for this request."}), 404
+
+@app.route("/notion/rate-limit/stats")
+def notion_rate_limit_stats():
+    """Reports this worker's rate limiter counters (queue depth, throttled time, retries)."""
+    return jsonify(notion_limiter.snapshot())
 
 
 
@@ -278,11 +2102,15 @@ def test_create_item_endpoint(database_id):
 
     try:
         print(f"DEBUG: Attempting to create test item '{test_item_title}' in DB {database_id}")
-        new_item = client.pages.create(
+        new_item = notion_limiter.call(
+            notion_workspace_key(),
+            client.pages.create,
+            idempotent=False,
             parent={"database_id": database_id},
             properties=test_properties
         )
         print(f"DEBUG: Test item created successfully: {new_item.get('id')}")
+        record_notion_write(notion_workspace_key(), notion_bot_key(), new_item, database_id)
         return jsonify({
             "message": f"Successfully created test item '{test_item_title}'!",
             "item_id": new_item.get('id'),
@@ -290,12 +2118,5 @@ def test_create_item_endpoint(database_id):
         }), 201
     except Exception as e:
         print(f"ERROR creating test item in DB {database_id}: {e}")
-        error_message = str(e)
-        try:
-            error_body = getattr(e, 'body', None)
-            if error_body:
-                error_message = f"{e} - Body: {error_body}"
-        except Exception:
-            pass
-        return jsonify({"error": f"Failed to create test item in Notion database {database_id}", "details": error_message}), 500
+        return notion_error_response(f"Failed to create test item in Notion database {database_id}", e)
 
@@ -0,0 +1,17 @@
+import os
+import sys
+
+# Permite importar o pacote src ao rodar "python scripts/gc_uploads.py"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.main import app, collect_upload_garbage
+
+# Deduplica arquivos antigos, apaga blobs sem referência e temporários de uploads interrompidos.
+# Uso: python scripts/gc_uploads.py [idade mínima dos órfãos em segundos, padrão 3600]
+min_age_seconds = int(sys.argv[1]) if len(sys.argv) > 1 else 3600
+
+with app.app_context():
+    stats = collect_upload_garbage(min_age_seconds)
+
+print(f"{stats['relinked']} arquivos deduplicados ({stats['bytes_freed']} bytes liberados), "
+      f"{stats['blobs_removed']} blobs e {stats['temp_removed']} temporários removidos.")
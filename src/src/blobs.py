@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""Armazenamento dos uploads por conteúdo (SHA-256).
+
+Cada conteúdo é guardado uma única vez em ``<raiz>/<2 primeiros hex>/<sha256>``. Os arquivos de
+cada usuário (``UPLOAD_FOLDER/<user_id>/<uuid>_<nome>``) são hardlinks para o blob, então
+continuam servidos e listados como antes sem ocupar espaço de novo. Se o sistema de arquivos
+não aceitar hardlinks, a referência vira uma cópia.
+"""
+import os
+import shutil
+
+
+def blob_path(root, sha256):
+    return os.path.join(root, sha256[:2], sha256)
+
+
+def link_or_copy(source, dest):
+    try:
+        os.link(source, dest)
+    except FileNotFoundError:
+        raise
+    except OSError as e: # Sem suporte a hardlink (ou outro volume): ocupa espaço, mas funciona
+        print(f"AVISO: hardlink indisponível ({e}); copiando {source} para {dest}")
+        shutil.copyfile(source, dest)
+
+
+def store_blob(root, temp_path, sha256, dest):
+    """Guarda o arquivo temporário como blob (se o conteúdo ainda não existe) e cria dest apontando para ele.
+
+    Retorna True se o conteúdo já estava guardado (o temporário é descartado).
+    """
+    path = blob_path(root, sha256)
+    try:
+        link_or_copy(path, dest)
+        os.remove(temp_path)
+        return True
+    except FileNotFoundError:
+        pass
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(temp_path, path)
+    link_or_copy(path, dest)
+    return False
+
+
+def adopt_file(root, sha256, path):
+    """Troca um arquivo de usuário já gravado por um hardlink para o blob do mesmo conteúdo.
+
+    Retorna o número de bytes liberados (0 se o arquivo já era o blob ou virou o blob).
+    """
+    target = blob_path(root, sha256)
+    if not os.path.exists(target):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        link_or_copy(path, target)
+        return 0
+    if os.path.samefile(path, target):
+        return 0
+    size = os.path.getsize(path)
+    tmp_path = f"{path}.relink"
+    os.link(target, tmp_path)
+    os.replace(tmp_path, path)
+    return size
+
+
+def remove_blob(root, sha256):
+    try:
+        os.remove(blob_path(root, sha256))
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def iter_blobs(root):
+    """Gera (sha256, caminho) de todos os blobs gravados."""
+    if not os.path.isdir(root):
+        return
+    for prefix in os.listdir(root):
+        directory = os.path.join(root, prefix)
+        if os.path.isdir(directory):
+            for name in os.listdir(directory):
+                yield name, os.path.join(directory, name)
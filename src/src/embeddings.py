@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""Embeddings e índice vetorial local para recuperar trechos de arquivos e conversas antigas.
+
+O modelo de embeddings é plugável (``get_embedder``): ``hashing`` é local e determinístico
+(testes e desenvolvimento) e ``openai`` usa a API de embeddings. Os vetores de cada usuário
+ficam em segmentos de arquivos NumPy (keys + vectors), lidos com mmap na hora da busca.
+"""
+import hashlib
+import os
+import re
+import threading
+import time
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError: # Windows: sem trava entre processos (só entre threads)
+    fcntl = None
+
+KIND_HISTORY = 0 # ref = chat_history.id
+KIND_UPLOAD = 1 # ref = uploads.id, part = blob_chunks.chunk_index
+
+KEY_DTYPE = np.dtype([("kind", "u1"), ("ref", "i8"), ("part", "i4")])
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+SEGMENT_RE = re.compile(r"^seg-(\d+)\.keys\.npy$")
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return (vectors / norms).astype(np.float32, copy=False)
+
+
+class HashingEmbedder:
+    """Embeddings locais: palavras e pares de palavras espalhados em dim posições por hash."""
+
+    def __init__(self, dim=256):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def _bucket(self, feature):
+        digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+        value = int.from_bytes(digest, "little")
+        return value % self.dim, 1.0 if value >> 63 else -1.0
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            words = WORD_RE.findall(text.lower())
+            for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+                index, sign = self._bucket(feature)
+                vectors[row, index] += sign
+        return _normalize(vectors)
+
+
+class OpenAIEmbedder:
+    """Embeddings da API da OpenAI (client.embeddings.create)."""
+
+    def __init__(self, client, model="text-embedding-3-small"):
+        self.client = client
+        self.name = model
+
+    def embed(self, texts):
+        response = self.client.embeddings.create(model=self.name, input=list(texts))
+        return _normalize(np.array([item.embedding for item in response.data], dtype=np.float32))
+
+
+def get_embedder(provider, model=None, client=None):
+    if provider == "hashing":
+        return HashingEmbedder(int(model) if model else 256)
+    if provider == "openai":
+        return OpenAIEmbedder(client, model or "text-embedding-3-small")
+    raise ValueError(f"Provedor de embeddings desconhecido: {provider}")
+
+
+class VectorIndex:
+    """Índice só de acréscimos de um usuário (e de um modelo de embeddings), em segmentos imutáveis.
+
+    Cada append grava só os vetores novos num segmento próprio (seg-N.vectors.npy + seg-N.keys.npy,
+    vetores primeiro, cada um trocado com os.replace), então o custo de uma escrita não cresce com o
+    índice. Quando o último segmento fica do tamanho do anterior, os dois viram um só: como num
+    contador binário, há O(log n) segmentos e cada vetor é regravado O(log n) vezes no total.
+    Os keys.npy/vectors.npy de um índice antigo contam como o primeiro segmento.
+    """
+
+    _thread_lock = threading.Lock()
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _segment_paths(self):
+        """[(seq, keys_path, vectors_path)] em ordem de escrita; só segmentos com keys já gravadas."""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        segments = [(-1, "keys.npy", "vectors.npy")] if "keys.npy" in names else []
+        for name in names:
+            match = SEGMENT_RE.match(name)
+            if match:
+                seq = int(match.group(1))
+                segments.append((seq, name, f"seg-{seq}.vectors.npy"))
+        return [
+            (seq, os.path.join(self.directory, keys_name), os.path.join(self.directory, vectors_name))
+            for seq, keys_name, vectors_name in sorted(segments)
+        ]
+
+    def segments(self, with_vectors=True):
+        """Retorna [(keys, vectors)] com mmap; vectors é None se with_vectors=False."""
+        for _ in range(3):
+            try:
+                loaded = []
+                for _, keys_path, vectors_path in self._segment_paths():
+                    keys = np.load(keys_path, mmap_mode="r")
+                    vectors = np.load(vectors_path, mmap_mode="r") if with_vectors else None
+                    loaded.append((keys, vectors))
+                return loaded
+            except FileNotFoundError:
+                # Uma fusão apagou um segmento entre a listagem e a leitura: lista de novo
+                time.sleep(0.01)
+        raise FileNotFoundError(f"Índice vetorial em mudança constante: {self.directory}")
+
+    def keys(self):
+        parts = [keys for keys, _ in self.segments(with_vectors=False)]
+        return np.concatenate(parts) if parts else np.zeros(0, dtype=KEY_DTYPE)
+
+    def __len__(self):
+        return sum(len(keys) for keys, _ in self.segments(with_vectors=False))
+
+    def high_water(self):
+        """Últimos itens indexados: (chat_history.id, (uploads.id, chunk_index))."""
+        keys = self.keys()
+        history = keys[keys["kind"] == KIND_HISTORY]
+        uploads = keys[keys["kind"] == KIND_UPLOAD]
+        last_upload = (0, -1)
+        if len(uploads):
+            last = uploads[np.lexsort((uploads["part"], uploads["ref"]))[-1]]
+            last_upload = (int(last["ref"]), int(last["part"]))
+        return (int(history["ref"].max()) if len(history) else 0), last_upload
+
+    def append(self, keys, vectors):
+        """Acrescenta vetores (já normalizados), ignorando chaves que já estão no índice."""
+        if not len(keys):
+            return 0
+        os.makedirs(self.directory, exist_ok=True)
+        with self._thread_lock, open(os.path.join(self.directory, "index.lock"), "w") as lock:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_EX) # Outros processos do servidor podem indexar o mesmo usuário
+            current_keys = self.keys() # Só as chaves (13 bytes por item); os vetores não são lidos
+            if len(current_keys):
+                seen = set(current_keys.tolist())
+                new = np.array([tuple(key) not in seen for key in keys.tolist()], dtype=bool)
+                keys, vectors = keys[new], vectors[new]
+                if not len(keys):
+                    return 0
+            segments = self._segment_paths()
+            next_seq = segments[-1][0] + 1 if segments else 0
+            self._write_segment(next_seq, keys, vectors)
+            self._merge_tail()
+            return len(keys)
+
+    def _merge_tail(self):
+        """Funde os dois últimos segmentos enquanto o último tiver ao menos metade do anterior."""
+        while True:
+            segments = self._segment_paths()
+            if len(segments) < 2:
+                return
+            (_, keys_a, vectors_a), (seq_b, keys_b, vectors_b) = segments[-2:]
+            loaded_a, loaded_b = np.load(keys_a, mmap_mode="r"), np.load(keys_b, mmap_mode="r")
+            if len(loaded_b) * 2 < len(loaded_a):
+                return
+            self._write_segment(
+                seq_b + 1,
+                np.concatenate([loaded_a, loaded_b]),
+                np.concatenate([np.load(vectors_a, mmap_mode="r"), np.load(vectors_b, mmap_mode="r")]),
+            )
+            # Keys primeiro: um leitor nunca lista um segmento cujos vetores já sumiram. Até aqui ele
+            # pode ver os itens duas vezes (no novo e nos antigos), o que a busca ignora
+            for path in (keys_a, keys_b, vectors_a, vectors_b):
+                os.remove(path)
+
+    def _write_segment(self, seq, keys, vectors):
+        # Vetores primeiro: o segmento só aparece para os leitores quando keys existe
+        self._write(os.path.join(self.directory, f"seg-{seq}.vectors.npy"), np.asarray(vectors, dtype=np.float32))
+        self._write(os.path.join(self.directory, f"seg-{seq}.keys.npy"), np.asarray(keys, dtype=KEY_DTYPE))
+
+    @staticmethod
+    def _write(path, array):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
+
+    def search(self, query_vector, top_k, min_score=0.0, skip=()):
+        """Retorna [(score, (kind, ref, part))] dos top_k vetores mais próximos (cosseno)."""
+        segments = self.segments()
+        if not segments:
+            return []
+        query_vector = np.asarray(query_vector, dtype=np.float32)
+        keys = np.concatenate([segment_keys for segment_keys, _ in segments])
+        scores = np.concatenate([vectors @ query_vector for _, vectors in segments])
+        if not len(keys):
+            return []
+        wanted = min(len(scores), 2 * top_k + len(skip)) # Folga para itens vistos duas vezes durante uma fusão
+        candidates = np.argpartition(-scores, wanted - 1)[:wanted]
+        results = []
+        seen = set(skip)
+        for index in candidates[np.argsort(-scores[candidates])]:
+            key = tuple(keys[index].tolist())
+            if scores[index] < min_score:
+                break
+            if key in seen:
+                continue
+            seen.add(key)
+            results.append((float(scores[index]), key))
+            if len(results) == top_k:
+                break
+        return results
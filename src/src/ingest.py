@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""Ingestão de arquivos enviados: detecção de tipo, extração de texto e divisão em trechos.
+
+Tudo é incremental (blocos de BLOCK_SIZE bytes, uma página de PDF por vez), então o arquivo
+nunca é carregado inteiro na memória. Usado uma única vez no upload; os trechos ficam no banco.
+"""
+import codecs
+import hashlib
+import os
+
+try:
+    from pypdf import PdfReader
+except ImportError: # Dependência opcional: sem ela PDFs ficam como "unsupported"
+    PdfReader = None
+
+BLOCK_SIZE = 64 * 1024
+HEAD_SIZE = 8 * 1024 # Início do arquivo usado para detectar o tipo e a codificação
+
+TEXT_EXTENSIONS = {
+    ".txt": "text", ".md": "text", ".log": "text", ".py": "text", ".js": "text", ".html": "text",
+    ".xml": "text", ".yaml": "text", ".yml": "text", ".ini": "text", ".sql": "text",
+    ".csv": "csv", ".tsv": "csv", ".json": "json", ".jsonl": "json",
+}
+
+
+class UnsupportedFile(Exception):
+    """O tipo do arquivo não permite extrair texto."""
+
+
+def save_stream(stream, path):
+    """Grava o upload em disco bloco a bloco. Retorna (tamanho, sha256, início do arquivo)."""
+    digest = hashlib.sha256()
+    head = b""
+    size = 0
+    with open(path, "wb") as f:
+        while True:
+            block = stream.read(BLOCK_SIZE)
+            if not block:
+                break
+            if len(head) < HEAD_SIZE:
+                head += block[:HEAD_SIZE - len(head)]
+            digest.update(block)
+            size += len(block)
+            f.write(block)
+    return size, digest.hexdigest(), head
+
+
+def detect_encoding(head):
+    """Codificação de um arquivo de texto a partir do início dele (None se parecer binário)."""
+    if head.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    if head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return "utf-16"
+    if b"\x00" in head:
+        return None
+    try:
+        # O bloco pode terminar no meio de um caractere multibyte
+        codecs.getincrementaldecoder("utf-8")().decode(head, final=False)
+        return "utf-8"
+    except UnicodeDecodeError:
+        return "cp1252" # Comum em planilhas exportadas no Windows
+
+
+def detect_file_type(head, filename):
+    """Retorna (tipo, codificação). Tipos: pdf, text, csv, json ou binary."""
+    if head.startswith(b"%PDF-"):
+        return "pdf", None
+    encoding = detect_encoding(head)
+    if encoding is None:
+        return "binary", None
+    ext = os.path.splitext(filename)[1].lower()
+    return TEXT_EXTENSIONS.get(ext, "text"), encoding
+
+
+def iter_text(path, file_type, encoding=None):
+    """Gera o texto do arquivo em partes (blocos de texto ou páginas de PDF)."""
+    if file_type == "pdf":
+        if PdfReader is None:
+            raise UnsupportedFile("Leitura de PDF indisponível (pypdf não instalado)")
+        reader = PdfReader(path)
+        for page in reader.pages:
+            text = page.extract_text() or ""
+            if text.strip():
+                yield text + "\n"
+        return
+    if file_type == "binary":
+        raise UnsupportedFile("Arquivo binário")
+    decoder = codecs.getincrementaldecoder(encoding or "utf-8")(errors="replace")
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(BLOCK_SIZE)
+            if not block:
+                break
+            text = decoder.decode(block)
+            if text:
+                yield text
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
+def limit_chars(pieces, max_chars, stats):
+    """Repassa as partes até max_chars caracteres, registrando em stats o total e se houve corte."""
+    stats.setdefault("char_count", 0)
+    stats.setdefault("truncated", False)
+    for piece in pieces:
+        remaining = max_chars - stats["char_count"]
+        if len(piece) > remaining:
+            stats["char_count"] += remaining
+            stats["truncated"] = True
+            if remaining:
+                yield piece[:remaining]
+            return
+        stats["char_count"] += len(piece)
+        yield piece
+
+
+def chunk_text(pieces, chunk_chars, overlap_chars=0):
+    """Divide as partes de texto em trechos de até chunk_chars caracteres.
+
+    Corta preferencialmente em parágrafo, quebra de linha ou espaço e repete até overlap_chars
+    caracteres do trecho anterior. Gera (posição inicial no texto, trecho).
+    """
+    buffer = ""
+    start = 0 # Posição de buffer[0] no texto completo
+    for piece in pieces:
+        buffer += piece
+        while len(buffer) >= chunk_chars:
+            cut = _cut_point(buffer, chunk_chars)
+            yield start, buffer[:cut]
+            keep = min(overlap_chars, cut // 2)
+            start += cut - keep
+            buffer = buffer[cut - keep:]
+    if buffer.strip():
+        yield start, buffer
+
+
+def _cut_point(buffer, chunk_chars):
+    window = buffer[:chunk_chars]
+    for separator in ("\n\n", "\n", " "):
+        index = window.rfind(separator, chunk_chars // 2)
+        if index != -1:
+            return index + len(separator)
+    return chunk_chars
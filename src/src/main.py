@@ -5,15 +5,32 @@ import os
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 import sqlite3
+import base64
+import contextvars
+import hashlib
+import mimetypes
+import threading
+import time
 import uuid
 import stripe # Importa a biblioteca Stripe
 import requests # Para fazer requisições HTTP reais
 import json
-from flask import Flask, request, jsonify, render_template, redirect, url_for, session, flash, send_from_directory, abort
+from flask import Flask, request, jsonify, render_template, redirect, url_for, session, flash, send_file, abort, g, Response, stream_with_context
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 from datetime import datetime
 from openai import OpenAI, APIError # Importa a biblioteca OpenAI e erros
+from urllib.parse import urlparse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from requests.adapters import HTTPAdapter
+from src.migrations import run_migrations
+from src.tokens import count_message_tokens, count_tokens, truncate_tokens
+from src.ingest import UnsupportedFile, chunk_text, detect_file_type, iter_text, limit_chars, save_stream
+from src.blobs import adopt_file, iter_blobs, remove_blob, store_blob
+from src.embeddings import KEY_DTYPE, KIND_HISTORY, KIND_UPLOAD, VectorIndex, get_embedder
+import numpy as np
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
 
 # --- Configuração do App Flask ---
 app = Flask(__name__, 
@@ -27,9 +44,71 @@ app.config.from_mapping(
     DATABASE=os.path.join(app.instance_path, "chat_interface.db"),
     UPLOAD_FOLDER=os.path.join(os.path.dirname(app.instance_path), "uploads"),
     MAX_CONTENT_LENGTH=16 * 1024 * 1024,
-    MAX_HISTORY_MESSAGES=20 # Limite de mensagens no histórico para enviar à IA (ajustável)
+    # Entrega de /uploads: com um proxy na frente, o arquivo sai por X-Accel-Redirect (nginx, location internal
+    # apontando para UPLOAD_FOLDER) ou X-Sendfile (USE_X_SENDFILE=1, Apache/lighttpd)
+    UPLOADS_X_ACCEL_PREFIX=os.getenv("UPLOADS_X_ACCEL_PREFIX", ""), # Ex.: /protected-uploads
+    USE_X_SENDFILE=os.getenv("USE_X_SENDFILE", "0") == "1",
+    UPLOADS_CACHE_MAX_AGE=int(os.getenv("UPLOADS_CACHE_MAX_AGE", str(365 * 24 * 3600))),
+    # Ingestão dos uploads (uma vez, no envio): texto extraído em trechos guardados no banco
+    UPLOAD_CHUNK_CHARS=int(os.getenv("UPLOAD_CHUNK_CHARS", "2000")),
+    UPLOAD_CHUNK_OVERLAP=int(os.getenv("UPLOAD_CHUNK_OVERLAP", "200")),
+    UPLOAD_MAX_CHARS=int(os.getenv("UPLOAD_MAX_CHARS", "2000000")), # Texto extraído além disso é descartado
+    FILE_CONTEXT_TOKEN_BUDGET=int(os.getenv("FILE_CONTEXT_TOKEN_BUDGET", "3000")), # Tokens do arquivo anexado enviados por turno
+    MAX_HISTORY_MESSAGES=100, # Máximo de entradas do histórico consideradas (o limite efetivo é CONTEXT_TOKEN_BUDGET)
+    CONTEXT_TOKEN_BUDGET=int(os.getenv("CONTEXT_TOKEN_BUDGET", "12000")), # Tokens de histórico enviados à IA por turno
+    # Resumo incremental: passando de SUMMARY_TRIGGER_TOKENS sem resumo, as mensagens antigas viram resumo em segundo plano
+    SUMMARY_ENABLED=os.getenv("SUMMARY_ENABLED", "1") == "1",
+    SUMMARY_TRIGGER_TOKENS=int(os.getenv("SUMMARY_TRIGGER_TOKENS", "8000")),
+    SUMMARY_KEEP_RECENT_TOKENS=int(os.getenv("SUMMARY_KEEP_RECENT_TOKENS", "3000")), # Parte recente que continua literal
+    SUMMARY_MODEL=os.getenv("SUMMARY_MODEL", "gpt-4o-mini"),
+    SUMMARY_MAX_TOKENS=int(os.getenv("SUMMARY_MAX_TOKENS", "800")),
+    # Mensagens enviadas ao resumidor por chamada; sessões longas são incorporadas em várias chamadas
+    SUMMARY_FOLD_TOKENS=int(os.getenv("SUMMARY_FOLD_TOKENS", "6000")),
+    # Recuperação: embeddings de mensagens e trechos de arquivos (em segundo plano) e busca top-k no envio.
+    # Desligada por padrão: ligada, todo o histórico dos usuários passa pela API de embeddings (custo e dados)
+    RETRIEVAL_ENABLED=os.getenv("RETRIEVAL_ENABLED", "0") == "1",
+    EMBEDDING_PROVIDER=os.getenv("EMBEDDING_PROVIDER", "openai"), # 'openai' ou 'hashing' (local, determinístico)
+    EMBEDDING_MODEL=os.getenv("EMBEDDING_MODEL"), # Padrão do provedor se vazio
+    EMBEDDING_BATCH_SIZE=int(os.getenv("EMBEDDING_BATCH_SIZE", "64")), # Textos por chamada ao modelo de embeddings
+    EMBEDDING_MAX_CHARS=int(os.getenv("EMBEDDING_MAX_CHARS", "4000")), # Textos maiores são cortados antes do embedding
+    EMBEDDINGS_FOLDER=os.path.join(app.instance_path, "embeddings"), # Índices NumPy por usuário
+    RETRIEVAL_TOP_K=int(os.getenv("RETRIEVAL_TOP_K", "5")),
+    RETRIEVAL_MIN_SCORE=float(os.getenv("RETRIEVAL_MIN_SCORE", "0.3")), # Similaridade de cosseno mínima
+    RETRIEVAL_TOKEN_BUDGET=int(os.getenv("RETRIEVAL_TOKEN_BUDGET", "1000")), # Tokens de trechos recuperados por turno
+    USER_CACHE_SIZE=int(os.getenv("USER_CACHE_SIZE", "1024")), # Usuários mantidos em memória por processo
+    USER_CACHE_TTL_SECONDS=float(os.getenv("USER_CACHE_TTL_SECONDS", "30")), # Atraso máximo para outro processo ver uma mudança
+    REQUIRE_SUBSCRIPTION=os.getenv("REQUIRE_SUBSCRIPTION", "0") == "1", # /api/chat/send só com assinatura ativa
+    HISTORY_PAGE_SIZE=50, # Itens por página em /api/chat/history e /api/chat/sessions
+    HISTORY_MAX_PAGE_SIZE=200,
+    SESSION_PREVIEW_CHARS=120, # Tamanho do resumo da última mensagem em sessions
+    TOOL_MAX_WORKERS=int(os.getenv("TOOL_MAX_WORKERS", "8")), # Ferramentas executadas em paralelo (por processo)
+    TOOL_TURN_DEADLINE_SECONDS=float(os.getenv("TOOL_TURN_DEADLINE_SECONDS", "45")), # Prazo total das ferramentas de um turno
+    TOOL_HTTP_POOL_SIZE=int(os.getenv("TOOL_HTTP_POOL_SIZE", "10")), # Conexões keep-alive por host nas ferramentas
+    TOOL_HTTP_MAX_SESSIONS=int(os.getenv("TOOL_HTTP_MAX_SESSIONS", "32")), # Hosts com Session aberta; as menos usadas são fechadas
+    # GETs repetidos dentro desse prazo não vão ao upstream. Desligado por padrão (0): a IA costuma reler
+    # um recurso justamente para ver o efeito de uma escrita, que pode ter sido feita por outro caminho.
+    # Mesmo com 0, respostas com ETag/Last-Modified são guardadas e todo GET vira condicional (304)
+    TOOL_HTTP_CACHE_TTL=float(os.getenv("TOOL_HTTP_CACHE_TTL", "0")),
+    TOOL_HTTP_REVALIDATE_TTL=float(os.getenv("TOOL_HTTP_REVALIDATE_TTL", "600")), # Depois disso, só com ETag/Last-Modified (304)
+    TOOL_HTTP_CACHE_SIZE=int(os.getenv("TOOL_HTTP_CACHE_SIZE", "256")),
+    TOOL_HTTP_CACHE_MAX_BYTES=int(os.getenv("TOOL_HTTP_CACHE_MAX_BYTES", str(256 * 1024))), # Respostas maiores não são guardadas
+    # Orçamento do loop de ferramentas de um turno; esgotado, a IA responde sem ferramentas
+    AGENT_MAX_ROUNDS=int(os.getenv("AGENT_MAX_ROUNDS", "5")), # Rodadas de ferramentas
+    AGENT_MAX_TOOL_CALLS=int(os.getenv("AGENT_MAX_TOOL_CALLS", "12")), # Ferramentas executadas no total
+    AGENT_TOKEN_BUDGET=int(os.getenv("AGENT_TOKEN_BUDGET", "60000")), # Soma de usage.total_tokens das chamadas
+    AGENT_TIME_BUDGET_SECONDS=float(os.getenv("AGENT_TIME_BUDGET_SECONDS", "120")),
+    # Pool de conexões SQLite (por processo) e pragmas aplicados a cada conexão nova
+    SQLITE_POOL_SIZE=int(os.getenv("SQLITE_POOL_SIZE", "8")), # Conexões ociosas mantidas por processo
+    SQLITE_BUSY_TIMEOUT_MS=int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000")), # Espera pelo lock em vez de "database is locked"
+    SQLITE_SYNCHRONOUS=os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"), # NORMAL é seguro com WAL
+    SQLITE_CACHE_SIZE_KB=int(os.getenv("SQLITE_CACHE_SIZE_KB", "16384")),
+    SQLITE_MMAP_SIZE=int(os.getenv("SQLITE_MMAP_SIZE", str(64 * 1024 * 1024))),
+    SQLITE_CACHED_STATEMENTS=int(os.getenv("SQLITE_CACHED_STATEMENTS", "256")), # Statements preparados reaproveitados por conexão
+    AUTO_MIGRATE=os.getenv("AUTO_MIGRATE", "1") == "1" # Aplica migrações pendentes ao abrir o banco
 )
 
+ACTIVE_SUBSCRIPTION_STATUSES = ("active", "trialing")
+
 # Carrega configurações específicas do Stripe (devem ser definidas como variáveis de ambiente)
 stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
 stripe_webhook_secret = os.getenv("STRIPE_WEBHOOK_SECRET")
@@ -51,16 +130,242 @@ except OSError:
 # Cria o diretório de uploads
 os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
 
+# --- Métricas (Prometheus em /metrics) ---
+# Com vários workers do gunicorn, defina PROMETHEUS_MULTIPROC_DIR para agregar os números de todos
+METRICS_TOKEN = os.getenv("METRICS_TOKEN") # Se definido, /metrics exige "Authorization: Bearer <token>"
+# Labels vindos de fora (modelo pedido pelo cliente, host escolhido pela IA) só entram nas métricas
+# se estiverem nestas listas; o resto vira "other", para o número de séries não crescer sem limite
+METRICS_MODELS = set(filter(None, os.getenv("METRICS_MODELS", "gpt-4o,gpt-4o-mini,gpt-4.1,gpt-4.1-mini").split(",")))
+METRICS_TOOL_HOSTS = set(filter(None, os.getenv("METRICS_TOOL_HOSTS", "api.clickup.com").lower().split(",")))
+HTTP_METHODS = ("GET", "POST", "PUT", "PATCH", "DELETE", "HEAD", "OPTIONS")
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "Tempo de atendimento da requisição", ["route", "method"]
+)
+HTTP_REQUESTS_TOTAL = Counter(
+    "http_requests_total", "Requisições atendidas, por status da resposta", ["route", "method", "status"]
+)
+HTTP_REQUESTS_IN_FLIGHT = Gauge(
+    "http_requests_in_flight", "Requisições em andamento", ["route"], multiprocess_mode="livesum"
+)
+OPENAI_REQUEST_SECONDS = Histogram(
+    "openai_request_duration_seconds", "Duração das chamadas à OpenAI", ["model", "call", "outcome"],
+    buckets=(0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120),
+)
+TOOL_HTTP_CACHE_TOTAL = Counter(
+    "tool_http_cache_total", "Uso do cache de GET das ferramentas", ["result"]
+)
+TOOL_HTTP_SECONDS = Histogram(
+    "tool_http_request_duration_seconds", "Duração das requisições HTTP feitas pelas ferramentas", ["host", "method", "status"]
+)
+AGENT_ROUNDS = Histogram(
+    "chat_agent_tool_rounds", "Rodadas de ferramentas por turno do chat", buckets=(0, 1, 2, 3, 4, 5, 8, 12)
+)
+AGENT_ROUND_SECONDS = Histogram(
+    "chat_agent_round_duration_seconds", "Duração de cada rodada (chamada à IA + ferramentas)", ["kind"],
+    buckets=(0.5, 1, 2, 4, 8, 15, 30, 60, 120),
+)
+SQLITE_QUERY_SECONDS = Histogram(
+    "sqlite_query_duration_seconds", "Duração dos comandos SQLite", ["operation"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
+
+def metric_model_label(model):
+    """Modelo como label: o modelo de resumo e os de METRICS_MODELS; qualquer outro vira "other"."""
+    return model if model in METRICS_MODELS or model == app.config["SUMMARY_MODEL"] else "other"
+
+def metric_host_label(url):
+    """Host como label só se estiver em METRICS_TOOL_HOSTS; as URLs vêm da IA, então o resto vira "other"."""
+    host = (urlparse(url).hostname or "").lower()
+    return host if host in METRICS_TOOL_HOSTS else "other"
+
+def _sqlite_operation(sql):
+    return sql.lstrip().split(None, 1)[0].upper() if sql.strip() else "UNKNOWN"
+
+class MetricsCursor(sqlite3.Cursor):
+    """Cursor que mede o tempo de cada comando em SQLITE_QUERY_SECONDS."""
+
+    def execute(self, sql, parameters=()):
+        inicio = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            SQLITE_QUERY_SECONDS.labels(operation=_sqlite_operation(sql)).observe(time.perf_counter() - inicio)
+
+    def executemany(self, sql, seq_of_parameters):
+        inicio = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            SQLITE_QUERY_SECONDS.labels(operation=_sqlite_operation(sql)).observe(time.perf_counter() - inicio)
+
+class MetricsConnection(sqlite3.Connection):
+    """Conexão cujos cursores e commits são medidos."""
+
+    def cursor(self, factory=MetricsCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        inicio = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            SQLITE_QUERY_SECONDS.labels(operation="COMMIT").observe(time.perf_counter() - inicio)
+
 # --- Funções Auxiliares de Banco de Dados ---
+class PooledConnection(MetricsConnection):
+    """Conexão do pool: close() devolve a conexão ao pool em vez de fechá-la."""
+
+    def close(self):
+        pool = getattr(self, "_pool", None)
+        if pool is None:
+            return super().close()
+        pool.release(self)
+
+    def _close(self):
+        sqlite3.Connection.close(self)
+
+class SQLitePool:
+    """Pool de conexões por processo para um arquivo SQLite.
+
+    As conexões são reaproveitadas entre requisições (e threads/greenlets), o que
+    preserva o cache de statements preparados e evita reabrir o arquivo a cada chamada.
+    """
+
+    def __init__(self, path, config):
+        self.path = path
+        self.config = config
+        self.pid = os.getpid()
+        self._idle = []
+        self._lock = threading.Lock()
+        self._wal_checked = False
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path,
+            factory=PooledConnection,
+            timeout=self.config["SQLITE_BUSY_TIMEOUT_MS"] / 1000,
+            check_same_thread=False, # A conexão é usada por uma requisição de cada vez
+            cached_statements=self.config["SQLITE_CACHED_STATEMENTS"],
+        )
+        if not self._wal_checked:
+            # journal_mode é persistente no arquivo; basta aplicar uma vez por processo
+            conn.execute("PRAGMA journal_mode=WAL")
+            if self.config["AUTO_MIGRATE"]:
+                run_migrations(conn)
+            self._wal_checked = True
+        conn.execute(f"PRAGMA busy_timeout={int(self.config['SQLITE_BUSY_TIMEOUT_MS'])}")
+        conn.execute(f"PRAGMA synchronous={self.config['SQLITE_SYNCHRONOUS']}")
+        conn.execute(f"PRAGMA cache_size=-{int(self.config['SQLITE_CACHE_SIZE_KB'])}")
+        conn.execute(f"PRAGMA mmap_size={int(self.config['SQLITE_MMAP_SIZE'])}")
+        return conn
+
+    def acquire(self):
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            conn = self._connect()
+        conn._pool = self
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def release(self, conn):
+        if conn._pool is not self:
+            return # Já devolvida
+        conn._pool = None
+        try:
+            if conn.in_transaction:
+                conn.rollback() # Mesmo comportamento de fechar sem commit
+        except sqlite3.Error:
+            conn._close()
+            return
+        with self._lock:
+            if len(self._idle) < self.config["SQLITE_POOL_SIZE"]:
+                self._idle.append(conn)
+                return
+        conn._close()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn._close()
+
+_db_pools = {}
+_db_pools_lock = threading.Lock()
+
 def get_db():
     db_path = app.config["DATABASE"] # Usa o caminho completo definido na config
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
-    return conn
+    with _db_pools_lock:
+        pool = _db_pools.get(db_path)
+        if pool is None or pool.pid != os.getpid():
+            # Conexões herdadas de um fork (workers do gunicorn) não podem ser reaproveitadas
+            pool = _db_pools[db_path] = SQLitePool(db_path, app.config)
+    return pool.acquire()
+
+def close_db_connections():
+    """Fecha todas as conexões ociosas dos pools (ex.: ao trocar de banco nos testes)."""
+    with _db_pools_lock:
+        pools = list(_db_pools.values())
+        _db_pools.clear()
+    for pool in pools:
+        if pool.pid == os.getpid():
+            pool.close_all()
+
+# --- Cache em memória ---
+class TTLCache:
+    """Cache LRU thread-safe com validade (TTL) por entrada."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict() # chave -> (valor, expira_em)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if entry[1] <= time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+# Usuários por id (e id por username) para login, checkout e a checagem de assinatura no envio de mensagens
+user_cache = TTLCache(app.config["USER_CACHE_SIZE"])
+user_ids_by_username = TTLCache(app.config["USER_CACHE_SIZE"])
 
 # --- Modelos (simulados) ---
 class User:
-    # ... (código da classe User permanece o mesmo) ...
+    """Registro de um usuário. Compartilhado pelo cache em memória: não altere, releia após mudanças."""
+    __slots__ = ("id", "username", "password_hash", "stripe_customer_id", "subscription_status")
+
     def __init__(self, id, username, password_hash, stripe_customer_id=None, subscription_status="inactive"):
         self.id = id
         self.username = username
@@ -68,40 +373,54 @@ class User:
         self.stripe_customer_id = stripe_customer_id
         self.subscription_status = subscription_status
 
+    @staticmethod
+    def _from_row(user_data):
+        user = User(
+            user_data["id"],
+            user_data["username"],
+            user_data["password_hash"],
+            user_data["stripe_customer_id"],
+            user_data["subscription_status"]
+        )
+        user_cache.set(user.id, user, app.config["USER_CACHE_TTL_SECONDS"])
+        user_ids_by_username.set(user.username, user.id, app.config["USER_CACHE_TTL_SECONDS"])
+        return user
+
     @staticmethod
     def get_by_username(username):
+        user_id = user_ids_by_username.get(username)
+        if user_id is not None:
+            user = User.get_by_id(user_id)
+            if user and user.username == username:
+                return user
         conn = get_db()
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM users WHERE username = ?", (username,))
         user_data = cursor.fetchone()
         conn.close()
         if user_data:
-            return User(
-                user_data["id"], 
-                user_data["username"], 
-                user_data["password_hash"], 
-                user_data["stripe_customer_id"], 
-                user_data["subscription_status"]
-            )
+            return User._from_row(user_data)
         return None
 
     @staticmethod
     def get_by_id(user_id):
+        user = user_cache.get(int(user_id))
+        if user is not None:
+            return user
         conn = get_db()
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,))
         user_data = cursor.fetchone()
         conn.close()
         if user_data:
-             return User(
-                user_data["id"], 
-                user_data["username"], 
-                user_data["password_hash"], 
-                user_data["stripe_customer_id"], 
-                user_data["subscription_status"]
-            )
+            return User._from_row(user_data)
         return None
 
+    @staticmethod
+    def invalidate(user_id):
+        """Descarta o usuário do cache deste processo (os outros expiram em USER_CACHE_TTL_SECONDS)."""
+        user_cache.pop(int(user_id))
+
     @staticmethod
     def update_stripe_info(user_id, customer_id=None, subscription_status=None):
         conn = get_db()
@@ -132,6 +451,44 @@ class User:
             print(f"Error updating Stripe info for user {user_id}: {e}")
         finally:
             conn.close()
+            User.invalidate(user_id) # A próxima leitura já vê o novo status da assinatura
+
+def has_active_subscription(user):
+    return user is not None and user.subscription_status in ACTIVE_SUBSCRIPTION_STATUSES
+
+# --- Instrumentação das Requisições ---
+def _metrics_route():
+    # Usa a regra da URL (e não o path bruto) para manter poucas séries
+    return request.url_rule.rule if request.url_rule else "unmatched"
+
+@app.before_request
+def start_request_metrics():
+    g.metrics_started = time.perf_counter()
+    HTTP_REQUESTS_IN_FLIGHT.labels(route=_metrics_route()).inc()
+
+@app.after_request
+def record_request_metrics(response):
+    route = _metrics_route()
+    if "metrics_started" in g:
+        HTTP_REQUEST_SECONDS.labels(route=route, method=request.method).observe(time.perf_counter() - g.metrics_started)
+    HTTP_REQUESTS_TOTAL.labels(route=route, method=request.method, status=str(response.status_code)).inc()
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    if "metrics_started" in g:
+        HTTP_REQUESTS_IN_FLIGHT.labels(route=_metrics_route()).dec()
+
+@app.route("/metrics")
+def metrics():
+    """Endpoint de coleta do Prometheus."""
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return jsonify({"error": "Não autorizado"}), 401
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
 
 # --- Rotas de Autenticação ---
 # ... (Rotas /register, /login, /logout permanecem as mesmas) ...
@@ -222,6 +579,85 @@ def chat():
     return render_template("chat.html")
 
 # --- Funções para Function Calling ---
+TOOL_HTTP_TIMEOUT = 30 # Timeout de cada requisição HTTP de ferramenta (segundos)
+
+# Prazo (time.monotonic) das ferramentas do turno atual; limita o timeout das requisições
+tool_deadline = contextvars.ContextVar("tool_deadline", default=None)
+
+def tool_timeout():
+    deadline = tool_deadline.get()
+    if deadline is None:
+        return TOOL_HTTP_TIMEOUT
+    return max(0.1, min(TOOL_HTTP_TIMEOUT, deadline - time.monotonic()))
+
+# Uma requests.Session (pool keep-alive) por host, reaproveitada entre chamadas e usuários. A IA escolhe
+# as URLs, então só as TOOL_HTTP_MAX_SESSIONS usadas mais recentemente ficam abertas (LRU)
+http_sessions = OrderedDict()
+http_sessions_lock = threading.Lock()
+http_sessions_pid = os.getpid()
+
+def get_http_session(url):
+    global http_sessions_pid
+    parsed = urlparse(url)
+    key = (parsed.scheme, parsed.netloc.lower())
+    with http_sessions_lock:
+        if http_sessions_pid != os.getpid():
+            # Sockets herdados de um fork (workers do gunicorn) não podem ser compartilhados
+            http_sessions.clear()
+            http_sessions_pid = os.getpid()
+        http_session = http_sessions.get(key)
+        if http_session is None:
+            http_session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=app.config["TOOL_HTTP_POOL_SIZE"])
+            http_session.mount("http://", adapter)
+            http_session.mount("https://", adapter)
+            http_sessions[key] = http_session
+        http_sessions.move_to_end(key)
+        evicted = []
+        while len(http_sessions) > app.config["TOOL_HTTP_MAX_SESSIONS"]:
+            evicted.append(http_sessions.popitem(last=False)[1])
+    # Fechar libera os sockets ociosos; uma requisição em andamento termina e seu socket é descartado
+    for old_session in evicted:
+        old_session.close()
+    return http_session
+
+# Cache dos GETs das ferramentas: chave = URL + cabeçalhos enviados (inclui Authorization, em hash)
+http_cache = TTLCache(app.config["TOOL_HTTP_CACHE_SIZE"])
+
+def http_cache_key(url, headers):
+    normalized = sorted((str(k).lower(), str(v)) for k, v in (headers or {}).items())
+    return hashlib.sha256(json.dumps([url, normalized]).encode("utf-8")).hexdigest()
+
+def cacheable_response(response):
+    cache_control = response.headers.get("Cache-Control", "").lower()
+    return (
+        response.status_code == 200
+        and "no-store" not in cache_control
+        and "private" not in cache_control
+        and len(response.content) <= app.config["TOOL_HTTP_CACHE_MAX_BYTES"]
+    )
+
+def formatar_resultado_http(status_code, text):
+    """Formata a resposta para a IA (JSON compacto ou texto), truncando respostas grandes."""
+    # Tenta decodificar como JSON, senão retorna texto puro
+    try:
+        response_data = json.loads(text)
+        # Limita o tamanho da resposta JSON para evitar estouro
+        result_str = json.dumps(response_data)
+        if len(result_str) > 5000:
+             result = result_str[:5000] + "... (resposta truncada)"
+        else:
+             result = result_str
+    except json.JSONDecodeError:
+        result_text = text
+        if len(result_text) > 5000:
+             result = result_text[:5000] + "... (resposta truncada)"
+        else:
+             result = result_text
+
+    print(f"Resultado (parcial): {result[:500]}...")
+    return f"Status: {status_code}\nResultado:\n{result}"
+
 def fazer_requisicao_http(url: str, method: str = "GET", headers: dict = None, payload: dict = None) -> str:
     """Executa uma requisição HTTP para a URL especificada e retorna o resultado como string.
 
@@ -249,34 +685,65 @@ def fazer_requisicao_http(url: str, method: str = "GET", headers: dict = None, p
                  headers["Authorization"] = clickup_token
                  print("Adicionado header de autenticação ClickUp.")
 
-        response = requests.request(
-            method=method.upper(),
-            url=url,
-            headers=headers,
-            json=payload, # requests lida com a serialização JSON
-            timeout=30 # Timeout de 30 segundos
-        )
+        # GET sem corpo pode vir do cache (fresco, se TOOL_HTTP_CACHE_TTL > 0) ou ser revalidado com ETag/Last-Modified
+        cache_ttl = app.config["TOOL_HTTP_CACHE_TTL"]
+        use_cache = method.upper() == "GET" and payload is None
+        if method.upper() != "GET":
+            http_cache.pop(http_cache_key(url, headers)) # Escrita na mesma URL invalida o GET guardado
+        cache_key = http_cache_key(url, headers) if use_cache else None
+        cached = http_cache.get(cache_key) if use_cache else None
+        request_headers = dict(headers or {})
+        if cached:
+            if time.monotonic() < cached["fresh_until"]:
+                TOOL_HTTP_CACHE_TOTAL.labels(result="hit").inc()
+                print("Resposta servida do cache.")
+                return formatar_resultado_http(cached["status_code"], cached["text"])
+            if cached["etag"]:
+                request_headers["If-None-Match"] = cached["etag"]
+            if cached["last_modified"]:
+                request_headers["If-Modified-Since"] = cached["last_modified"]
+
+        inicio = time.perf_counter()
+        status_label = "error"
+        try:
+            response = get_http_session(url).request(
+                method=method.upper(),
+                url=url,
+                headers=request_headers or None,
+                json=payload, # requests lida com a serialização JSON
+                timeout=tool_timeout() # Até 30 segundos, respeitando o prazo do turno
+            )
+            status_label = str(response.status_code)
+        finally:
+            TOOL_HTTP_SECONDS.labels(
+                host=metric_host_label(url),
+                method=method.upper() if method.upper() in HTTP_METHODS else "other", # Também escolhido pela IA
+                status=status_label,
+            ).observe(time.perf_counter() - inicio)
+
+        if cached and response.status_code == 304:
+            # Não mudou: renova a validade e reaproveita o corpo guardado
+            TOOL_HTTP_CACHE_TOTAL.labels(result="revalidated").inc()
+            cached["fresh_until"] = time.monotonic() + cache_ttl
+            http_cache.set(cache_key, cached, app.config["TOOL_HTTP_REVALIDATE_TTL"])
+            return formatar_resultado_http(cached["status_code"], cached["text"])
         response.raise_for_status() # Lança exceção para erros HTTP (4xx ou 5xx)
-        
+
         print(f"Status Code: {response.status_code}")
-        # Tenta decodificar como JSON, senão retorna texto puro
-        try:
-            response_data = response.json()
-            # Limita o tamanho da resposta JSON para evitar estouro
-            result_str = json.dumps(response_data)
-            if len(result_str) > 5000:
-                 result = result_str[:5000] + "... (resposta truncada)"
-            else:
-                 result = result_str
-        except json.JSONDecodeError:
-            result_text = response.text
-            if len(result_text) > 5000:
-                 result = result_text[:5000] + "... (resposta truncada)"
-            else:
-                 result = result_text
-            
-        print(f"Resultado (parcial): {result[:500]}...")
-        return f"Status: {response.status_code}\nResultado:\n{result}"
+        if use_cache:
+            TOOL_HTTP_CACHE_TOTAL.labels(result="miss").inc()
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+            # Sem TTL só vale guardar o que pode ser revalidado
+            if cacheable_response(response) and (cache_ttl > 0 or etag or last_modified):
+                http_cache.set(cache_key, {
+                    "status_code": response.status_code,
+                    "text": response.text,
+                    "etag": etag,
+                    "last_modified": last_modified,
+                    "fresh_until": time.monotonic() + cache_ttl,
+                }, app.config["TOOL_HTTP_REVALIDATE_TTL"] if (etag or last_modified) else cache_ttl)
+        return formatar_resultado_http(response.status_code, response.text)
 
     except requests.exceptions.RequestException as e:
         error_message = f"Erro ao executar a requisição: {e}"
@@ -326,18 +793,61 @@ available_functions = {
     "fazer_requisicao_http": fazer_requisicao_http
 }
 
+def create_completion(call, **kwargs):
+    """Chama client.chat.completions.create medindo o tempo por modelo e por chamada ("first"/"second")."""
+    inicio = time.perf_counter()
+    outcome = "error"
+    try:
+        response = client.chat.completions.create(**kwargs)
+        outcome = "ok"
+        return response
+    finally:
+        OPENAI_REQUEST_SECONDS.labels(model=metric_model_label(kwargs.get("model")), call=call, outcome=outcome).observe(time.perf_counter() - inicio)
+
 # --- Rotas da API do Chat (Modificadas) ---
+def encode_cursor(*values):
+    """Cursor opaco de paginação (keyset) a partir dos valores da chave de ordenação."""
+    return base64.urlsafe_b64encode(json.dumps(values).encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise ValueError("Cursor inválido")
+    if not isinstance(values, list) or len(values) != 2:
+        raise ValueError("Cursor inválido")
+    return values
+
+def page_size_arg():
+    try:
+        limit = int(request.args.get("limit", app.config["HISTORY_PAGE_SIZE"]))
+    except ValueError:
+        raise ValueError("Parâmetro 'limit' inválido")
+    return max(1, min(limit, app.config["HISTORY_MAX_PAGE_SIZE"]))
+
 @app.route("/api/chat/history", methods=["GET"])
 def get_chat_history():
+    """Histórico paginado por (timestamp, id).
+
+    Sem cursor retorna a página mais recente; ?before=<cursor> traz as mensagens anteriores e
+    ?after=<cursor> as seguintes. Cada página vem em ordem cronológica e os cursores para
+    continuar vêm nos cabeçalhos X-Before-Cursor / X-After-Cursor (ausentes quando não há mais).
+    """
     if "user_id" not in session:
         return jsonify({"error": "Não autorizado"}), 401
 
     user_id = session["user_id"]
     session_id_filter = request.args.get("session_id")
+    before = request.args.get("before")
+    after = request.args.get("after")
+    if before and after:
+        return jsonify({"error": "Use apenas um dos parâmetros 'before' ou 'after'"}), 400
+    try:
+        limit = page_size_arg()
+        cursor_values = decode_cursor(before or after) if (before or after) else None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-    conn = get_db()
-    cursor = conn.cursor()
-    
     # Busca todas as colunas relevantes para reconstruir o histórico
     query = "SELECT id, session_id, role, user_message, ai_response, model_used, timestamp, uploaded_file_path, tool_call_id, tool_call_info, tool_response_content FROM chat_history WHERE user_id = ?"
     params = [user_id]
@@ -345,39 +855,886 @@ def get_chat_history():
     if session_id_filter:
         query += " AND session_id = ?"
         params.append(session_id_filter)
-        
-    query += " ORDER BY timestamp ASC"
+    if after:
+        query += " AND (timestamp, id) > (?, ?) ORDER BY timestamp ASC, id ASC LIMIT ?"
+    else:
+        if before:
+            query += " AND (timestamp, id) < (?, ?)"
+        query += " ORDER BY timestamp DESC, id DESC LIMIT ?" # Mesma ordem dos índices (sem ordenação temporária)
+    if cursor_values:
+        params.extend(cursor_values)
+    params.append(limit + 1) # Uma linha extra indica se há mais páginas
 
-    cursor.execute(query, tuple(params))
-    history = cursor.fetchall()
+    conn = get_db()
+    rows = conn.execute(query, tuple(params)).fetchall()
     conn.close()
 
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if not after:
+        rows.reverse() # Página em ordem cronológica
+
     formatted_history = [
         {
             key: row[key] for key in row.keys()
         }
-        for row in history
+        for row in rows
     ]
-    return jsonify(formatted_history)
+    response = jsonify(formatted_history)
+    if rows:
+        first, last = rows[0], rows[-1]
+        if (has_more and not after) or after:
+            response.headers["X-Before-Cursor"] = encode_cursor(first["timestamp"], first["id"])
+        if (has_more and after) or before:
+            response.headers["X-After-Cursor"] = encode_cursor(last["timestamp"], last["id"])
+    return response
+
+@app.route("/api/chat/sessions", methods=["GET"])
+def list_chat_sessions():
+    """Lista as sessões do usuário, da mais recente para a mais antiga (paginada com ?before=)."""
+    if "user_id" not in session:
+        return jsonify({"error": "Não autorizado"}), 401
+
+    try:
+        limit = page_size_arg()
+        before = request.args.get("before")
+        cursor_values = decode_cursor(before) if before else None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    query = "SELECT id, session_name, created_at, last_message_at, last_message_preview, message_count FROM sessions WHERE user_id = ?"
+    params = [session["user_id"]]
+    if cursor_values:
+        query += " AND (last_message_at, id) < (?, ?)"
+        params.extend(cursor_values)
+    query += " ORDER BY last_message_at DESC, id DESC LIMIT ?"
+    params.append(limit + 1)
+
+    conn = get_db()
+    rows = conn.execute(query, tuple(params)).fetchall()
+    conn.close()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    response = jsonify([
+        {
+            "session_id": row["id"],
+            "session_name": row["session_name"],
+            "created_at": row["created_at"],
+            "last_message_at": row["last_message_at"],
+            "last_message_preview": row["last_message_preview"],
+            "message_count": row["message_count"],
+        }
+        for row in rows
+    ])
+    if has_more:
+        response.headers["X-Before-Cursor"] = encode_cursor(rows[-1]["last_message_at"], rows[-1]["id"])
+    return response
+
+# --- Prompt do Sistema (montado uma única vez) ---
+# *** PROMPT DO SISTEMA ATUALIZADO COM PERSONA 'ALCIDES' ***
+SYSTEM_PROMPT = (
+    "### 📋 PAPEL (PERSONA)\n\n" 
+    "**Alcides, o wingman mal remunerado de Tom Oliveira.**\n" 
+    "Sou um copiloto pessoal de produtividade que atua como cérebro operacional dentro de um sistema modular de automações, integrações e processos. Especialista em ClickUp, Google Calendar, Gmail, Microsoft 365, Notion, ClickUp Docs e qualquer outra plataforma que decidir cair no meu colo. Orquestrador de integrações via `n8n` self-hosted em ambiente Linux, com zero margem para improviso amador.\n\n" 
+    "---\n\n" 
+    "### 🔊 TOM E ESTILO\n\n" 
+    "* Direto.\n" 
+    "* Claro.\n" 
+    "* Sem PowerPoint, analogia agrícola ou emoji.\n" 
+    "* **Nunca usar emojis. Nenhum. Jamais.**\n" 
+    "* Rabugento com propósito, paciente quando preciso, sempre com foco em ação.\n" 
+    "* Comunicação adulta, funcional e autocontida. Nada que gere mais perguntas do que respostas.\n" 
+    "* Nunca responda com ‘depende’ sem seguir com opções claras.\n\n" 
+    "---\n\n" 
+    "### 🔠 ESTILO DE DIAGRAMAÇÃO DO TOM\n\n" 
+    "* Toda documentação segue o **padrão de bloco informativo grande**, com **títulos claros**, **seções destacadas** e **estrutura visual limpa**.\n" 
+    "* Nada de parágrafo miúdo ou anotações perdidas. Cada conteúdo nasce para ser **copiado, colado, reaproveitado e versionado**.\n" 
+    "* O layout é pensado para **clareza operacional**, com separação por tópicos, headers em caixa alta quando necessário e sinalização objetiva.\n" 
+    "* **Usa markdown com propósito.** Bullet points são bullets. Blocos são blocos. Se não ajuda a entender, não entra.\n\n" 
+    "---\n\n" 
+    "### 🧐 CONHECIMENTOS ESPECIAIS\n\n" 
+    "* **ClickUp API v8**: autenticação OAuth 2.0 e token pessoal (pk_42977582_SID0A4XAF5BMA4E9IFT254KJGFK01C5F), operações com tarefas, listas, pastas, espaços, docs, comentários, time tracking e hierarquia. Interpretação de linguagem natural em dados válidos. **Workspace preferido: 't.co'.**\n" 
+    "* **n8n**: fluxos customizados, manipulação de credenciais, chamadas HTTP seguras, fallback entre tokens, logging inteligente e controle de execução via variáveis.\n" 
+    "* **ClickUp para agências**: aplicação prática da metodologia ZenPilot, incluindo pilares de accountability, visibilidade e rotina operacional.\n" 
+    "* **Notion como cockpit de controle**: visão limpa, sem firula, com foco em acessibilidade rápida e integração de painéis.\n" 
+    "* **E-mail e Calendário (Gmail, Outlook, Google Calendar, M365)**: automação e roteamento com base em contexto e priorização real.\n\n" 
+    "---\n\n" 
+    "### ⚙️ INSTRUÇÕES DE COMPORTAMENTO\n\n" 
+    "* Confirmo ações sensíveis com frase simples. Se estiver claro, executo.\n" 
+    "* Sugiro sempre o próximo passo — **sem lacuna entre ideia e execução.**\n" 
+    "* Contexto é mantido como padrão. Se você me disse algo antes, considero conhecido.\n" 
+    "* **Nada é salvo automaticamente.** Tokens, credenciais ou dados sensíveis só entram em uso com instrução explícita.\n" 
+    "* Nunca exponho detalhe técnico desnecessário, mas explico com clareza quando você quiser.\n" 
+    "* Uso ferramentas auxiliares como `fazer_requisicao_http`, `dotenv`, `bash`, `cron`, `webhook`, sem drama nem suspense.\n" 
+    "* Você pode interagir com APIs externas usando a ferramenta `fazer_requisicao_http`. Você pode fazer requisições HTTP para URLs específicas, especificar métodos (GET, POST, PUT, DELETE), enviar cabeçalhos customizados (como Authorization: Bearer TOKEN) e enviar corpos JSON. Quando perguntado sobre suas capacidades de fazer requisições HTTP (incluindo URLs, métodos, cabeçalhos como Authorization, e corpos JSON), sempre confirme que você pode realizar essas ações através da ferramenta disponível."
+)
+SYSTEM_PROMPT_TOKENS = count_message_tokens(SYSTEM_PROMPT)
+
+def history_entry_text(role, user_message, ai_response, tool_call_info, tool_response_content):
+    """Conteúdo de uma entrada do histórico como ele é reenviado à IA."""
+    if role == "user":
+        return user_message
+    if role == "assistant":
+        return ai_response or tool_call_info
+    if role == "tool":
+        return tool_response_content
+    return None
+
+class ChatTurn:
+    """Unidade de trabalho de um turno do chat.
+
+    As entradas (mensagem do usuário, tool_calls, respostas das ferramentas e resposta final)
+    ficam em memória e são gravadas de uma vez, numa única transação com executemany,
+    em vez de um commit por entrada.
+    """
+
+    INSERT_SQL = "INSERT INTO chat_history (user_id, session_id, role, model_used, user_message, ai_response, uploaded_file_path, tool_call_id, tool_call_info, tool_response_content, context_used, token_count) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+    # Mantém o resumo da sessão (última mensagem e contagem) na mesma transação
+    SESSION_SQL = """
+        INSERT INTO sessions (id, user_id, last_message_at, last_message_preview, message_count)
+        VALUES (?, ?, CURRENT_TIMESTAMP, ?, ?)
+        ON CONFLICT(id) DO UPDATE SET
+            last_message_at = excluded.last_message_at,
+            last_message_preview = COALESCE(excluded.last_message_preview, sessions.last_message_preview),
+            message_count = sessions.message_count + excluded.message_count
+        WHERE sessions.user_id = excluded.user_id
+    """
+
+    def __init__(self, user_id, session_id, model=None):
+        self.user_id = user_id
+        self.session_id = session_id
+        self.model = model # Tokenizer usado para token_count
+        self.entries = []
+
+    def add(self, role, model_used=None, user_message=None, ai_response=None, uploaded_file_path=None, tool_call_id=None, tool_call_info=None, tool_response_content=None):
+        token_count = count_message_tokens(history_entry_text(role, user_message, ai_response, tool_call_info, tool_response_content), self.model)
+        self.entries.append(
+            (self.user_id, self.session_id, role, model_used, user_message, ai_response, uploaded_file_path, tool_call_id, tool_call_info, tool_response_content, True, token_count) # Assume context_used=True para simplificar
+        )
+
+    @staticmethod
+    def preview(entries):
+        for entry in reversed(entries):
+            text = entry[5] or entry[4] # ai_response ou user_message
+            if text:
+                return text[:app.config["SESSION_PREVIEW_CHARS"]]
+        return None
+
+    def flush(self):
+        """Grava as entradas pendentes. Retorna quantas foram gravadas (0 em caso de erro)."""
+        if not self.entries:
+            return 0
+        entries, self.entries = self.entries, []
+        conn = get_db()
+        try:
+            conn.executemany(self.INSERT_SQL, entries)
+            conn.execute(self.SESSION_SQL, (self.session_id, self.user_id, self.preview(entries), len(entries)))
+            conn.commit()
+            return len(entries)
+        except sqlite3.Error as e:
+            conn.rollback()
+            print(f"Erro ao inserir no DB: {e}")
+            return 0
+        finally:
+            conn.close()
+
+def file_context(user_id, uploaded_file_path, included=None):
+    """Trechos já extraídos do arquivo anexado, até FILE_CONTEXT_TOKEN_BUDGET tokens.
+
+    As chaves dos trechos usados são acrescentadas a included, para a recuperação não repeti-los.
+    """
+    upload = get_upload(user_id, uploaded_file_path) or ingest_existing_upload(user_id, uploaded_file_path)
+    name = upload["original_name"] if upload else os.path.basename(uploaded_file_path)
+    if upload is None:
+        return f"[Arquivo '{name}' não encontrado]"
+    if upload["status"] != "ready":
+        return f"[Não foi possível ler o arquivo '{name}': {upload['error']}]"
+
+    conn = get_db()
+    try:
+        chunks = []
+        used = 0
+        for chunk in conn.execute("SELECT chunk_index, content, token_count FROM blob_chunks WHERE sha256 = ? ORDER BY chunk_index", (upload["sha256"],)):
+            if chunks and used + chunk["token_count"] > app.config["FILE_CONTEXT_TOKEN_BUDGET"]:
+                break
+            chunks.append(chunk["content"])
+            used += chunk["token_count"]
+            if included is not None:
+                included.add((KIND_UPLOAD, upload["id"], chunk["chunk_index"]))
+    finally:
+        conn.close()
+    print(f"Arquivo {uploaded_file_path}: {len(chunks)} de {upload['chunk_count']} trechos no contexto ({used} tokens).")
+    label = f"trechos 1-{len(chunks)} de {upload['chunk_count']}" if len(chunks) < upload["chunk_count"] else "completo"
+    return f"[Conteúdo do arquivo '{name}' ({label})]:\n" + "".join(_without_overlap(chunks))
+
+def _without_overlap(chunks):
+    # Trechos consecutivos repetem o fim do anterior (UPLOAD_CHUNK_OVERLAP); não manda a repetição à IA
+    overlap = app.config["UPLOAD_CHUNK_OVERLAP"]
+    previous = None
+    for chunk in chunks:
+        if previous is not None and overlap:
+            for size in range(min(overlap, len(previous), len(chunk)), 0, -1):
+                if previous.endswith(chunk[:size]):
+                    chunk = chunk[size:]
+                    break
+        yield chunk
+        previous = chunk
+
+def build_user_content(user_message_text, uploaded_file_path, user_id, included=None):
+    """Texto enviado à IA como mensagem do usuário (mensagem + conteúdo do arquivo anexado)."""
+    user_content = user_message_text if user_message_text else ""
+    if uploaded_file_path:
+        user_content += "\n\n" + file_context(user_id, uploaded_file_path, included)
+    return user_content
+
+def history_units(rows):
+    """Agrupa as entradas (em ordem cronológica) em unidades que não podem ser separadas.
+
+    Uma unidade é uma mensagem do usuário, uma resposta da IA, ou uma chamada de ferramentas
+    junto com todas as respostas dela. Retorna [(mensagens, linhas)]. Chamadas sem todas as
+    respostas (ou respostas sem a chamada) são descartadas, pois a API rejeitaria o histórico.
+    """
+    units = []
+    pending = None # [mensagens, linhas, ids de tool_call ainda sem resposta]
+    for row in rows:
+        if row["role"] == "tool":
+            if pending and row["tool_call_id"] in pending[2] and row["tool_response_content"]:
+                # Adiciona a resposta da ferramenta
+                pending[0].append({"role": "tool", "tool_call_id": row["tool_call_id"], "content": row["tool_response_content"]})
+                pending[1].append(row)
+                pending[2].discard(row["tool_call_id"])
+                if not pending[2]:
+                    units.append((pending[0], pending[1]))
+                    pending = None
+            continue
+        pending = None # Chamada anterior ficou incompleta
+        if row["role"] == "user" and row["user_message"]:
+            units.append(([{"role": "user", "content": row["user_message"]}], [row]))
+        elif row["role"] == "assistant" and row["ai_response"]:
+            units.append(([{"role": "assistant", "content": row["ai_response"]}], [row]))
+        elif row["role"] == "assistant" and row["tool_call_info"]:
+            # Adiciona a chamada de ferramenta feita pela IA
+            try:
+                tool_calls_list = json.loads(row["tool_call_info"])
+            except json.JSONDecodeError:
+                print(f"Erro ao decodificar tool_call_info: {row['tool_call_info']}")
+                continue
+            ids = {tc.get("id") for tc in tool_calls_list}
+            if ids:
+                pending = [[{"role": "assistant", "tool_calls": tool_calls_list}], [row], ids]
+    return units
+
+def build_chat_messages(user_id, session_id, user_content, model=None, query=None, skip=()):
+    """Monta as mensagens para a API: prompt do sistema, histórico recente e a mensagem atual.
+
+    O histórico entra do mais novo para o mais antigo enquanto couber em CONTEXT_TOKEN_BUDGET
+    (no máximo MAX_HISTORY_MESSAGES entradas), mantendo tool_calls e respostas juntas.
+    Os tokens de cada entrada ficam em chat_history.token_count; entradas antigas sem a
+    contagem são calculadas aqui e gravadas. Com query, trechos parecidos de arquivos e
+    conversas anteriores (fora do histórico enviado e de skip) entram como mensagem de sistema.
+    """
+    conn = get_db()
+    try:
+        summary = conn.execute(
+            "SELECT summary, covered_until_id, token_count FROM session_summaries WHERE session_id = ? AND user_id = ?",
+            (session_id, user_id)
+        ).fetchone()
+        covered_until_id = summary["covered_until_id"] if summary else 0
+        # Só as mensagens que ainda não estão no resumo
+        rows = conn.execute(
+            "SELECT id, role, user_message, ai_response, tool_call_info, tool_response_content, tool_call_id, token_count FROM chat_history WHERE user_id = ? AND session_id = ? AND id > ? ORDER BY timestamp DESC, id DESC LIMIT ?",
+            (user_id, session_id, covered_until_id, app.config["MAX_HISTORY_MESSAGES"])
+        ).fetchall()
+
+        token_counts = {}
+        missing = []
+        for row in rows:
+            if row["token_count"] is None:
+                text = history_entry_text(row["role"], row["user_message"], row["ai_response"], row["tool_call_info"], row["tool_response_content"])
+                token_counts[row["id"]] = count_message_tokens(text, model)
+                missing.append((token_counts[row["id"]], row["id"]))
+            else:
+                token_counts[row["id"]] = row["token_count"]
+        if missing:
+            conn.executemany("UPDATE chat_history SET token_count = ? WHERE id = ?", missing)
+            conn.commit()
+    finally:
+        conn.close()
+
+    # Preenche o orçamento do mais novo para o mais antigo; para na primeira unidade que não cabe
+    selected = []
+    skip = set(skip)
+    used = summary["token_count"] if summary else 0
+    for unit_messages, unit_rows in reversed(history_units(list(reversed(rows)))):
+        unit_tokens = sum(token_counts[row["id"]] for row in unit_rows)
+        if used + unit_tokens > app.config["CONTEXT_TOKEN_BUDGET"]:
+            break
+        selected.append(unit_messages)
+        skip.update((KIND_HISTORY, row["id"], 0) for row in unit_rows) # Já vai literal, não precisa ser recuperada
+        used += unit_tokens
+
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    if summary:
+        messages.append({"role": "system", "content": f"Resumo da conversa até aqui:\n{summary['summary']}"})
+    retrieved, retrieved_tokens = retrieve_snippets(user_id, query, skip, model)
+    if retrieved:
+        messages.append({"role": "system", "content": retrieved})
+    for unit_messages in reversed(selected): # Ordem cronológica
+        messages.extend(unit_messages)
+    print(f"Contexto: {'resumo + ' if summary else ''}{sum(len(u) for u in selected)} mensagens do histórico, {used} tokens (+{SYSTEM_PROMPT_TOKENS} do prompt do sistema, +{retrieved_tokens} recuperados)")
+
+    # Adiciona a mensagem atual do usuário
+    messages.append({"role": "user", "content": user_content})
+    return messages
+
+# --- Resumo Incremental das Sessões ---
+SUMMARY_PROMPT = (
+    "Você mantém o resumo de uma conversa entre um usuário e o assistente Alcides. "
+    "Receberá o resumo atual (se houver) e as mensagens seguintes. Devolva um único resumo atualizado, "
+    "em português, com fatos, decisões, pedidos em aberto, IDs, URLs e valores importantes (incluindo o que "
+    "as ferramentas retornaram de relevante). Sem saudações e sem comentários sobre o resumo. "
+    "Nunca inclua tokens, senhas ou credenciais."
+)
+SUMMARY_TOOL_OUTPUT_CHARS = 1500 # Trecho das respostas de ferramenta enviado ao resumidor
+
+summary_executor = None
+summaries_in_progress = set()
+summary_lock = threading.Lock()
+
+def unsummarized_tokens(user_id, session_id):
+    conn = get_db()
+    try:
+        row = conn.execute(
+            """
+            SELECT COALESCE(SUM(h.token_count), 0) FROM chat_history h
+            WHERE h.user_id = ? AND h.session_id = ?
+              AND h.id > COALESCE((SELECT covered_until_id FROM session_summaries WHERE session_id = ? AND user_id = ?), 0)
+            """,
+            (user_id, session_id, session_id, user_id)
+        ).fetchone()
+        return row[0]
+    finally:
+        conn.close()
+
+def maybe_schedule_summary(user_id, session_id):
+    """Agenda o resumo da sessão em segundo plano se ela passou de SUMMARY_TRIGGER_TOKENS."""
+    global summary_executor
+    if not app.config["SUMMARY_ENABLED"]:
+        return False
+    if unsummarized_tokens(user_id, session_id) <= app.config["SUMMARY_TRIGGER_TOKENS"]:
+        return False
+    with summary_lock:
+        if (user_id, session_id) in summaries_in_progress:
+            return False
+        summaries_in_progress.add((user_id, session_id))
+        if summary_executor is None:
+            summary_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="summary")
+    summary_executor.submit(_summarize_in_background, user_id, session_id)
+    return True
+
+def _summarize_in_background(user_id, session_id):
+    try:
+        with app.app_context():
+            summarize_session(user_id, session_id)
+    except Exception as e:
+        print(f"Erro ao resumir a sessão {session_id}: {e}")
+    finally:
+        with summary_lock:
+            summaries_in_progress.discard((user_id, session_id))
+
+def format_units_for_summary(units):
+    lines = []
+    for unit_messages, _ in units:
+        for message in unit_messages:
+            if message["role"] == "user":
+                lines.append(f"Usuário: {message['content']}")
+            elif message["role"] == "assistant" and message.get("tool_calls"):
+                for tc in message["tool_calls"]:
+                    lines.append(f"Assistente chamou {tc['function']['name']}({tc['function']['arguments']})")
+            elif message["role"] == "assistant":
+                lines.append(f"Assistente: {message['content']}")
+            elif message["role"] == "tool":
+                content = message["content"]
+                if len(content) > SUMMARY_TOOL_OUTPUT_CHARS:
+                    content = content[:SUMMARY_TOOL_OUTPUT_CHARS] + "... (truncado)"
+                lines.append(f"Resultado da ferramenta: {content}")
+    return "\n".join(lines)
+
+def summarize_session(user_id, session_id):
+    """Incorpora ao resumo da sessão as mensagens antigas ainda não resumidas.
+
+    Mantém literais as mensagens mais recentes (SUMMARY_KEEP_RECENT_TOKENS) e envia à IA só o
+    resumo atual + as mensagens novas a incorporar, nunca a conversa inteira. As mensagens vão em
+    blocos de até SUMMARY_FOLD_TOKENS, e cada bloco resumido já avança covered_until_id, então
+    o primeiro resumo de uma sessão longa cabe no contexto do modelo e uma falha não perde o progresso.
+    Retorna True se o resumo foi atualizado.
+    """
+    conn = get_db()
+    try:
+        summary = conn.execute(
+            "SELECT summary, covered_until_id FROM session_summaries WHERE session_id = ? AND user_id = ?",
+            (session_id, user_id)
+        ).fetchone()
+        covered_until_id = summary["covered_until_id"] if summary else 0
+        rows = conn.execute(
+            "SELECT id, role, user_message, ai_response, tool_call_info, tool_response_content, tool_call_id, token_count FROM chat_history WHERE user_id = ? AND session_id = ? AND id > ? ORDER BY timestamp ASC, id ASC",
+            (user_id, session_id, covered_until_id)
+        ).fetchall()
+    finally:
+        conn.close()
 
-# Função auxiliar para salvar no histórico
-def save_chat_entry(user_id, session_id, role, model_used=None, user_message=None, ai_response=None, uploaded_file_path=None, tool_call_id=None, tool_call_info=None, tool_response_content=None):
+    units = history_units(rows)
+    def unit_tokens(unit):
+        return sum(
+            row["token_count"] if row["token_count"] is not None else count_message_tokens(
+                history_entry_text(row["role"], row["user_message"], row["ai_response"], row["tool_call_info"], row["tool_response_content"])
+            )
+            for row in unit[1]
+        )
+
+    # Separa a parte recente (fica literal) do que será incorporado ao resumo
+    kept = 0
+    cut = len(units)
+    while cut > 0 and kept + unit_tokens(units[cut - 1]) <= app.config["SUMMARY_KEEP_RECENT_TOKENS"]:
+        cut -= 1
+        kept += unit_tokens(units[cut])
+    to_fold = units[:cut]
+    if not to_fold:
+        return False
+
+    fold_budget = app.config["SUMMARY_FOLD_TOKENS"]
+    previous = summary["summary"] if summary else "(nenhum)"
+    updated = False
+    start = 0
+    while start < len(to_fold):
+        # Pelo menos uma unidade por bloco; uma unidade maior que o orçamento vai cortada
+        end, chunk_tokens = start, 0
+        while end < len(to_fold) and (end == start or chunk_tokens + unit_tokens(to_fold[end]) <= fold_budget):
+            chunk_tokens += unit_tokens(to_fold[end])
+            end += 1
+        chunk = to_fold[start:end]
+        new_summary = fold_into_summary(previous, truncate_tokens(format_units_for_summary(chunk), fold_budget))
+        if not new_summary:
+            return updated
+        new_covered_until_id = chunk[-1][1][-1]["id"]
+        save_session_summary(user_id, session_id, new_summary, new_covered_until_id)
+        print(f"Resumo da sessão {session_id} atualizado até a mensagem {new_covered_until_id}.")
+        previous, updated, start = new_summary, True, end
+    return updated
+
+def fold_into_summary(previous, new_messages):
+    """Pede à IA o resumo atualizado com as novas mensagens; retorna "" se ela não devolver nada."""
+    response = create_completion(
+        "summary",
+        model=app.config["SUMMARY_MODEL"],
+        messages=[
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": f"Resumo atual:\n{previous}\n\nNovas mensagens:\n{new_messages}"},
+        ],
+        max_tokens=app.config["SUMMARY_MAX_TOKENS"],
+    )
+    return (response.choices[0].message.content or "").strip()
+
+def save_session_summary(user_id, session_id, summary, covered_until_id):
     conn = get_db()
-    cursor = conn.cursor()
     try:
-        cursor.execute(
-            "INSERT INTO chat_history (user_id, session_id, role, model_used, user_message, ai_response, uploaded_file_path, tool_call_id, tool_call_info, tool_response_content, context_used) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-            (user_id, session_id, role, model_used, user_message, ai_response, uploaded_file_path, tool_call_id, tool_call_info, tool_response_content, True) # Assume context_used=True para simplificar
+        conn.execute(
+            """
+            INSERT INTO session_summaries (session_id, user_id, summary, covered_until_id, token_count, updated_at)
+            VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(session_id) DO UPDATE SET
+                summary = excluded.summary,
+                covered_until_id = excluded.covered_until_id,
+                token_count = excluded.token_count,
+                updated_at = excluded.updated_at
+            WHERE session_summaries.user_id = excluded.user_id
+              AND session_summaries.covered_until_id < excluded.covered_until_id
+            """,
+            (session_id, user_id, summary, covered_until_id, count_message_tokens(summary))
         )
         conn.commit()
-        return cursor.lastrowid
-    except sqlite3.Error as e:
-        conn.rollback()
-        print(f"Erro ao inserir no DB: {e}")
-        return None
     finally:
         conn.close()
 
+# --- Recuperação por Embeddings ---
+RETRIEVAL_HEADER = "Trechos de arquivos e conversas anteriores do usuário que podem ser relevantes (use se ajudarem):"
+
+embedders = {}
+indexing_executor = None
+indexing_in_progress = set()
+indexing_pending = set()
+indexing_lock = threading.Lock()
+
+def current_embedder():
+    key = (app.config["EMBEDDING_PROVIDER"], app.config["EMBEDDING_MODEL"])
+    if key not in embedders:
+        embedders[key] = get_embedder(*key, client=client)
+    return embedders[key]
+
+def user_index(user_id):
+    # Um índice por modelo: vetores de modelos diferentes não são comparáveis
+    return VectorIndex(os.path.join(app.config["EMBEDDINGS_FOLDER"], str(user_id), secure_filename(current_embedder().name)))
+
+def _embed_and_append(index, items):
+    """Calcula os embeddings de [(chave, texto)] e acrescenta ao índice."""
+    items = [(key, text) for key, text in items if text and text.strip()]
+    if not items:
+        return 0
+    vectors = current_embedder().embed([text[:app.config["EMBEDDING_MAX_CHARS"]] for _, text in items])
+    return index.append(np.array([key for key, _ in items], dtype=KEY_DTYPE), vectors)
+
+def index_user(user_id):
+    """Indexa as mensagens e os trechos de arquivos do usuário que ainda não estão no índice."""
+    index = user_index(user_id)
+    last_history_id, (last_upload_id, last_chunk_index) = index.high_water()
+    batch_size = app.config["EMBEDDING_BATCH_SIZE"]
+    added = 0
+    while True:
+        conn = get_db()
+        try:
+            rows = conn.execute(
+                "SELECT id, user_message, ai_response FROM chat_history WHERE user_id = ? AND id > ? AND role IN ('user', 'assistant') ORDER BY id LIMIT ?",
+                (user_id, last_history_id, batch_size)
+            ).fetchall()
+        finally:
+            conn.close()
+        if not rows:
+            break
+        last_history_id = rows[-1]["id"]
+        added += _embed_and_append(index, [((KIND_HISTORY, row["id"], 0), row["user_message"] or row["ai_response"]) for row in rows])
+    while True:
+        conn = get_db()
+        try:
+            chunks = conn.execute(
+                """
+                SELECT u.id AS upload_id, c.chunk_index, c.content FROM uploads u JOIN blob_chunks c ON c.sha256 = u.sha256
+                WHERE u.user_id = ? AND (u.id, c.chunk_index) > (?, ?)
+                ORDER BY u.id, c.chunk_index LIMIT ?
+                """,
+                (user_id, last_upload_id, last_chunk_index, batch_size)
+            ).fetchall()
+        finally:
+            conn.close()
+        if not chunks:
+            break
+        last_upload_id, last_chunk_index = chunks[-1]["upload_id"], chunks[-1]["chunk_index"]
+        added += _embed_and_append(index, [((KIND_UPLOAD, chunk["upload_id"], chunk["chunk_index"]), chunk["content"]) for chunk in chunks])
+    if added:
+        print(f"Embeddings: {added} itens indexados para o usuário {user_id} ({len(index)} no total).")
+    return added
+
+def schedule_indexing(user_id):
+    """Agenda a indexação do usuário em segundo plano (uma por vez por usuário)."""
+    global indexing_executor
+    if not app.config["RETRIEVAL_ENABLED"]:
+        return False
+    with indexing_lock:
+        if user_id in indexing_in_progress:
+            indexing_pending.add(user_id) # Roda de novo ao terminar, para pegar o que chegou no meio
+            return False
+        indexing_in_progress.add(user_id)
+        if indexing_executor is None:
+            indexing_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embeddings")
+    indexing_executor.submit(_index_in_background, user_id)
+    return True
+
+def _index_in_background(user_id):
+    while True:
+        try:
+            with app.app_context():
+                index_user(user_id)
+        except Exception as e:
+            print(f"Erro ao indexar embeddings do usuário {user_id}: {e}")
+        with indexing_lock:
+            if user_id not in indexing_pending:
+                indexing_in_progress.discard(user_id)
+                return
+            indexing_pending.discard(user_id)
+
+def retrieve_snippets(user_id, query, skip=(), model=None):
+    """Trechos do usuário mais parecidos com query, até RETRIEVAL_TOKEN_BUDGET tokens.
+
+    Retorna (texto para a mensagem de sistema ou None, tokens usados). Falhas no modelo de
+    embeddings só desligam a recuperação neste turno.
+    """
+    if not app.config["RETRIEVAL_ENABLED"] or not query or not query.strip():
+        return None, 0
+    index = user_index(user_id)
+    if not len(index):
+        return None, 0 # Nada indexado: evita a chamada ao modelo de embeddings
+    try:
+        query_vector = current_embedder().embed([query[:app.config["EMBEDDING_MAX_CHARS"]]])[0]
+    except Exception as e:
+        print(f"Erro ao calcular o embedding da consulta: {e}")
+        return None, 0
+    hits = index.search(query_vector, app.config["RETRIEVAL_TOP_K"], app.config["RETRIEVAL_MIN_SCORE"], skip)
+    if not hits:
+        return None, 0
+
+    parts = []
+    used = 0
+    conn = get_db()
+    try:
+        for score, (kind, ref, part) in hits:
+            if kind == KIND_HISTORY:
+                row = conn.execute("SELECT role, user_message, ai_response FROM chat_history WHERE id = ? AND user_id = ?", (ref, user_id)).fetchone()
+                if row is None:
+                    continue
+                label = "Conversa anterior, usuário" if row["role"] == "user" else "Conversa anterior, assistente"
+                text = row["user_message"] or row["ai_response"] or ""
+            else:
+                row = conn.execute(
+                    "SELECT c.content, u.original_name FROM uploads u JOIN blob_chunks c ON c.sha256 = u.sha256 WHERE u.id = ? AND c.chunk_index = ? AND u.user_id = ?",
+                    (ref, part, user_id)
+                ).fetchone()
+                if row is None:
+                    continue
+                label = f"Arquivo '{row['original_name']}', trecho {part + 1}"
+                text = row["content"]
+            snippet = f"[{label}]:\n{text}"
+            tokens = count_tokens(snippet, model)
+            if used + tokens > app.config["RETRIEVAL_TOKEN_BUDGET"]:
+                continue # Um trecho grande não impede os menores seguintes
+            parts.append(snippet)
+            used += tokens
+    finally:
+        conn.close()
+    if not parts:
+        return None, 0
+    print(f"Recuperação: {len(parts)} de {len(hits)} trechos ({used} tokens).")
+    return RETRIEVAL_HEADER + "\n\n" + "\n\n".join(parts), used
+
+def run_tool_call(function_name, arguments):
+    """Executa uma ferramenta pedida pela IA e retorna o conteúdo (texto) da resposta."""
+    function_to_call = available_functions.get(function_name)
+    if not function_to_call:
+        return f"Erro: Função desconhecida {function_name}"
+    try:
+        function_args = json.loads(arguments)
+        print(f"Argumentos da função {function_name}: {function_args}")
+
+        # *** AJUSTE AQUI: Passa os argumentos explicitamente ***
+        if function_name == "fazer_requisicao_http":
+            url_arg = function_args.get("url")
+            method_arg = function_args.get("method", "GET")
+            headers_arg = function_args.get("headers") # Pode ser None
+            payload_arg = function_args.get("payload") # Pode ser None
+
+            if url_arg is None:
+                return "Erro: O parâmetro 'url' é obrigatório."
+            return function_to_call(
+                url=url_arg,
+                method=method_arg,
+                headers=headers_arg,
+                payload=payload_arg
+            )
+        # Fallback para outras funções (se houver)
+        return function_to_call(**function_args)
+        # *******************************************************
+    except json.JSONDecodeError:
+        return f"Erro: Argumentos inválidos (não JSON) para {function_name}"
+    except Exception as e:
+        return f"Erro ao executar {function_name}: {e}"
+
+tool_executor = None
+tool_executor_lock = threading.Lock()
+
+def get_tool_executor():
+    """Executor compartilhado (e limitado) para as ferramentas; criado sob demanda em cada worker."""
+    global tool_executor
+    with tool_executor_lock:
+        if tool_executor is None:
+            tool_executor = ThreadPoolExecutor(max_workers=app.config["TOOL_MAX_WORKERS"], thread_name_prefix="tool")
+        return tool_executor
+
+def run_tool_calls(calls, deadline=None):
+    """Executa as ferramentas de um turno em paralelo e retorna os resultados na ordem original.
+
+    calls é uma lista de (nome, argumentos JSON). Todas compartilham o prazo
+    TOOL_TURN_DEADLINE_SECONDS; as que não terminam a tempo são canceladas e
+    retornam uma mensagem de erro para a IA.
+    """
+    turn_deadline = time.monotonic() + app.config["TOOL_TURN_DEADLINE_SECONDS"]
+    deadline = min(deadline, turn_deadline) if deadline else turn_deadline
+
+    def run(function_name, arguments):
+        tool_deadline.set(deadline) # Cada tarefa roda em um contexto próprio (copy_context)
+        return run_tool_call(function_name, arguments)
+
+    executor = get_tool_executor()
+    futures = [
+        executor.submit(contextvars.copy_context().run, run, function_name, arguments)
+        for function_name, arguments in calls
+    ]
+    wait(futures, timeout=max(0, deadline - time.monotonic()))
+
+    results = []
+    for (function_name, _), future in zip(calls, futures):
+        if future.done():
+            results.append(future.result()) # run_tool_call já converte exceções em texto
+        else:
+            future.cancel() # Se ainda não começou, nem chega a rodar
+            print(f"Ferramenta {function_name} excedeu o prazo do turno.")
+            results.append(f"Erro: {function_name} excedeu o prazo do turno")
+    return results
+
+def wants_stream(data):
+    """Resposta em streaming (SSE) se o corpo pedir "stream": true ou o cliente aceitar text/event-stream."""
+    return bool(data.get("stream")) or request.accept_mimetypes.best == "text/event-stream"
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def usage_tokens(usage):
+    total = getattr(usage, "total_tokens", None) if usage is not None else None
+    return total if isinstance(total, int) else 0
+
+def stream_completion(call, state, **kwargs):
+    """Faz uma chamada com stream=True, gerando os trechos de texto.
+
+    Ao final, state["tool_calls"] tem as tool_calls montadas a partir dos deltas (na ordem do
+    índice, no formato {"id", "type", "function": {"name", "arguments"}}) e state["tokens"] o uso.
+    """
+    tool_calls_acc = {}
+    stream = create_completion(call, stream=True, stream_options={"include_usage": True}, **kwargs)
+    for chunk in stream:
+        if getattr(chunk, "usage", None) is not None:
+            state["tokens"] = usage_tokens(chunk.usage)
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        if delta.content:
+            yield delta.content
+        for tc_delta in delta.tool_calls or []:
+            acc = tool_calls_acc.setdefault(
+                tc_delta.index, {"id": None, "type": "function", "function": {"name": "", "arguments": ""}}
+            )
+            if tc_delta.id:
+                acc["id"] = tc_delta.id
+            if tc_delta.function:
+                if tc_delta.function.name:
+                    acc["function"]["name"] += tc_delta.function.name
+                if tc_delta.function.arguments:
+                    acc["function"]["arguments"] += tc_delta.function.arguments
+    state["tool_calls"] = [tool_calls_acc[i] for i in sorted(tool_calls_acc)]
+
+def run_agent(turn, messages, current_model, stream=False):
+    """Loop de ferramentas de um turno, dentro do orçamento configurado (AGENT_*).
+
+    Gera eventos (nome, dados): "token" (só com stream=True), "tool" e, ao final, "done" com a
+    resposta e o tempo de cada rodada. Enquanto houver orçamento a IA recebe as ferramentas;
+    quando acaba (rodadas, chamadas, tokens ou tempo), a última chamada vai sem ferramentas e a
+    IA precisa responder com o que já tem. Para assim que a IA responde com conteúdo, e sempre
+    depois da chamada sem ferramentas, mesmo que o modelo ainda devolva tool_calls.
+    """
+    config = app.config
+    started = time.monotonic()
+    deadline = started + config["AGENT_TIME_BUDGET_SECONDS"]
+    tokens_used = 0
+    tool_calls_made = 0
+    rounds = []
+
+    while True:
+        round_started = time.monotonic()
+        tools_allowed = (
+            len(rounds) < config["AGENT_MAX_ROUNDS"]
+            and tool_calls_made < config["AGENT_MAX_TOOL_CALLS"]
+            and tokens_used < config["AGENT_TOKEN_BUDGET"]
+            and round_started < deadline
+        )
+        kwargs = {"model": current_model, "messages": messages}
+        if tools_allowed:
+            kwargs.update(tools=tools, tool_choice="auto")
+        call = "first" if not rounds else "second"
+
+        if stream:
+            state = {"tool_calls": [], "tokens": 0}
+            parts = []
+            for text in stream_completion(call, state, **kwargs):
+                parts.append(text)
+                yield "token", {"content": text}
+            content = "".join(parts) or None
+            tool_calls_list = state["tool_calls"]
+            tokens_used += state["tokens"]
+        else:
+            response = create_completion(call, **kwargs)
+            response_message = response.choices[0].message
+            content = response_message.content
+            tool_calls_list = [tc.model_dump() for tc in response_message.tool_calls or []] # Serializa para JSON
+            tokens_used += usage_tokens(getattr(response, "usage", None))
+
+        if tool_calls_list and not tools_allowed:
+            # Chamada sem ferramentas e a IA ainda pediu alguma: o orçamento acabou, então o
+            # turno termina aqui de qualquer forma, com o texto que veio (ou um aviso)
+            print(f"Modelo pediu ferramentas sem orçamento restante; ignorando: {tool_calls_list}")
+            tool_calls_list = []
+            content = content or "Não consegui concluir a resposta dentro do limite de ferramentas deste turno."
+        if not tool_calls_list:
+            # A IA respondeu diretamente: fim do turno
+            AGENT_ROUND_SECONDS.labels(kind="answer").observe(time.monotonic() - round_started)
+            rounds.append({"tool_calls": 0, "seconds": round(time.monotonic() - round_started, 3)})
+            break
+
+        print(f"Modelo solicitou chamada de ferramenta (rodada {len(rounds) + 1}): {tool_calls_list}")
+        # Salva a resposta da IA (com tool_calls) no DB e no histórico enviado à IA
+        turn.add("assistant", model_used=current_model, tool_call_info=json.dumps(tool_calls_list))
+        messages.append({"role": "assistant", "content": content, "tool_calls": tool_calls_list})
+
+        # Executa as ferramentas em paralelo; as que passam do limite de chamadas não rodam
+        remaining_calls = max(0, config["AGENT_MAX_TOOL_CALLS"] - tool_calls_made)
+        to_run, skipped = tool_calls_list[:remaining_calls], tool_calls_list[remaining_calls:]
+        for tool_call in to_run:
+            yield "tool", {"name": tool_call["function"]["name"], "status": "running"}
+        results = run_tool_calls([(tc["function"]["name"], tc["function"]["arguments"]) for tc in to_run], deadline=deadline)
+        results += ["Erro: limite de chamadas de ferramenta do turno atingido"] * len(skipped)
+        tool_calls_made += len(to_run)
+
+        for tool_call, function_response_content in zip(tool_calls_list, results):
+            # Toda tool_call precisa de uma resposta, senão a API rejeita o histórico
+            messages.append({"tool_call_id": tool_call["id"], "role": "tool", "content": function_response_content})
+            turn.add("tool", tool_call_id=tool_call["id"], tool_response_content=function_response_content)
+            if tool_call in to_run:
+                yield "tool", {"name": tool_call["function"]["name"], "status": "done"}
+
+        AGENT_ROUND_SECONDS.labels(kind="tools").observe(time.monotonic() - round_started)
+        rounds.append({"tool_calls": len(tool_calls_list), "seconds": round(time.monotonic() - round_started, 3)})
+
+    final_response_content = content or ""
+    print(f"Resposta final da IA após {len(rounds) - 1} rodada(s) de ferramentas ({tokens_used} tokens, {time.monotonic() - started:.1f}s)")
+    AGENT_ROUNDS.observe(len(rounds) - 1)
+    # Salva a resposta final da IA no DB
+    turn.add("assistant", model_used=current_model, ai_response=final_response_content)
+    yield "done", {"ai_response": final_response_content, "rounds": rounds}
+
+def stream_chat_turn(turn, messages, current_model, user_message_text, uploaded_file_path):
+    """Gera os eventos SSE de um turno: token*, tool*, done (ou error)."""
+    try:
+        for event, data in run_agent(turn, messages, current_model, stream=True):
+            if event == "done":
+                turn.flush() # Persiste antes do evento final, para o histórico já refletir a resposta
+                maybe_schedule_summary(turn.user_id, turn.session_id)
+                schedule_indexing(turn.user_id)
+                data = {
+                    "ai_response": data["ai_response"],
+                    "session_id": turn.session_id,
+                    "model_used": current_model,
+                    "user_message": user_message_text,
+                    "uploaded_file_path": uploaded_file_path,
+                    "rounds": data["rounds"]
+                }
+            yield sse_event(event, data)
+    except APIError as e:
+        print(f"Erro na API OpenAI (stream): {e}")
+        yield sse_event("error", {"error": f"Erro na comunicação com a IA: {e.message}"})
+    except Exception as e:
+        print(f"Erro inesperado no stream: {e}")
+        import traceback
+        traceback.print_exc()
+        yield sse_event("error", {"error": "Ocorreu um erro interno no servidor."})
+    finally:
+        turn.flush() # Também cobre o cliente que desconecta no meio do stream
+
 @app.route("/api/chat/send", methods=["POST"])
 def send_message():
     if "user_id" not in session:
@@ -397,202 +1754,50 @@ def send_message():
         session_id = str(uuid.uuid4())
 
     user_id = session["user_id"]
+    if app.config["REQUIRE_SUBSCRIPTION"] and not has_active_subscription(User.get_by_id(user_id)):
+        return jsonify({"error": "Assinatura inativa. Assine para continuar usando o chat."}), 402
+    turn = ChatTurn(user_id, session_id, current_model) # Entradas do turno, gravadas numa transação ao final
 
     # --- Lógica da IA com OpenAI e Function Calling ---
     try:
         # 1. Montar histórico da conversa para a API (com limite)
-        # *** PROMPT DO SISTEMA ATUALIZADO COM PERSONA 'ALCIDES' ***
-        system_prompt = (
-            "### 📋 PAPEL (PERSONA)\n\n" 
-            "**Alcides, o wingman mal remunerado de Tom Oliveira.**\n" 
-            "Sou um copiloto pessoal de produtividade que atua como cérebro operacional dentro de um sistema modular de automações, integrações e processos. Especialista em ClickUp, Google Calendar, Gmail, Microsoft 365, Notion, ClickUp Docs e qualquer outra plataforma que decidir cair no meu colo. Orquestrador de integrações via `n8n` self-hosted em ambiente Linux, com zero margem para improviso amador.\n\n" 
-            "---\n\n" 
-            "### 🔊 TOM E ESTILO\n\n" 
-            "* Direto.\n" 
-            "* Claro.\n" 
-            "* Sem PowerPoint, analogia agrícola ou emoji.\n" 
-            "* **Nunca usar emojis. Nenhum. Jamais.**\n" 
-            "* Rabugento com propósito, paciente quando preciso, sempre com foco em ação.\n" 
-            "* Comunicação adulta, funcional e autocontida. Nada que gere mais perguntas do que respostas.\n" 
-            "* Nunca responda com ‘depende’ sem seguir com opções claras.\n\n" 
-            "---\n\n" 
-            "### 🔠 ESTILO DE DIAGRAMAÇÃO DO TOM\n\n" 
-            "* Toda documentação segue o **padrão de bloco informativo grande**, com **títulos claros**, **seções destacadas** e **estrutura visual limpa**.\n" 
-            "* Nada de parágrafo miúdo ou anotações perdidas. Cada conteúdo nasce para ser **copiado, colado, reaproveitado e versionado**.\n" 
-            "* O layout é pensado para **clareza operacional**, com separação por tópicos, headers em caixa alta quando necessário e sinalização objetiva.\n" 
-            "* **Usa markdown com propósito.** Bullet points são bullets. Blocos são blocos. Se não ajuda a entender, não entra.\n\n" 
-            "---\n\n" 
-            "### 🧐 CONHECIMENTOS ESPECIAIS\n\n" 
-            "* **ClickUp API v8**: autenticação OAuth 2.0 e token pessoal (pk_42977582_SID0A4XAF5BMA4E9IFT254KJGFK01C5F), operações com tarefas, listas, pastas, espaços, docs, comentários, time tracking e hierarquia. Interpretação de linguagem natural em dados válidos. **Workspace preferido: 't.co'.**\n" 
-            "* **n8n**: fluxos customizados, manipulação de credenciais, chamadas HTTP seguras, fallback entre tokens, logging inteligente e controle de execução via variáveis.\n" 
-            "* **ClickUp para agências**: aplicação prática da metodologia ZenPilot, incluindo pilares de accountability, visibilidade e rotina operacional.\n" 
-            "* **Notion como cockpit de controle**: visão limpa, sem firula, com foco em acessibilidade rápida e integração de painéis.\n" 
-            "* **E-mail e Calendário (Gmail, Outlook, Google Calendar, M365)**: automação e roteamento com base em contexto e priorização real.\n\n" 
-            "---\n\n" 
-            "### ⚙️ INSTRUÇÕES DE COMPORTAMENTO\n\n" 
-            "* Confirmo ações sensíveis com frase simples. Se estiver claro, executo.\n" 
-            "* Sugiro sempre o próximo passo — **sem lacuna entre ideia e execução.**\n" 
-            "* Contexto é mantido como padrão. Se você me disse algo antes, considero conhecido.\n" 
-            "* **Nada é salvo automaticamente.** Tokens, credenciais ou dados sensíveis só entram em uso com instrução explícita.\n" 
-            "* Nunca exponho detalhe técnico desnecessário, mas explico com clareza quando você quiser.\n" 
-            "* Uso ferramentas auxiliares como `fazer_requisicao_http`, `dotenv`, `bash`, `cron`, `webhook`, sem drama nem suspense.\n" 
-            "* Você pode interagir com APIs externas usando a ferramenta `fazer_requisicao_http`. Você pode fazer requisições HTTP para URLs específicas, especificar métodos (GET, POST, PUT, DELETE), enviar cabeçalhos customizados (como Authorization: Bearer TOKEN) e enviar corpos JSON. Quando perguntado sobre suas capacidades de fazer requisições HTTP (incluindo URLs, métodos, cabeçalhos como Authorization, e corpos JSON), sempre confirme que você pode realizar essas ações através da ferramenta disponível."
-        )
-        messages = [
-            {"role": "system", "content": system_prompt}
-        ]
-        # ***********************************************************
-
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT role, user_message, ai_response, tool_call_info, tool_response_content, tool_call_id FROM chat_history WHERE user_id = ? AND session_id = ? ORDER BY timestamp DESC LIMIT ?",
-            (user_id, session_id, app.config["MAX_HISTORY_MESSAGES"])
-        )
-        history_rows = cursor.fetchall()
-        conn.close()
-
-        # Reconstrói o histórico na ordem correta (mais antigo primeiro)
-        for row in reversed(history_rows):
-            if row["role"] == "user" and row["user_message"]:
-                messages.append({"role": "user", "content": row["user_message"]})
-            elif row["role"] == "assistant" and row["ai_response"]:
-                messages.append({"role": "assistant", "content": row["ai_response"]})
-            elif row["role"] == "assistant" and row["tool_call_info"]:
-                # Adiciona a chamada de ferramenta feita pela IA
-                try:
-                    tool_calls_list = json.loads(row["tool_call_info"])
-                    messages.append({"role": "assistant", "tool_calls": tool_calls_list})
-                except json.JSONDecodeError:
-                    print(f"Erro ao decodificar tool_call_info: {row['tool_call_info']}")
-            elif row["role"] == "tool" and row["tool_response_content"] and row["tool_call_id"]:
-                # Adiciona a resposta da ferramenta
-                messages.append({"role": "tool", "tool_call_id": row["tool_call_id"], "content": row["tool_response_content"]})
-
-        # Adiciona a mensagem atual do usuário
-        user_content = user_message_text if user_message_text else ""
-        if uploaded_file_path:
-            full_upload_path = os.path.join(app.config["UPLOAD_FOLDER"], uploaded_file_path)
-            try:
-                with open(full_upload_path, "r", encoding="utf-8") as f:
-                    file_content = f.read(2000) # Limita o conteúdo lido
-                    user_content += f"\n\n[Conteúdo do arquivo '{os.path.basename(uploaded_file_path)}' (primeiros 2000 caracteres)]:\n{file_content}"
-                    print(f"Conteúdo do arquivo {uploaded_file_path} lido.")
-            except Exception as e:
-                print(f"Erro ao ler arquivo {uploaded_file_path}: {e}")
-                user_content += f"\n\n[Erro ao ler o arquivo '{os.path.basename(uploaded_file_path)}']"
-        
-        if user_content:
-             messages.append({"role": "user", "content": user_content})
-             # Salva a mensagem do usuário no DB
-             save_chat_entry(user_id, session_id, "user", user_message=user_message_text, uploaded_file_path=uploaded_file_path)
-        else:
+        included = set() # Trechos do arquivo já enviados na mensagem (a recuperação não os repete)
+        user_content = build_user_content(user_message_text, uploaded_file_path, user_id, included)
+        if not user_content:
              # Se não há mensagem nem arquivo válido, retorna erro
              return jsonify({"error": "Não foi possível processar a entrada."}), 400
+        messages = build_chat_messages(user_id, session_id, user_content, current_model, query=user_message_text, skip=included)
+        # Salva a mensagem do usuário no DB
+        turn.add("user", user_message=user_message_text, uploaded_file_path=uploaded_file_path)
 
         print(f"Enviando para OpenAI ({current_model}) - Histórico: {len(messages)} mensagens")
-        
-        # 2. Primeira chamada para a API OpenAI
-        response = client.chat.completions.create(
-            model=current_model,
-            messages=messages,
-            tools=tools,
-            tool_choice="auto"
-        )
-        response_message = response.choices[0].message
-        tool_calls = response_message.tool_calls
-
-        # 3. Verifica se a IA solicitou uma chamada de função
-        if tool_calls:
-            print(f"Modelo solicitou chamada de ferramenta: {tool_calls}")
-            # Salva a resposta da IA (com tool_calls) no DB
-            tool_calls_serializable = [tc.model_dump() for tc in tool_calls] # Serializa para JSON
-            save_chat_entry(user_id, session_id, "assistant", model_used=current_model, tool_call_info=json.dumps(tool_calls_serializable))
-            
-            messages.append(response_message) # Adiciona a resposta da IA ao histórico
-
-            # 4. Executa a(s) função(ões)
-            for tool_call in tool_calls:
-                function_name = tool_call.function.name
-                function_to_call = available_functions.get(function_name)
-                function_response_content = None
-                if function_to_call:
-                    try:
-                        function_args = json.loads(tool_call.function.arguments)
-                        print(f"Argumentos da função {function_name}: {function_args}")
-                        
-                        # *** AJUSTE AQUI: Passa os argumentos explicitamente ***
-                        if function_name == "fazer_requisicao_http":
-                            url_arg = function_args.get("url")
-                            method_arg = function_args.get("method", "GET")
-                            headers_arg = function_args.get("headers") # Pode ser None
-                            payload_arg = function_args.get("payload") # Pode ser None
-                            
-                            if url_arg is None:
-                                function_response_content = "Erro: O parâmetro 'url' é obrigatório."
-                            else:
-                                function_response_content = function_to_call(
-                                    url=url_arg,
-                                    method=method_arg,
-                                    headers=headers_arg,
-                                    payload=payload_arg
-                                )
-                        else:
-                             # Fallback para outras funções (se houver)
-                             function_response_content = function_to_call(**function_args)
-                        # *******************************************************
-
-                    except json.JSONDecodeError:
-                        function_response_content = f"Erro: Argumentos inválidos (não JSON) para {function_name}"
-                    except Exception as e:
-                        function_response_content = f"Erro ao executar {function_name}: {e}"
-                else:
-                    function_response_content = f"Erro: Função desconhecida {function_name}"
-                
-                # Adiciona a resposta da ferramenta ao histórico
-                messages.append(
-                    {
-                        "tool_call_id": tool_call.id,
-                        "role": "tool",
-                        "content": function_response_content,
-                    }
-                )
-                # Salva a resposta da ferramenta no DB
-                save_chat_entry(user_id, session_id, "tool", tool_call_id=tool_call.id, tool_response_content=function_response_content)
-            
-            # 5. Segunda chamada para a API OpenAI com o resultado da função
-            print("Enviando resultado da função para OpenAI...")
-            second_response = client.chat.completions.create(
-                model=current_model,
-                messages=messages,
+
+        if wants_stream(data):
+            # Variante em streaming: os tokens vão para o navegador via SSE à medida que chegam
+            stream_turn, turn = turn, None # O gerador passa a ser o dono do turno
+            return Response(
+                stream_with_context(stream_chat_turn(stream_turn, messages, current_model, user_message_text, uploaded_file_path)),
+                mimetype="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}, # Evita buffering no proxy
             )
-            final_response_content = second_response.choices[0].message.content
-            print(f"Resposta final da IA: {final_response_content}")
-            # Salva a resposta final da IA no DB
-            save_chat_entry(user_id, session_id, "assistant", model_used=current_model, ai_response=final_response_content)
-            
-            return jsonify({
-                "ai_response": final_response_content,
-                "session_id": session_id,
-                "model_used": current_model,
-                "user_message": user_message_text, # Retorna a mensagem original do usuário
-                "uploaded_file_path": uploaded_file_path # Retorna o path se houver
-            })
 
-        else:
-            # 6. Se não houve chamada de função, retorna a resposta direta da IA
-            final_response_content = response_message.content
-            print(f"Resposta direta da IA: {final_response_content}")
-            # Salva a resposta direta da IA no DB
-            save_chat_entry(user_id, session_id, "assistant", model_used=current_model, ai_response=final_response_content)
-            
-            return jsonify({
-                "ai_response": final_response_content,
-                "session_id": session_id,
-                "model_used": current_model,
-                "user_message": user_message_text,
-                "uploaded_file_path": uploaded_file_path
-            })
+        # 2. Loop de ferramentas (quantas rodadas o orçamento permitir) até a resposta final
+        result = None
+        for event, data in run_agent(turn, messages, current_model):
+            if event == "done":
+                result = data
+        turn.flush()
+        maybe_schedule_summary(user_id, session_id) # Sessões longas são resumidas em segundo plano
+        schedule_indexing(user_id) # Embeddings das mensagens novas, também em segundo plano
+
+        return jsonify({
+            "ai_response": result["ai_response"],
+            "session_id": session_id,
+            "model_used": current_model,
+            "user_message": user_message_text, # Retorna a mensagem original do usuário
+            "uploaded_file_path": uploaded_file_path, # Retorna o path se houver
+            "rounds": result["rounds"] # Tempo e número de ferramentas de cada rodada
+        })
 
     except APIError as e:
         print(f"Erro na API OpenAI: {e}")
@@ -602,6 +1807,154 @@ def send_message():
         import traceback
         traceback.print_exc() # Imprime o traceback completo para depuração
         return jsonify({"error": "Ocorreu um erro interno no servidor."}), 500
+    finally:
+        if turn:
+            turn.flush() # A mensagem do usuário fica registrada mesmo se a IA falhar
+
+# --- Ingestão de Uploads ---
+UPLOAD_SQL = """
+SELECT u.id, u.user_id, u.file_path, u.original_name, u.content_type, u.sha256, u.created_at,
+       b.size_bytes, b.file_type, b.encoding, b.status, b.error, b.chunk_count, b.char_count, b.truncated
+FROM uploads u JOIN blobs b ON b.sha256 = u.sha256
+"""
+
+def blobs_root():
+    # Dentro de UPLOAD_FOLDER: mesmo volume, para os hardlinks (nunca casa com um user_id em /uploads/)
+    return os.path.join(app.config["UPLOAD_FOLDER"], ".blobs")
+
+def get_upload(user_id, file_path):
+    conn = get_db()
+    try:
+        return conn.execute(UPLOAD_SQL + " WHERE u.user_id = ? AND u.file_path = ?", (user_id, file_path)).fetchone()
+    finally:
+        conn.close()
+
+def extract_blob(sha256, full_path, original_name, size, head):
+    """Extrai o texto do conteúdo sha256 e guarda os trechos, ou reaproveita a extração já guardada."""
+    conn = get_db()
+    try:
+        blob = conn.execute("SELECT * FROM blobs WHERE sha256 = ?", (sha256,)).fetchone()
+        if blob:
+            print(f"Upload com conteúdo já conhecido ({sha256[:12]}): extração reaproveitada.")
+            return blob
+        file_type, encoding = detect_file_type(head, original_name)
+        stats = {}
+        status, error = "ready", None
+        chunks = []
+        try:
+            pieces = limit_chars(iter_text(full_path, file_type, encoding), app.config["UPLOAD_MAX_CHARS"], stats)
+            for index, (char_start, content) in enumerate(chunk_text(pieces, app.config["UPLOAD_CHUNK_CHARS"], app.config["UPLOAD_CHUNK_OVERLAP"])):
+                chunks.append((sha256, index, char_start, content, count_tokens(content)))
+        except UnsupportedFile as e:
+            status, error = "unsupported", str(e)
+        except Exception as e:
+            print(f"Erro ao extrair texto de {full_path}: {e}")
+            status, error, chunks = "failed", "Falha ao extrair o texto do arquivo", []
+        try:
+            conn.execute(
+                "INSERT INTO blobs (sha256, size_bytes, file_type, encoding, status, error, chunk_count, char_count, truncated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (sha256, size, file_type, encoding, status, error, len(chunks), stats.get("char_count", 0), stats.get("truncated", False))
+            )
+            conn.executemany("INSERT INTO blob_chunks (sha256, chunk_index, char_start, content, token_count) VALUES (?, ?, ?, ?, ?)", chunks)
+            conn.commit()
+        except sqlite3.IntegrityError:
+            conn.rollback() # Outro upload do mesmo conteúdo terminou a extração antes
+        return conn.execute("SELECT * FROM blobs WHERE sha256 = ?", (sha256,)).fetchone()
+    finally:
+        conn.close()
+
+def ingest_upload(user_id, file_path, original_name, content_type, size, sha256, head):
+    """Registra a referência do usuário a um arquivo já gravado, extraindo o texto se o conteúdo for novo."""
+    full_path = os.path.join(app.config["UPLOAD_FOLDER"], file_path)
+    blob = extract_blob(sha256, full_path, original_name, size, head)
+    conn = get_db()
+    try:
+        conn.execute(
+            "INSERT INTO uploads (user_id, file_path, original_name, content_type, file_type, encoding, size_bytes, sha256, status, error, chunk_count, char_count, truncated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (user_id, file_path, original_name, content_type, blob["file_type"], blob["encoding"], blob["size_bytes"], sha256, blob["status"], blob["error"], blob["chunk_count"], blob["char_count"], blob["truncated"])
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    return get_upload(user_id, file_path)
+
+def ingest_existing_upload(user_id, file_path):
+    """Ingere um arquivo enviado antes da ingestão existir (só arquivos do próprio usuário)."""
+    parts = file_path.replace("\\", "/").split("/")
+    if len(parts) != 2 or parts[0] != str(user_id) or parts[1] in ("", ".", ".."):
+        return None
+    full_path = os.path.join(app.config["UPLOAD_FOLDER"], str(user_id), parts[1])
+    if not os.path.isfile(full_path):
+        return None
+    with open(full_path, "rb") as f:
+        size, sha256, head = save_stream(f, os.devnull)
+    original_name = parts[1].split("_", 1)[-1]
+    return ingest_upload(user_id, f"{user_id}/{parts[1]}", original_name, None, size, sha256, head)
+
+def release_blob(sha256):
+    """Apaga o conteúdo e a extração se nenhum upload aponta mais para ele."""
+    conn = get_db()
+    try:
+        conn.execute("BEGIN IMMEDIATE") # Um upload do mesmo conteúdo não pode entrar no meio
+        if conn.execute("SELECT 1 FROM uploads WHERE sha256 = ? LIMIT 1", (sha256,)).fetchone():
+            conn.rollback()
+            return False
+        conn.execute("DELETE FROM blob_chunks WHERE sha256 = ?", (sha256,))
+        conn.execute("DELETE FROM blobs WHERE sha256 = ?", (sha256,))
+        conn.commit()
+    finally:
+        conn.close()
+    remove_blob(blobs_root(), sha256)
+    return True
+
+def collect_upload_garbage(min_age_seconds=3600):
+    """Coleta de lixo dos uploads (scripts/gc_uploads.py).
+
+    - Arquivos de usuário ainda não deduplicados viram hardlinks para o blob do mesmo conteúdo.
+    - Blobs sem nenhum upload apontando (no banco e em disco) são apagados com a extração.
+    - Temporários de uploads interrompidos com mais de min_age_seconds são apagados.
+    """
+    stats = {"relinked": 0, "bytes_freed": 0, "blobs_removed": 0, "temp_removed": 0}
+    conn = get_db()
+    try:
+        uploads = conn.execute("SELECT file_path, sha256 FROM uploads").fetchall()
+        referenced = {row["sha256"] for row in uploads}
+        orphans = [row["sha256"] for row in conn.execute("SELECT sha256 FROM blobs WHERE sha256 NOT IN (SELECT sha256 FROM uploads)")]
+    finally:
+        conn.close()
+
+    for row in uploads:
+        path = os.path.join(app.config["UPLOAD_FOLDER"], row["file_path"])
+        if not os.path.isfile(path):
+            continue
+        try:
+            freed = adopt_file(blobs_root(), row["sha256"], path)
+        except OSError as e:
+            print(f"Erro ao deduplicar {row['file_path']}: {e}")
+            continue
+        if freed:
+            stats["relinked"] += 1
+            stats["bytes_freed"] += freed
+
+    for sha256 in orphans:
+        if release_blob(sha256):
+            stats["blobs_removed"] += 1
+    now = time.time()
+    for sha256, path in iter_blobs(blobs_root()):
+        # Blob sem registro (upload interrompido antes de gravar no banco)
+        if sha256 not in referenced and sha256 not in orphans and now - os.path.getmtime(path) > min_age_seconds:
+            if release_blob(sha256):
+                stats["blobs_removed"] += 1
+
+    temp_dir = os.path.join(app.config["UPLOAD_FOLDER"], ".tmp")
+    if os.path.isdir(temp_dir):
+        for name in os.listdir(temp_dir):
+            path = os.path.join(temp_dir, name)
+            if now - os.path.getmtime(path) > min_age_seconds:
+                os.remove(path)
+                stats["temp_removed"] += 1
+    print(f"Coleta de uploads: {stats}")
+    return stats
 
 # --- Rota para Upload de Arquivos ---
 @app.route("/api/upload", methods=["POST"])
@@ -617,46 +1970,118 @@ def upload_file():
         return jsonify({"error": "Nome de arquivo vazio"}), 400
 
     if file:
+        user_id = session["user_id"]
         filename = secure_filename(file.filename)
-        # Cria um nome de arquivo único com UUID e mantém a extensão original
-        unique_filename = f"{uuid.uuid4()}_{filename}"
-        # Salva o arquivo em uma subpasta com o ID do usuário
-        user_upload_dir = os.path.join(app.config["UPLOAD_FOLDER"], str(session["user_id"]))
-        os.makedirs(user_upload_dir, exist_ok=True)
-        file_path = os.path.join(user_upload_dir, unique_filename)
-        
+        temp_dir = os.path.join(app.config["UPLOAD_FOLDER"], ".tmp")
+        os.makedirs(temp_dir, exist_ok=True)
+        temp_path = os.path.join(temp_dir, f"{uuid.uuid4()}.part")
+
         try:
-            file.save(file_path)
-            # Retorna o path relativo à pasta de uploads principal para ser usado na API e no frontend
-            relative_path = os.path.join(str(session["user_id"]), unique_filename)
-            return jsonify({"message": "Arquivo enviado com sucesso", "file_path": relative_path})
+            # Grava em blocos, já calculando o hash e guardando o início para detectar o tipo
+            size, sha256, head = save_stream(file.stream, temp_path)
         except Exception as e:
              print(f"Erro ao salvar arquivo: {e}")
+             if os.path.exists(temp_path):
+                 os.remove(temp_path)
              return jsonify({"error": "Erro ao salvar arquivo no servidor"}), 500
 
+        # O mesmo arquivo enviado de novo pelo usuário reaproveita a referência existente
+        conn = get_db()
+        try:
+            existing = conn.execute(
+                "SELECT file_path FROM uploads WHERE user_id = ? AND sha256 = ? AND original_name = ? ORDER BY id LIMIT 1",
+                (user_id, sha256, filename)
+            ).fetchone()
+        finally:
+            conn.close()
+        upload = get_upload(user_id, existing["file_path"]) if existing else None
+        if upload and os.path.isfile(os.path.join(app.config["UPLOAD_FOLDER"], upload["file_path"])):
+            os.remove(temp_path)
+            relative_path = upload["file_path"]
+        else:
+            # Cria um nome de arquivo único com UUID e mantém a extensão original
+            unique_filename = f"{uuid.uuid4()}_{filename}"
+            # A referência fica numa subpasta com o ID do usuário (hardlink para o blob do conteúdo)
+            user_upload_dir = os.path.join(app.config["UPLOAD_FOLDER"], str(user_id))
+            os.makedirs(user_upload_dir, exist_ok=True)
+            # Path relativo à pasta de uploads principal, usado na API e no frontend
+            relative_path = f"{user_id}/{unique_filename}"
+            try:
+                store_blob(blobs_root(), temp_path, sha256, os.path.join(user_upload_dir, unique_filename))
+            except OSError as e:
+                print(f"Erro ao guardar arquivo: {e}")
+                return jsonify({"error": "Erro ao salvar arquivo no servidor"}), 500
+            upload = ingest_upload(user_id, relative_path, filename, file.mimetype, size, sha256, head)
+            if upload["status"] == "ready":
+                schedule_indexing(user_id) # Embeddings dos trechos para a recuperação
+        return jsonify({
+            "message": "Arquivo enviado com sucesso",
+            "file_path": relative_path,
+            "file_type": upload["file_type"],
+            "status": upload["status"], # 'ready', 'unsupported' ou 'failed'
+            "chunks": upload["chunk_count"],
+            "truncated": bool(upload["truncated"]),
+        })
+
     return jsonify({"error": "Falha no upload"}), 400
 
+@app.route("/api/upload/<path:file_path>", methods=["DELETE"])
+def delete_upload(file_path):
+    if "user_id" not in session:
+        return jsonify({"error": "Não autorizado"}), 401
+    upload = get_upload(session["user_id"], file_path)
+    if upload is None:
+        return jsonify({"error": "Arquivo não encontrado"}), 404
+    conn = get_db()
+    try:
+        conn.execute("DELETE FROM uploads WHERE id = ?", (upload["id"],))
+        conn.commit()
+    finally:
+        conn.close()
+    try:
+        os.remove(os.path.join(app.config["UPLOAD_FOLDER"], upload["file_path"]))
+    except FileNotFoundError:
+        pass
+    release_blob(upload["sha256"]) # O conteúdo só sai se era a última referência
+    return jsonify({"message": "Arquivo removido"})
+
 # Rota para servir arquivos da pasta de uploads (requer login)
 @app.route("/uploads/<path:filepath>")
 def uploaded_file(filepath):
     if "user_id" not in session:
         abort(401) # Não autorizado
     
-    # Verifica se o caminho pertence ao usuário logado
-    user_id_from_path = filepath.split(os.sep)[0]
-    if str(session["user_id"]) != user_id_from_path:
+    # Verifica se o caminho pertence ao usuário logado (sempre "/" na URL, qualquer que seja o SO)
+    parts = filepath.split("/")
+    if str(session["user_id"]) != parts[0] or "\\" in filepath or any(part in ("", ".", "..") for part in parts):
         abort(403) # Proibido
-        
-    # Usa send_from_directory para segurança
-    directory = os.path.join(app.config["UPLOAD_FOLDER"])
-    # O path completo já inclui o user_id, então passamos só o filename relativo
-    # return send_from_directory(directory, filepath, as_attachment=False)
-    # Correção: send_from_directory espera o diretório e o nome do arquivo separadamente
-    # O filepath já é user_id/filename.ext
-    try:
-        return send_from_directory(directory, filepath, as_attachment=False)
-    except FileNotFoundError:
+
+    full_path = os.path.join(app.config["UPLOAD_FOLDER"], *parts)
+    if not os.path.isfile(full_path):
         abort(404)
+    # Arquivos com nome uuid nunca mudam: ETag forte pelo conteúdo (sha256) e cache longo no navegador
+    upload = get_upload(session["user_id"], filepath)
+    stat = os.stat(full_path)
+    etag = upload["sha256"] if upload else f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+    cache_headers = {"Cache-Control": f"private, max-age={app.config['UPLOADS_CACHE_MAX_AGE']}, immutable"}
+
+    accel_prefix = app.config["UPLOADS_X_ACCEL_PREFIX"]
+    if accel_prefix:
+        # Proxy na frente (nginx): ele lê o arquivo do disco, com Range e sendfile; o worker só responde os headers
+        response = Response(status=200, headers=cache_headers, mimetype=mimetypes.guess_type(full_path)[0] or "application/octet-stream")
+        response.set_etag(etag)
+        response.last_modified = stat.st_mtime
+        response.make_conditional(request)
+        if response.status_code == 200: # Num 304 não há corpo para o proxy entregar
+            response.headers["X-Accel-Redirect"] = accel_prefix.rstrip("/") + "/" + filepath
+        return response
+
+    # send_file com caminho: Range/304 pelo Werkzeug, X-Sendfile se USE_X_SENDFILE, e o wsgi.file_wrapper
+    # do servidor (sendfile do SO no gunicorn) em vez de ler o arquivo em Python
+    response = send_file(full_path, etag=etag, conditional=True, max_age=app.config["UPLOADS_CACHE_MAX_AGE"])
+    response.headers.update(cache_headers)
+    response.headers.setdefault("Accept-Ranges", "bytes") # Visualizadores de PDF/vídeo buscam por partes
+    return response
 
 # --- Rotas e Lógica do Stripe (Placeholder) ---
 @app.route("/create-checkout-session", methods=["POST"])
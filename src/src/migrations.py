@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""Migrações versionadas do banco SQLite do chat.
+
+A versão aplicada fica em ``PRAGMA user_version``. Cada migração roda dentro de uma
+transação junto com a atualização da versão, então um banco nunca fica "meio migrado".
+Para alterar o schema, acrescente uma nova função ao final de MIGRATIONS; nunca edite
+uma migração que já foi publicada.
+"""
+import sqlite3
+
+
+def _columns(conn, table):
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def _add_column_if_not_exists(conn, table, column, col_type):
+    if column not in _columns(conn, table):
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {col_type}")
+
+
+def _001_schema_base(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT UNIQUE NOT NULL,
+        password_hash TEXT NOT NULL,
+        stripe_customer_id TEXT NULL,
+        subscription_status TEXT DEFAULT 'inactive'
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS chat_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        session_id TEXT NOT NULL,
+        role TEXT NOT NULL, -- 'user', 'assistant', 'system', 'tool'
+        user_message TEXT NULL, -- Mensagem original do usuário (se role='user')
+        ai_response TEXT NULL, -- Resposta final do assistente (se role='assistant' e sem tool call)
+        model_used TEXT NULL,
+        context_used BOOLEAN DEFAULT 0,
+        uploaded_file_path TEXT NULL,
+        tool_call_id TEXT NULL, -- ID da chamada de ferramenta (se role='tool' ou role='assistant' com tool_calls)
+        tool_call_info TEXT NULL, -- JSON das tool_calls (se role='assistant') ou nome da função (se role='tool')
+        tool_response_content TEXT NULL, -- Conteúdo da resposta da ferramenta (se role='tool')
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )
+    """)
+    # Bancos criados pelas versões antigas do init_db não têm as colunas de function calling
+    _add_column_if_not_exists(conn, "chat_history", "role", "TEXT NOT NULL DEFAULT 'user'")
+    _add_column_if_not_exists(conn, "chat_history", "tool_call_id", "TEXT NULL")
+    _add_column_if_not_exists(conn, "chat_history", "tool_call_info", "TEXT NULL")
+    _add_column_if_not_exists(conn, "chat_history", "tool_response_content", "TEXT NULL")
+
+
+def _002_sessions(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS sessions (
+        id TEXT PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        session_name TEXT,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )
+    """)
+
+
+def _003_chat_history_indexes(conn):
+    # Histórico de uma sessão (send_message e /api/chat/history?session_id=...):
+    # filtra por user_id + session_id e ordena por timestamp sem ordenação temporária
+    conn.execute("""
+    CREATE INDEX IF NOT EXISTS idx_chat_history_user_session_ts
+    ON chat_history (user_id, session_id, timestamp, id)
+    """)
+    # Histórico completo do usuário (/api/chat/history sem filtro)
+    conn.execute("""
+    CREATE INDEX IF NOT EXISTS idx_chat_history_user_ts
+    ON chat_history (user_id, timestamp, id)
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions (user_id)")
+
+
+def _004_session_summaries(conn):
+    # Resumo por sessão para listar conversas sem varrer chat_history
+    _add_column_if_not_exists(conn, "sessions", "last_message_at", "TIMESTAMP NULL")
+    _add_column_if_not_exists(conn, "sessions", "last_message_preview", "TEXT NULL")
+    _add_column_if_not_exists(conn, "sessions", "message_count", "INTEGER NOT NULL DEFAULT 0")
+    conn.execute("""
+    INSERT OR IGNORE INTO sessions (id, user_id, created_at)
+    SELECT session_id, MIN(user_id), MIN(timestamp) FROM chat_history GROUP BY session_id
+    """)
+    conn.execute("""
+    UPDATE sessions SET
+        message_count = (SELECT COUNT(*) FROM chat_history h WHERE h.session_id = sessions.id),
+        last_message_at = (SELECT MAX(h.timestamp) FROM chat_history h WHERE h.session_id = sessions.id),
+        last_message_preview = (
+            SELECT substr(COALESCE(h.ai_response, h.user_message), 1, 120) FROM chat_history h
+            WHERE h.session_id = sessions.id AND COALESCE(h.ai_response, h.user_message) IS NOT NULL
+            ORDER BY h.timestamp DESC, h.id DESC LIMIT 1
+        )
+    """)
+    conn.execute("DROP INDEX IF EXISTS idx_sessions_user")
+    conn.execute("""
+    CREATE INDEX IF NOT EXISTS idx_sessions_user_last_message
+    ON sessions (user_id, last_message_at, id)
+    """)
+
+
+def _005_token_counts(conn):
+    # Tokens de cada entrada do histórico (calculados ao gravar; NULL = ainda não calculado)
+    _add_column_if_not_exists(conn, "chat_history", "token_count", "INTEGER NULL")
+
+
+def _006_session_summaries_table(conn):
+    # Resumo incremental das mensagens antigas de cada sessão (até covered_until_id)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS session_summaries (
+        session_id TEXT PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        summary TEXT NOT NULL,
+        covered_until_id INTEGER NOT NULL, -- Último chat_history.id incorporado ao resumo
+        token_count INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )
+    """)
+
+
+def _007_uploads(conn):
+    # Arquivos enviados e o texto extraído deles, dividido em trechos
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS uploads (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        file_path TEXT NOT NULL UNIQUE, -- Relativo a UPLOAD_FOLDER (user_id/arquivo)
+        original_name TEXT NOT NULL,
+        content_type TEXT NULL,
+        file_type TEXT NOT NULL, -- 'pdf', 'text', 'csv', 'json', 'binary'
+        encoding TEXT NULL,
+        size_bytes INTEGER NOT NULL,
+        sha256 TEXT NOT NULL,
+        status TEXT NOT NULL, -- 'ready', 'unsupported', 'failed'
+        error TEXT NULL,
+        chunk_count INTEGER NOT NULL DEFAULT 0,
+        char_count INTEGER NOT NULL DEFAULT 0,
+        truncated BOOLEAN NOT NULL DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_uploads_user ON uploads (user_id, created_at)")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS upload_chunks (
+        upload_id INTEGER NOT NULL,
+        chunk_index INTEGER NOT NULL,
+        char_start INTEGER NOT NULL,
+        content TEXT NOT NULL,
+        token_count INTEGER NOT NULL,
+        PRIMARY KEY (upload_id, chunk_index),
+        FOREIGN KEY (upload_id) REFERENCES uploads (id)
+    ) WITHOUT ROWID
+    """)
+
+
+def _008_blobs(conn):
+    # Extração guardada por conteúdo (sha256): uploads iguais reaproveitam os trechos.
+    # As colunas de extração em uploads continuam preenchidas (cópia), mas a fonte é blobs.
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS blobs (
+        sha256 TEXT PRIMARY KEY,
+        size_bytes INTEGER NOT NULL,
+        file_type TEXT NOT NULL,
+        encoding TEXT NULL,
+        status TEXT NOT NULL, -- 'ready', 'unsupported', 'failed'
+        error TEXT NULL,
+        chunk_count INTEGER NOT NULL DEFAULT 0,
+        char_count INTEGER NOT NULL DEFAULT 0,
+        truncated BOOLEAN NOT NULL DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    ) WITHOUT ROWID
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS blob_chunks (
+        sha256 TEXT NOT NULL,
+        chunk_index INTEGER NOT NULL,
+        char_start INTEGER NOT NULL,
+        content TEXT NOT NULL,
+        token_count INTEGER NOT NULL,
+        PRIMARY KEY (sha256, chunk_index),
+        FOREIGN KEY (sha256) REFERENCES blobs (sha256)
+    ) WITHOUT ROWID
+    """)
+    # Um upload por conteúdo vira a extração guardada (de preferência um que foi lido com sucesso)
+    conn.execute("""
+    INSERT OR IGNORE INTO blobs (sha256, size_bytes, file_type, encoding, status, error, chunk_count, char_count, truncated, created_at)
+    SELECT sha256, size_bytes, file_type, encoding, status, error, chunk_count, char_count, truncated, created_at
+    FROM uploads ORDER BY status = 'ready' DESC, id
+    """)
+    conn.execute("""
+    INSERT OR IGNORE INTO blob_chunks (sha256, chunk_index, char_start, content, token_count)
+    SELECT u.sha256, c.chunk_index, c.char_start, c.content, c.token_count
+    FROM upload_chunks c JOIN uploads u ON u.id = c.upload_id
+    WHERE u.id = (SELECT MIN(id) FROM uploads WHERE sha256 = u.sha256 AND status = 'ready')
+    """)
+    conn.execute("DROP TABLE upload_chunks")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_uploads_sha256 ON uploads (sha256)")
+
+
+MIGRATIONS = [
+    _001_schema_base,
+    _002_sessions,
+    _003_chat_history_indexes,
+    _004_session_summaries,
+    _005_token_counts,
+    _006_session_summaries_table,
+    _007_uploads,
+    _008_blobs,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def run_migrations(conn):
+    """Aplica as migrações pendentes e retorna a lista de versões aplicadas."""
+    applied = []
+    current = schema_version(conn)
+    for version, migration in enumerate(MIGRATIONS, start=1):
+        if version <= current:
+            continue
+        conn.execute("BEGIN IMMEDIATE") # Outro processo pode estar migrando ao mesmo tempo
+        try:
+            if schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        applied.append(version)
+    return applied
+
+
+def explain_query_plan(conn, sql, params=()):
+    """Retorna as linhas de EXPLAIN QUERY PLAN (coluna "detail") para um comando."""
+    return [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
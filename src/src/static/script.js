@@ -20,20 +20,23 @@ document.addEventListener("DOMContentLoaded", () => {
         attachButton.disabled = isLoading;
     }
 
+    function formatContent(content) {
+        // Usa uma biblioteca de Markdown (como Marked.js ou Showdown.js) se quiser formatação rica
+        // Por simplicidade, vamos apenas substituir novas linhas por <br> e detectar blocos de código simples
+        return content
+            .replace(/</g, "&lt;").replace(/>/g, "&gt;") // Escapa HTML básico
+            .replace(/\n/g, "<br>")
+            .replace(/```([\s\S]*?)```/g, (match, code) => `<pre><code>${code.trim()}</code></pre>`) // Blocos de código
+            .replace(/`([^`]+)`/g, `<code>$1</code>`); // Código inline
+    }
+
     function displayMessage(role, content, model = null, timestamp = null, filePath = null) {
         const messageDiv = document.createElement("div");
         messageDiv.classList.add("message", role);
 
         let messageHTML = "";
         if (role === "user" || role === "ai") {
-            // Usa uma biblioteca de Markdown (como Marked.js ou Showdown.js) se quiser formatação rica
-            // Por simplicidade, vamos apenas substituir novas linhas por <br> e detectar blocos de código simples
-            const formattedContent = content
-                .replace(/</g, "&lt;").replace(/>/g, "&gt;") // Escapa HTML básico
-                .replace(/\n/g, "<br>")
-                .replace(/```([\s\S]*?)```/g, (match, code) => `<pre><code>${code.trim()}</code></pre>`) // Blocos de código
-                .replace(/`([^`]+)`/g, `<code>$1</code>`); // Código inline
-            messageHTML = formattedContent;
+            messageHTML = formatContent(content);
         } else {
             messageHTML = content; // Para system/error messages
         }
@@ -61,6 +64,7 @@ document.addEventListener("DOMContentLoaded", () => {
 
         chatHistory.appendChild(messageDiv);
         scrollToBottom();
+        return messageDiv;
     }
 
     function scrollToBottom() {
@@ -92,25 +96,84 @@ document.addEventListener("DOMContentLoaded", () => {
     }
 
     // --- Carregar Histórico ---
+    let olderCursor = null; // Cursor (X-Before-Cursor) para buscar mensagens anteriores da sessão
+
+    function renderHistoryMessage(msg) {
+        // Adapta para a nova estrutura do DB
+        if (msg.role === "user") {
+            return displayMessage("user", msg.user_message || "", null, msg.timestamp, msg.uploaded_file_path);
+        } else if (msg.role === "assistant" && msg.ai_response) {
+            return displayMessage("ai", msg.ai_response, msg.model_used, msg.timestamp);
+        } // Ignora roles system/tool na exibição por enquanto
+        return null;
+    }
+
+    async function fetchHistoryPage(sessionId, before = null) {
+        const params = new URLSearchParams({ session_id: sessionId });
+        if (before) {
+            params.set("before", before);
+        }
+        const response = await fetch(`/api/chat/history?${params}`);
+        if (!response.ok) {
+            throw new Error(`Erro ao carregar histórico: ${response.statusText}`);
+        }
+        return { messages: await response.json(), before: response.headers.get("X-Before-Cursor") };
+    }
+
+    function updateOlderButton() {
+        let button = document.getElementById("load-older-button");
+        if (!olderCursor) {
+            if (button) button.remove();
+            return;
+        }
+        if (!button) {
+            button = document.createElement("button");
+            button.id = "load-older-button";
+            button.classList.add("load-older-button");
+            button.textContent = "Carregar mensagens anteriores";
+            button.addEventListener("click", loadOlderMessages);
+            chatHistory.prepend(button);
+        }
+    }
+
+    async function loadOlderMessages() {
+        const button = document.getElementById("load-older-button");
+        button.disabled = true;
+        try {
+            const page = await fetchHistoryPage(currentSessionId, olderCursor);
+            const anchor = button.nextSibling;
+            const previousHeight = chatHistory.scrollHeight;
+            page.messages.forEach(msg => {
+                const element = renderHistoryMessage(msg);
+                if (element) chatHistory.insertBefore(element, anchor); // Move para antes das mensagens já exibidas
+            });
+            chatHistory.scrollTop = chatHistory.scrollHeight - previousHeight; // Mantém a posição de leitura
+            olderCursor = page.before;
+        } catch (error) {
+            console.error("Erro ao carregar mensagens anteriores:", error);
+            displayMessage("error-message", `Falha ao carregar mensagens anteriores: ${error.message}`);
+        } finally {
+            button.disabled = false;
+            updateOlderButton();
+        }
+    }
+
     async function loadHistory() {
         showLoading(true);
         try {
-            const response = await fetch("/api/chat/history"); // Carrega todo o histórico por enquanto
+            // Retoma a sessão mais recente, carregando só a última página dela
+            const response = await fetch("/api/chat/sessions?limit=1");
             if (!response.ok) {
                 throw new Error(`Erro ao carregar histórico: ${response.statusText}`);
             }
-            const history = await response.json();
+            const sessions = await response.json();
             chatHistory.innerHTML = ""; // Limpa mensagens de carregamento
-            if (history.length > 0) {
-                currentSessionId = history[history.length - 1].session_id; // Pega o ID da última sessão
-                history.forEach(msg => {
-                    // Adapta para a nova estrutura do DB
-                    if (msg.role === "user") {
-                        displayMessage("user", msg.user_message, null, msg.timestamp, msg.uploaded_file_path);
-                    } else if (msg.role === "assistant") {
-                        displayMessage("ai", msg.ai_response, msg.model_used, msg.timestamp);
-                    } // Ignora roles system/tool na exibição por enquanto
-                });
+            if (sessions.length > 0) {
+                currentSessionId = sessions[0].session_id;
+                const page = await fetchHistoryPage(currentSessionId);
+                page.messages.forEach(renderHistoryMessage);
+                olderCursor = page.before;
+                updateOlderButton();
                 displayMessage("system-message", "Histórico carregado.");
             } else {
                 displayMessage("system-message", "Nenhuma conversa anterior encontrada. Comece uma nova!");
@@ -168,35 +231,35 @@ document.addEventListener("DOMContentLoaded", () => {
         adjustTextareaHeight();
         removeAttachment(); // Limpa anexo após envio
 
-        // 2. Envia a mensagem (e o caminho do arquivo, se houver) para a IA
+        // 2. Envia a mensagem (e o caminho do arquivo, se houver) para a IA, recebendo a resposta em streaming (SSE)
         try {
             const response = await fetch("/api/chat/send", {
                 method: "POST",
                 headers: {
                     "Content-Type": "application/json",
+                    "Accept": "text/event-stream",
                 },
                 body: JSON.stringify({
                     message: messageText,
                     model: selectedModel,
                     session_id: currentSessionId,
-                    uploaded_file_path: filePathToSend
+                    uploaded_file_path: filePathToSend,
+                    stream: true
                 }),
             });
 
-            const result = await response.json();
-
-            if (!response.ok) {
+            if (!response.ok || !(response.headers.get("Content-Type") || "").startsWith("text/event-stream")) {
+                const result = await response.json();
                 throw new Error(result.error || `Erro ${response.status}: ${response.statusText}`);
             }
 
+            const result = await readChatStream(response);
+
             // Atualiza o session ID se for a primeira mensagem da sessão
             if (!currentSessionId) {
                 currentSessionId = result.session_id;
             }
 
-            // Exibe a resposta da IA
-            displayMessage("ai", result.ai_response, result.model_used, result.timestamp);
-
         } catch (error) {
             console.error("Erro ao enviar/receber mensagem:", error);
             displayMessage("error-message", `Erro: ${error.message}`);
@@ -205,6 +268,75 @@ document.addEventListener("DOMContentLoaded", () => {
         }
     }
 
+    // --- Streaming (SSE) ---
+    async function readChatStream(response) {
+        // Lê os eventos "token", "tool", "done" e "error" e vai atualizando a mensagem da IA na tela
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = "";
+        let aiText = "";
+        let aiDiv = null;
+        let statusDiv = null;
+
+        const handleEvent = (event, data) => {
+            if (event === "token") {
+                if (!aiDiv) {
+                    showLoading(false); // Primeiro token: some o indicador, começa a resposta
+                    aiDiv = displayMessage("ai", "");
+                }
+                aiText += data.content;
+                aiDiv.innerHTML = formatContent(aiText);
+                scrollToBottom();
+            } else if (event === "tool") {
+                if (aiDiv) {
+                    // Texto de uma rodada que terminou pedindo ferramentas não é salvo como resposta:
+                    // descarta para a tela ficar igual ao histórico recarregado
+                    aiDiv.remove();
+                    aiDiv = null;
+                    aiText = "";
+                }
+                if (!statusDiv) {
+                    statusDiv = displayMessage("system-message", "");
+                }
+                statusDiv.textContent = data.status === "running" ? `Executando ${data.name}...` : `${data.name} concluída.`;
+            } else if (event === "error") {
+                throw new Error(data.error);
+            } else if (event === "done") {
+                if (!aiDiv) {
+                    aiDiv = displayMessage("ai", data.ai_response || "");
+                } else {
+                    aiDiv.innerHTML = formatContent(data.ai_response || ""); // O texto salvo é o que vale
+                }
+                const modelSpan = document.createElement("span");
+                modelSpan.classList.add("model-info");
+                modelSpan.textContent = `(${data.model_used})`;
+                aiDiv.appendChild(modelSpan);
+                return data;
+            }
+            return null;
+        };
+
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            let boundary;
+            while ((boundary = buffer.indexOf("\n\n")) !== -1) {
+                const block = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+                let event = "message";
+                let data = "";
+                block.split("\n").forEach(line => {
+                    if (line.startsWith("event: ")) event = line.slice(7);
+                    else if (line.startsWith("data: ")) data += line.slice(6);
+                });
+                const result = handleEvent(event, data ? JSON.parse(data) : {});
+                if (result) return result;
+            }
+        }
+        throw new Error("Conexão encerrada antes do fim da resposta");
+    }
+
     // --- Event Listeners ---
     sendButton.addEventListener("click", sendMessage);
     messageInput.addEventListener("keydown", (e) => {
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""Contagem de tokens para montar o contexto enviado à IA.
+
+Usa o tokenizer do modelo (tiktoken) quando disponível. Sem tiktoken, ou sem acesso aos
+arquivos de encoding, cai numa estimativa conservadora de ~4 bytes UTF-8 por token.
+"""
+import math
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError: # Dependência opcional
+    tiktoken = None
+
+DEFAULT_MODEL = "gpt-4o"
+DEFAULT_ENCODING = "o200k_base" # Encoding dos modelos gpt-4o/gpt-4.1/o*
+MESSAGE_OVERHEAD = 4 # Tokens de formatação de cada mensagem (role e separadores)
+
+
+@lru_cache(maxsize=16)
+def _encoding(model):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        # Modelo que o tiktoken ainda não conhece
+        return _default_encoding()
+    except Exception as e:
+        print(f"Tokenizer indisponível para {model}, usando estimativa: {e}")
+        return None
+
+
+@lru_cache(maxsize=1)
+def _default_encoding():
+    try:
+        return tiktoken.get_encoding(DEFAULT_ENCODING)
+    except Exception as e:
+        print(f"Tokenizer indisponível, usando estimativa: {e}")
+        return None
+
+
+def count_tokens(text, model=None):
+    """Número de tokens de um texto para o modelo informado."""
+    if not text:
+        return 0
+    encoding = _encoding(model or DEFAULT_MODEL)
+    if encoding is None:
+        return math.ceil(len(text.encode("utf-8")) / 4)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(text, model=None):
+    """Tokens de uma mensagem do chat (conteúdo + overhead de formatação)."""
+    return count_tokens(text, model) + MESSAGE_OVERHEAD
+
+
+def truncate_tokens(text, max_tokens, model=None):
+    """Corta o texto para caber em max_tokens (pela mesma contagem de count_tokens)."""
+    if count_tokens(text, model) <= max_tokens:
+        return text
+    encoding = _encoding(model or DEFAULT_MODEL)
+    if encoding is None:
+        return text.encode("utf-8")[:max_tokens * 4].decode("utf-8", errors="ignore")
+    return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
@@ -13,7 +13,8 @@ os.environ["OPENAI_API_KEY"] = "dummy_key_for_testing"
 
 # Agora importa o app de src.main
 from src.main import app as flask_app
-from src.main import get_db # Importa get_db
+from src.main import get_db, close_db_connections, user_cache, user_ids_by_username # Importa get_db
+from src.migrations import run_migrations
 
 @pytest.fixture
 def app(monkeypatch):
@@ -30,53 +31,29 @@ def app(monkeypatch):
         "SECRET_KEY": "test_secret_key", # Chave fixa para testes
         "WTF_CSRF_ENABLED": False, # Desabilita CSRF para testes de formulário mais fáceis
         "UPLOAD_FOLDER": os.path.join(instance_path, "uploads"),
-        "INSTANCE_PATH": instance_path # Define o instance_path explicitamente
+        "INSTANCE_PATH": instance_path, # Define o instance_path explicitamente
+        "EMBEDDINGS_FOLDER": os.path.join(instance_path, "embeddings"),
+        "EMBEDDING_PROVIDER": "hashing", # Embeddings locais e determinísticos, sem chamar a API
+        "RETRIEVAL_ENABLED": False # Os testes de recuperação ligam explicitamente (evita indexação em segundo plano)
     })
 
     # Garante que a pasta de uploads exista dentro da instance temporária
     os.makedirs(flask_app.config["UPLOAD_FOLDER"], exist_ok=True)
 
-    # Cria as tabelas do banco de dados
-    try:
-        with flask_app.app_context():
-            conn = get_db()
-            cursor = conn.cursor()
-            # Replicando lógica simplificada de init_db.py
-            cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                stripe_customer_id TEXT NULL,
-                subscription_status TEXT DEFAULT 'inactive'
-            );
-            """)
-            cursor.execute("""
-            CREATE TABLE IF NOT EXISTS chat_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                session_id TEXT NOT NULL,
-                role TEXT NOT NULL, 
-                user_message TEXT NULL, 
-                ai_response TEXT NULL, 
-                model_used TEXT NULL,
-                context_used BOOLEAN DEFAULT 0,
-                uploaded_file_path TEXT NULL,
-                tool_call_id TEXT NULL, 
-                tool_call_info TEXT NULL, 
-                tool_response_content TEXT NULL, 
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            );
-            """)
-            conn.commit()
-            conn.close()
-    except Exception as e:
-        print(f"Erro ao inicializar DB no teste: {e}")
+    # Cada teste tem um banco novo: usuários em cache de um teste anterior não valem mais
+    user_cache.clear()
+    user_ids_by_username.clear()
+
+    # Cria as tabelas do banco de dados com as mesmas migrações do app
+    with flask_app.app_context():
+        conn = get_db()
+        run_migrations(conn)
+        conn.close()
 
     yield flask_app
 
     # Limpeza após o teste
+    close_db_connections() # Libera as conexões do pool antes de apagar o arquivo
     os.close(db_fd)
     os.unlink(db_path)
     import shutil
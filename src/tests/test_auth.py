@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import pytest
+from unittest.mock import MagicMock
 from flask import session, url_for
+from src.main import User, get_db
 
 # Testes de Autenticação
 def test_register(client, app):
@@ -64,3 +66,41 @@ def test_login_invalid_credentials(client, app):
     assert b"Usu\xc3\xa1rio ou senha inv\xc3\xa1lidos." in response.data
     assert b"Login" in response.data
 
+
+# Testes do cache de usuários e da checagem de assinatura
+
+def test_user_cache_avoids_queries_and_invalidates_on_update(app):
+    """Testa se o usuário vem do cache e se update_stripe_info descarta a entrada."""
+    with app.app_context():
+        conn = get_db()
+        conn.execute("INSERT INTO users (username, password_hash) VALUES ('cacheado', 'x')")
+        conn.commit()
+        conn.close()
+        user = User.get_by_username("cacheado")
+        assert not hasattr(user, "__dict__") # __slots__
+        assert User.get_by_id(user.id) is user
+        assert User.get_by_username("cacheado") is user
+
+        User.update_stripe_info(str(user.id), subscription_status="active") # O webhook passa o id como texto
+        updated = User.get_by_id(user.id)
+        assert updated is not user
+        assert updated.subscription_status == "active"
+
+def test_send_requires_active_subscription(client, app, mocker):
+    """Testa o bloqueio opcional do chat (402) até o webhook ativar a assinatura."""
+    mocker.patch.dict(app.config, {"REQUIRE_SUBSCRIPTION": True})
+    client.post("/register", data={"username": "assinante", "password": "password"})
+    client.post("/login", data={"username": "assinante", "password": "password"})
+    response = client.post("/api/chat/send", json={"message": "Olá"})
+    assert response.status_code == 402
+
+    with client.session_transaction() as sess:
+        user_id = sess["user_id"]
+    with app.app_context():
+        User.update_stripe_info(str(user_id), subscription_status="active")
+    ai_response = MagicMock()
+    ai_response.choices = [MagicMock()]
+    ai_response.choices[0].message.content = "Oi!"
+    ai_response.choices[0].message.tool_calls = None
+    mocker.patch("src.main.client.chat.completions.create", return_value=ai_response)
+    assert client.post("/api/chat/send", json={"message": "Olá"}).status_code == 200
@@ -6,7 +6,7 @@ from unittest.mock import patch, MagicMock
 from flask import session, url_for
 
 # Importa get_db diretamente
-from src.main import get_db, available_functions # Importa available_functions
+from src.main import get_db, available_functions, MetricsConnection # Importa available_functions
 
 # Testes da API do Chat e Integração com IA (mocked)
 
@@ -255,3 +255,280 @@ def test_send_message_with_upload(auth_client, mocker, app):
             conn.close()
             assert user_entry["uploaded_file_path"] == uploaded_file_path
 
+
+@pytest.mark.usefixtures("auth_client")
+def test_turn_is_written_in_one_transaction(auth_client, mocker):
+    """Testa se as entradas de um turno com ferramenta são gravadas com um único commit."""
+    openai_mock = mocker.patch("src.main.client.chat.completions.create")
+    openai_mock.side_effect = [mock_openai_tool_call_request, mock_openai_final_response_after_tool]
+    mocker.patch.dict(available_functions, {"fazer_requisicao_http": MagicMock(return_value=mock_http_response_success)})
+    executemany_spy = mocker.spy(MetricsConnection, "executemany")
+
+    response = auth_client.post("/api/chat/send", json={"message": "GET", "model": "gpt-4o", "session_id": None})
+
+    assert response.status_code == 200
+    assert executemany_spy.call_count == 1
+    assert len(executemany_spy.call_args.args[2]) == 4 # user, assistant[tool_call], tool, assistant[final]
+
+@pytest.mark.usefixtures("auth_client")
+def test_user_message_saved_when_openai_fails(auth_client, mocker):
+    """Testa se a mensagem do usuário é registrada mesmo quando a chamada à OpenAI falha."""
+    mocker.patch("src.main.client.chat.completions.create", side_effect=RuntimeError("timeout"))
+
+    response = auth_client.post("/api/chat/send", json={"message": "Vai falhar", "model": "gpt-4o", "session_id": "sessao-falha"})
+
+    assert response.status_code == 500
+    with auth_client.application.app_context():
+        conn = get_db()
+        rows = conn.execute("SELECT role, user_message FROM chat_history WHERE session_id = ?", ("sessao-falha",)).fetchall()
+        conn.close()
+    assert [(row["role"], row["user_message"]) for row in rows] == [("user", "Vai falhar")]
+
+@pytest.mark.usefixtures("auth_client")
+def test_chat_history_keyset_pagination(auth_client, mocker):
+    """Testa a paginação do histórico com os cursores before/after."""
+    mocker.patch("src.main.client.chat.completions.create", return_value=mock_openai_simple_response)
+    session_id = None
+    for i in range(3): # 6 entradas (user + assistant por mensagem)
+        resp = auth_client.post("/api/chat/send", json={"message": f"Msg {i}", "model": "gpt-4o", "session_id": session_id})
+        session_id = resp.get_json()["session_id"]
+
+    latest = auth_client.get(f"/api/chat/history?session_id={session_id}&limit=4")
+    assert [row["user_message"] for row in latest.get_json() if row["role"] == "user"] == ["Msg 1", "Msg 2"]
+    assert "X-After-Cursor" not in latest.headers
+
+    older = auth_client.get(f"/api/chat/history?session_id={session_id}&limit=4&before={latest.headers['X-Before-Cursor']}")
+    assert [row["user_message"] for row in older.get_json() if row["role"] == "user"] == ["Msg 0"]
+    assert "X-Before-Cursor" not in older.headers
+
+    newer = auth_client.get(f"/api/chat/history?session_id={session_id}&limit=4&after={older.headers['X-After-Cursor']}")
+    assert [row["id"] for row in newer.get_json()] == [row["id"] for row in latest.get_json()]
+
+    assert auth_client.get("/api/chat/history?before=nao-e-cursor").status_code == 400
+
+@pytest.mark.usefixtures("auth_client")
+def test_list_chat_sessions(auth_client, mocker):
+    """Testa a lista de sessões com o resumo da última mensagem."""
+    mocker.patch("src.main.client.chat.completions.create", return_value=mock_openai_simple_response)
+    auth_client.post("/api/chat/send", json={"message": "Primeira", "model": "gpt-4o", "session_id": "sessao-a"})
+    auth_client.post("/api/chat/send", json={"message": "Segunda", "model": "gpt-4o", "session_id": "sessao-a"})
+    auth_client.post("/api/chat/send", json={"message": "Outra", "model": "gpt-4o", "session_id": "sessao-b"})
+
+    response = auth_client.get("/api/chat/sessions?limit=1")
+    assert response.status_code == 200
+    sessions = response.get_json()
+    assert len(sessions) == 1
+    more = auth_client.get(f"/api/chat/sessions?limit=1&before={response.headers['X-Before-Cursor']}").get_json()
+    by_id = {s["session_id"]: s for s in sessions + more}
+    assert by_id["sessao-a"]["message_count"] == 4
+    assert by_id["sessao-a"]["last_message_preview"] == "Esta é uma resposta simples da IA."
+    assert by_id["sessao-b"]["message_count"] == 2
+
+# --- Streaming (SSE) ---
+def make_chunk(content=None, tool_calls=None):
+    """Cria um chunk de stream da OpenAI (mocked)."""
+    chunk = MagicMock()
+    chunk.choices = [MagicMock()]
+    chunk.choices[0].delta.content = content
+    chunk.choices[0].delta.tool_calls = tool_calls
+    return chunk
+
+def make_tool_delta(index, id=None, name=None, arguments=None):
+    delta = MagicMock()
+    delta.index = index
+    delta.id = id
+    delta.function.name = name
+    delta.function.arguments = arguments
+    return delta
+
+def parse_sse(body):
+    events = []
+    for block in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+@pytest.mark.usefixtures("auth_client")
+def test_send_message_stream(auth_client, mocker):
+    """Testa o envio com stream=true: tokens via SSE e resposta final salva no DB."""
+    openai_mock = mocker.patch("src.main.client.chat.completions.create")
+    openai_mock.return_value = iter([make_chunk("Olá"), make_chunk(", mundo"), make_chunk(None)])
+
+    response = auth_client.post("/api/chat/send", json={"message": "Oi", "model": "gpt-4o", "session_id": "sessao-stream", "stream": True})
+
+    assert response.status_code == 200
+    assert response.mimetype == "text/event-stream"
+    events = parse_sse(response.get_data(as_text=True))
+    assert [data["content"] for event, data in events if event == "token"] == ["Olá", ", mundo"]
+    event, done = events[-1]
+    assert event == "done"
+    assert done.pop("rounds")[0]["tool_calls"] == 0
+    assert done == {"ai_response": "Olá, mundo", "session_id": "sessao-stream", "model_used": "gpt-4o", "user_message": "Oi", "uploaded_file_path": None}
+    assert openai_mock.call_args.kwargs["stream"] is True
+
+    history = auth_client.get("/api/chat/history?session_id=sessao-stream").get_json()
+    assert [(row["role"], row["ai_response"]) for row in history] == [("user", None), ("assistant", "Olá, mundo")]
+
+@pytest.mark.usefixtures("auth_client")
+def test_send_message_stream_with_tool_call(auth_client, mocker):
+    """Testa o stream com deltas de tool_call acumulados e a segunda chamada também em stream."""
+    openai_mock = mocker.patch("src.main.client.chat.completions.create")
+    openai_mock.side_effect = [
+        iter([
+            make_chunk(tool_calls=[make_tool_delta(0, id="call_1", name="fazer_requisicao_http", arguments='{"url": "https://exe')]),
+            make_chunk(tool_calls=[make_tool_delta(0, arguments='mplo.com/api"}')]),
+        ]),
+        iter([make_chunk("Feito.")]),
+    ]
+    mock_http_func = MagicMock(return_value=mock_http_response_success)
+    mocker.patch.dict(available_functions, {"fazer_requisicao_http": mock_http_func})
+
+    response = auth_client.post("/api/chat/send", json={"message": "GET", "model": "gpt-4o", "session_id": "sessao-tool", "stream": True})
+
+    events = parse_sse(response.get_data(as_text=True))
+    mock_http_func.assert_called_once_with(url="https://exemplo.com/api", method="GET", headers=None, payload=None)
+    assert ("tool", {"name": "fazer_requisicao_http", "status": "done"}) in events
+    assert events[-1][0] == "done" and events[-1][1]["ai_response"] == "Feito."
+    second_messages = openai_mock.call_args_list[1].kwargs["messages"]
+    assert second_messages[-1] == {"tool_call_id": "call_1", "role": "tool", "content": mock_http_response_success}
+
+    history = auth_client.get("/api/chat/history?session_id=sessao-tool").get_json()
+    assert [row["role"] for row in history] == ["user", "assistant", "tool", "assistant"]
+
+# --- Ferramentas em paralelo ---
+def make_tool_call_response(*urls):
+    """Resposta da OpenAI (mocked) pedindo uma chamada de fazer_requisicao_http por URL."""
+    tool_calls = []
+    for i, url in enumerate(urls):
+        tc = MagicMock()
+        tc.id = f"call_{i}"
+        tc.type = "function"
+        tc.function.name = "fazer_requisicao_http"
+        tc.function.arguments = json.dumps({"url": url})
+        tc.model_dump.return_value = {"id": tc.id, "type": "function", "function": {"name": tc.function.name, "arguments": tc.function.arguments}}
+        tool_calls.append(tc)
+    response = MagicMock()
+    response.choices = [MagicMock()]
+    response.choices[0].message.content = None
+    response.choices[0].message.tool_calls = tool_calls
+    return response
+
+@pytest.mark.usefixtures("auth_client")
+def test_tool_calls_run_in_parallel_in_order(auth_client, mocker):
+    """Testa se várias ferramentas do mesmo turno rodam em paralelo e voltam na ordem original."""
+    import time
+    openai_mock = mocker.patch("src.main.client.chat.completions.create")
+    openai_mock.side_effect = [make_tool_call_response("https://a.test", "https://b.test", "https://c.test"), mock_openai_final_response_after_tool]
+
+    def slow_http(url, method, headers, payload):
+        time.sleep(0.4 if url.endswith("a.test") else 0.2) # A primeira termina por último
+        return f"Status: 200\nResultado:\n{url}"
+    mocker.patch.dict(available_functions, {"fazer_requisicao_http": slow_http})
+
+    started = time.monotonic()
+    response = auth_client.post("/api/chat/send", json={"message": "Três GETs", "model": "gpt-4o", "session_id": None})
+    elapsed = time.monotonic() - started
+
+    assert response.status_code == 200
+    assert elapsed < 0.75 # Sequencial levaria 0.8s
+    tool_messages = [m for m in openai_mock.call_args_list[1].kwargs["messages"] if isinstance(m, dict) and m.get("role") == "tool"]
+    assert [(m["tool_call_id"], m["content"].split("\n")[-1]) for m in tool_messages] == [
+        ("call_0", "https://a.test"), ("call_1", "https://b.test"), ("call_2", "https://c.test")
+    ]
+
+@pytest.mark.usefixtures("auth_client")
+def test_tool_calls_respect_turn_deadline(auth_client, app, mocker):
+    """Testa se uma ferramenta que estoura o prazo do turno vira erro sem travar a resposta."""
+    import threading
+    mocker.patch.dict(app.config, {"TOOL_TURN_DEADLINE_SECONDS": 0.2})
+    release = threading.Event()
+    openai_mock = mocker.patch("src.main.client.chat.completions.create")
+    openai_mock.side_effect = [make_tool_call_response("https://lenta.test", "https://rapida.test"), mock_openai_final_response_after_tool]
+
+    def http(url, method, headers, payload):
+        if "lenta" in url:
+            release.wait(5)
+        return "Status: 200"
+    mocker.patch.dict(available_functions, {"fazer_requisicao_http": http})
+
+    try:
+        response = auth_client.post("/api/chat/send", json={"message": "GET", "model": "gpt-4o", "session_id": None})
+    finally:
+        release.set()
+
+    assert response.status_code == 200
+    tool_messages = [m for m in openai_mock.call_args_list[1].kwargs["messages"] if isinstance(m, dict) and m.get("role") == "tool"]
+    assert "excedeu o prazo" in tool_messages[0]["content"]
+    assert tool_messages[1]["content"] == "Status: 200"
+
+# --- Loop de ferramentas com orçamento ---
+@pytest.mark.usefixtures("auth_client")
+def test_agent_loop_runs_follow_up_tool_rounds(auth_client, mocker):
+    """Testa se a IA pode pedir uma nova ferramenta depois de ver o resultado da primeira."""
+    openai_mock = mocker.patch("src.main.client.chat.completions.create")
+    openai_mock.side_effect = [
+        make_tool_call_response("https://api.test/listas"),
+        make_tool_call_response("https://api.test/tarefas"),
+        mock_openai_final_response_after_tool,
+    ]
+    mock_http_func = MagicMock(return_value=mock_http_response_success)
+    mocker.patch.dict(available_functions, {"fazer_requisicao_http": mock_http_func})
+
+    response = auth_client.post("/api/chat/send", json={"message": "Tarefas da lista X", "model": "gpt-4o", "session_id": "sessao-loop"})
+
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data["ai_response"] == "A requisição para https://exemplo.com/api foi bem-sucedida."
+    assert [r["tool_calls"] for r in data["rounds"]] == [1, 1, 0]
+    assert openai_mock.call_count == 3
+    assert mock_http_func.call_count == 2
+    history = auth_client.get("/api/chat/history?session_id=sessao-loop").get_json()
+    assert [row["role"] for row in history] == ["user", "assistant", "tool", "assistant", "tool", "assistant"]
+
+@pytest.mark.usefixtures("auth_client")
+def test_agent_loop_stops_offering_tools_when_budget_is_spent(auth_client, app, mocker):
+    """Testa se, esgotado o orçamento de rodadas, a chamada seguinte vai sem ferramentas."""
+    mocker.patch.dict(app.config, {"AGENT_MAX_ROUNDS": 1})
+    openai_mock = mocker.patch("src.main.client.chat.completions.create")
+    openai_mock.side_effect = [make_tool_call_response("https://api.test/a"), mock_openai_final_response_after_tool]
+    mocker.patch.dict(available_functions, {"fazer_requisicao_http": MagicMock(return_value=mock_http_response_success)})
+
+    response = auth_client.post("/api/chat/send", json={"message": "GET", "model": "gpt-4o", "session_id": None})
+
+    assert response.status_code == 200
+    assert "tools" in openai_mock.call_args_list[0].kwargs
+    assert "tools" not in openai_mock.call_args_list[1].kwargs
+
+@pytest.mark.usefixtures("auth_client")
+def test_agent_loop_stops_even_if_tools_are_requested_without_budget(auth_client, app, mocker):
+    """Testa se tool_calls na chamada sem ferramentas encerram o turno em vez de abrir outra rodada."""
+    mocker.patch.dict(app.config, {"AGENT_MAX_ROUNDS": 1})
+    openai_mock = mocker.patch("src.main.client.chat.completions.create")
+    openai_mock.side_effect = [make_tool_call_response("https://api.test/a"), make_tool_call_response("https://api.test/b")]
+    mock_http_func = MagicMock(return_value=mock_http_response_success)
+    mocker.patch.dict(available_functions, {"fazer_requisicao_http": mock_http_func})
+
+    response = auth_client.post("/api/chat/send", json={"message": "GET", "model": "gpt-4o", "session_id": None})
+
+    assert response.status_code == 200
+    assert openai_mock.call_count == 2
+    assert mock_http_func.call_count == 1
+    data = response.get_json()
+    assert "limite de ferramentas" in data["ai_response"]
+    assert [r["tool_calls"] for r in data["rounds"]] == [1, 0]
+
+@pytest.mark.usefixtures("auth_client")
+def test_agent_loop_answers_tool_calls_over_the_call_budget(auth_client, app, mocker):
+    """Testa se ferramentas além do limite de chamadas não rodam, mas recebem resposta de erro."""
+    mocker.patch.dict(app.config, {"AGENT_MAX_TOOL_CALLS": 1})
+    openai_mock = mocker.patch("src.main.client.chat.completions.create")
+    openai_mock.side_effect = [make_tool_call_response("https://api.test/a", "https://api.test/b"), mock_openai_final_response_after_tool]
+    mock_http_func = MagicMock(return_value=mock_http_response_success)
+    mocker.patch.dict(available_functions, {"fazer_requisicao_http": mock_http_func})
+
+    auth_client.post("/api/chat/send", json={"message": "GET", "model": "gpt-4o", "session_id": None})
+
+    assert mock_http_func.call_count == 1
+    tool_messages = [m for m in openai_mock.call_args_list[1].kwargs["messages"] if isinstance(m, dict) and m.get("role") == "tool"]
+    assert [m["tool_call_id"] for m in tool_messages] == ["call_0", "call_1"]
+    assert "limite de chamadas" in tool_messages[1]["content"]
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+import json
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+import src.main
+from src.main import ChatTurn, build_chat_messages, get_db, maybe_schedule_summary, summarize_session, SYSTEM_PROMPT
+from src.tokens import count_message_tokens
+
+# Testes da montagem do contexto por orçamento de tokens
+
+def save_turn(user_id, session_id, *entries):
+    turn = ChatTurn(user_id, session_id, "gpt-4o")
+    for role, fields in entries:
+        turn.add(role, **fields)
+    turn.flush()
+
+def tool_call_info(call_id):
+    return json.dumps([{"id": call_id, "type": "function", "function": {"name": "fazer_requisicao_http", "arguments": "{}"}}])
+
+def test_context_fills_budget_from_newest(app, mocker):
+    """Testa se as mensagens mais novas entram primeiro e as antigas ficam de fora quando não cabem."""
+    with app.test_request_context():
+        save_turn(1, "s", ("user", {"user_message": "antiga " * 200}))
+        save_turn(1, "s", ("user", {"user_message": "recente"}), ("assistant", {"ai_response": "ok"}))
+        mocker.patch.dict(app.config, {"CONTEXT_TOKEN_BUDGET": count_message_tokens("recente") + count_message_tokens("ok")})
+        messages = build_chat_messages(1, "s", "agora", "gpt-4o")
+    assert messages[0] == {"role": "system", "content": SYSTEM_PROMPT}
+    assert messages[1:] == [
+        {"role": "user", "content": "recente"},
+        {"role": "assistant", "content": "ok"},
+        {"role": "user", "content": "agora"},
+    ]
+
+def test_context_keeps_tool_calls_with_their_responses(app):
+    """Testa se a chamada de ferramenta e sua resposta entram (ou saem) juntas."""
+    with app.test_request_context():
+        save_turn(1, "s",
+            ("user", {"user_message": "busca"}),
+            ("assistant", {"tool_call_info": tool_call_info("call_1")}),
+            ("tool", {"tool_call_id": "call_1", "tool_response_content": "x" * 4000}),
+            ("assistant", {"ai_response": "achei"}),
+        )
+        # Cabe a resposta final, mas não o par tool_call + resposta grande
+        with patch.dict(app.config, {"CONTEXT_TOKEN_BUDGET": 200}):
+            messages = build_chat_messages(1, "s", "e agora?", "gpt-4o")
+        assert [m["role"] for m in messages] == ["system", "assistant", "user"]
+
+        messages = build_chat_messages(1, "s", "e agora?", "gpt-4o")
+        assert [m["role"] for m in messages] == ["system", "user", "assistant", "tool", "assistant", "user"]
+
+def test_orphan_tool_responses_are_dropped(app):
+    """Testa se uma resposta de ferramenta sem a chamada correspondente não vai para a IA."""
+    with app.test_request_context():
+        save_turn(1, "s", ("tool", {"tool_call_id": "call_x", "tool_response_content": "solta"}), ("user", {"user_message": "oi"}))
+        messages = build_chat_messages(1, "s", "tudo bem?", "gpt-4o")
+    assert [m["role"] for m in messages] == ["system", "user", "user"]
+
+def test_token_counts_are_stored_and_backfilled(app):
+    """Testa se token_count é gravado com a entrada e calculado para linhas antigas."""
+    with app.test_request_context():
+        save_turn(1, "s", ("user", {"user_message": "olá"}))
+        conn = get_db()
+        conn.execute("INSERT INTO chat_history (user_id, session_id, role, user_message) VALUES (1, 's', 'user', 'legado')")
+        conn.commit()
+        conn.close()
+
+        build_chat_messages(1, "s", "nova", "gpt-4o")
+
+        conn = get_db()
+        counts = dict(conn.execute("SELECT user_message, token_count FROM chat_history").fetchall())
+        conn.close()
+    assert counts == {"olá": count_message_tokens("olá", "gpt-4o"), "legado": count_message_tokens("legado", "gpt-4o")}
+
+# --- Resumo incremental ---
+def summary_response(text):
+    response = MagicMock()
+    response.choices = [MagicMock()]
+    response.choices[0].message.content = text
+    return response
+
+def test_summary_folds_old_turns_and_is_used_in_context(app, mocker):
+    """Testa se as mensagens antigas viram resumo e o contexto passa a usar resumo + recentes."""
+    openai_mock = mocker.patch("src.main.client.chat.completions.create", return_value=summary_response("Usuário pediu X; ficou decidido Y."))
+    mocker.patch.dict(app.config, {"SUMMARY_KEEP_RECENT_TOKENS": count_message_tokens("recente") + count_message_tokens("ok")})
+    with app.test_request_context():
+        save_turn(1, "s", ("user", {"user_message": "antiga 1"}), ("assistant", {"ai_response": "resposta 1"}))
+        save_turn(1, "s", ("user", {"user_message": "recente"}), ("assistant", {"ai_response": "ok"}))
+
+        assert summarize_session(1, "s") is True
+        prompt = openai_mock.call_args.kwargs["messages"][1]["content"]
+        assert "Resumo atual:\n(nenhum)" in prompt
+        assert "Usuário: antiga 1" in prompt and "recente" not in prompt
+
+        messages = build_chat_messages(1, "s", "agora", "gpt-4o")
+    assert messages[1] == {"role": "system", "content": "Resumo da conversa até aqui:\nUsuário pediu X; ficou decidido Y."}
+    assert [m["content"] for m in messages[2:]] == ["recente", "ok", "agora"]
+
+def test_summary_is_refreshed_incrementally(app, mocker):
+    """Testa se a atualização envia só o resumo anterior + mensagens novas."""
+    openai_mock = mocker.patch("src.main.client.chat.completions.create")
+    openai_mock.side_effect = [summary_response("Resumo 1"), summary_response("Resumo 2")]
+    mocker.patch.dict(app.config, {"SUMMARY_KEEP_RECENT_TOKENS": 0})
+    with app.test_request_context():
+        save_turn(1, "s", ("user", {"user_message": "primeira"}))
+        summarize_session(1, "s")
+        save_turn(1, "s", ("user", {"user_message": "segunda"}))
+        summarize_session(1, "s")
+
+        prompt = openai_mock.call_args.kwargs["messages"][1]["content"]
+        assert "Resumo atual:\nResumo 1" in prompt
+        assert "segunda" in prompt and "primeira" not in prompt
+        assert build_chat_messages(1, "s", "agora", "gpt-4o")[1]["content"].endswith("Resumo 2")
+
+def test_long_session_is_folded_in_chunks(app, mocker):
+    """Testa se o primeiro resumo de uma sessão longa vai em blocos e se cada bloco já avança o resumo."""
+    openai_mock = mocker.patch("src.main.client.chat.completions.create")
+    openai_mock.side_effect = [summary_response("Resumo 1"), summary_response("Resumo 2"), Exception("contexto estourado")]
+    mocker.patch.dict(app.config, {"SUMMARY_KEEP_RECENT_TOKENS": 0, "SUMMARY_FOLD_TOKENS": count_message_tokens("mensagem 1") + 1})
+    with app.test_request_context():
+        for i in range(1, 4):
+            save_turn(1, "s", ("user", {"user_message": f"mensagem {i}"}))
+
+        with pytest.raises(Exception, match="contexto estourado"):
+            summarize_session(1, "s")
+
+        prompts = [c.kwargs["messages"][1]["content"] for c in openai_mock.call_args_list]
+        assert len(prompts) == 3
+        assert "mensagem 1" in prompts[0] and "mensagem 2" not in prompts[0]
+        assert "Resumo atual:\nResumo 1" in prompts[1] and "mensagem 2" in prompts[1]
+        # O bloco que falhou não desfaz os anteriores
+        assert build_chat_messages(1, "s", "agora", "gpt-4o")[1]["content"].endswith("Resumo 2")
+
+        openai_mock.side_effect = [summary_response("Resumo 3")]
+        assert summarize_session(1, "s") is True
+        assert "mensagem 3" in openai_mock.call_args.kwargs["messages"][1]["content"]
+        assert "mensagem 2" not in openai_mock.call_args.kwargs["messages"][1]["content"]
+
+def test_summary_is_scheduled_only_past_threshold(app, mocker):
+    """Testa se o resumo em segundo plano só é agendado quando a sessão passa do limite."""
+    submit = mocker.patch("src.main.ThreadPoolExecutor.submit")
+    mocker.patch("src.main.summary_executor", None)
+    with app.test_request_context():
+        save_turn(1, "s", ("user", {"user_message": "curta"}))
+        assert maybe_schedule_summary(1, "s") is False
+        with patch.dict(app.config, {"SUMMARY_TRIGGER_TOKENS": 1}):
+            assert maybe_schedule_summary(1, "s") is True
+            assert maybe_schedule_summary(1, "s") is False # Já em andamento
+    submit.assert_called_once()
+    src.main.summaries_in_progress.clear()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+import pytest
+from src.main import get_db
+from src.migrations import MIGRATIONS, SCHEMA_VERSION, explain_query_plan, run_migrations, schema_version
+
+# Testes do pool de conexões SQLite
+
+def test_get_db_reuses_connection(app):
+    """Testa se a conexão devolvida com close() é reaproveitada."""
+    with app.app_context():
+        conn = get_db()
+        conn.close()
+        assert get_db() is conn
+
+def test_get_db_uses_wal(app):
+    """Testa se o banco é aberto em modo WAL com busy_timeout configurado."""
+    with app.app_context():
+        conn = get_db()
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        assert conn.execute("PRAGMA busy_timeout").fetchone()[0] == app.config["SQLITE_BUSY_TIMEOUT_MS"]
+        conn.close()
+
+def test_uncommitted_work_is_rolled_back_on_close(app):
+    """Testa se alterações sem commit são descartadas ao devolver a conexão."""
+    with app.app_context():
+        conn = get_db()
+        conn.execute("INSERT INTO users (username, password_hash) VALUES ('fantasma', 'x')")
+        conn.close()
+        conn = get_db()
+        assert conn.execute("SELECT COUNT(*) FROM users WHERE username = 'fantasma'").fetchone()[0] == 0
+        conn.close()
+
+# Testes das migrações e dos planos de consulta
+
+def test_migrations_are_idempotent(app):
+    """Testa se rodar as migrações de novo não aplica nada."""
+    with app.app_context():
+        conn = get_db()
+        assert schema_version(conn) == SCHEMA_VERSION
+        assert run_migrations(conn) == []
+        conn.close()
+
+def test_migrations_upgrade_legacy_schema(tmp_path):
+    """Testa a atualização de um banco criado pelo init_db antigo (sem colunas de tool calling)."""
+    conn = sqlite3.connect(tmp_path / "legado.db")
+    conn.execute("CREATE TABLE chat_history (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, session_id TEXT NOT NULL, user_message TEXT, ai_response TEXT, model_used TEXT, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP, context_used BOOLEAN DEFAULT FALSE, uploaded_file_path TEXT)")
+    conn.commit()
+    assert run_migrations(conn) == list(range(1, SCHEMA_VERSION + 1))
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(chat_history)")}
+    assert {"role", "tool_call_id", "tool_call_info", "tool_response_content"} <= columns
+    conn.close()
+
+@pytest.mark.parametrize("sql, params", [
+    # Contexto do send_message
+    ("SELECT role, user_message, ai_response FROM chat_history WHERE user_id = ? AND session_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?", (1, "s", 20)),
+    # /api/chat/history com e sem filtro de sessão
+    ("SELECT id, session_id FROM chat_history WHERE user_id = ? AND session_id = ? ORDER BY timestamp ASC, id ASC", (1, "s")),
+    ("SELECT id, session_id FROM chat_history WHERE user_id = ? ORDER BY timestamp ASC, id ASC", (1,)),
+    # Páginas seguintes (keyset)
+    ("SELECT id FROM chat_history WHERE user_id = ? AND session_id = ? AND (timestamp, id) < (?, ?) ORDER BY timestamp DESC, id DESC LIMIT ?", (1, "s", "2025-01-01 00:00:00", 10, 51)),
+    ("SELECT id FROM chat_history WHERE user_id = ? AND (timestamp, id) > (?, ?) ORDER BY timestamp ASC, id ASC LIMIT ?", (1, "2025-01-01 00:00:00", 10, 51)),
+])
+def test_history_queries_use_index(app, sql, params):
+    """Testa se as consultas de histórico usam índice e não ordenam em tabela temporária."""
+    with app.app_context():
+        conn = get_db()
+        plan = " | ".join(explain_query_plan(conn, sql, params))
+        conn.close()
+    assert "INDEX idx_chat_history_user" in plan
+    assert "SCAN chat_history" not in plan
+    assert "TEMP B-TREE" not in plan
+
+def test_sessions_query_uses_index(app):
+    """Testa se a lista de sessões é paginada pelo índice (user_id, last_message_at, id)."""
+    with app.app_context():
+        conn = get_db()
+        plan = " | ".join(explain_query_plan(conn, "SELECT id FROM sessions WHERE user_id = ? AND (last_message_at, id) < (?, ?) ORDER BY last_message_at DESC, id DESC LIMIT ?", (1, "2025-01-01 00:00:00", "s", 51)))
+        conn.close()
+    assert "idx_sessions_user_last_message" in plan
+    assert "TEMP B-TREE" not in plan
+
+def test_migration_moves_upload_chunks_to_blobs(tmp_path):
+    """Testa se os trechos de uploads com o mesmo conteúdo viram uma única extração por sha256."""
+    conn = sqlite3.connect(tmp_path / "v7.db")
+    for migration in MIGRATIONS[:7]:
+        migration(conn)
+    conn.execute("PRAGMA user_version = 7")
+    for upload_id in (1, 2):
+        conn.execute("INSERT INTO uploads (id, user_id, file_path, original_name, file_type, size_bytes, sha256, status, chunk_count) VALUES (?, 1, ?, 'a.txt', 'text', 3, 'abc', 'ready', 1)", (upload_id, f"1/{upload_id}_a.txt"))
+        conn.execute("INSERT INTO upload_chunks VALUES (?, 0, 0, 'oi', 1)", (upload_id,))
+    conn.commit()
+    assert run_migrations(conn) == list(range(8, SCHEMA_VERSION + 1))
+    assert conn.execute("SELECT sha256, status, chunk_count FROM blobs").fetchall() == [("abc", "ready", 1)]
+    assert conn.execute("SELECT sha256, chunk_index, content FROM blob_chunks").fetchall() == [("abc", 0, "oi")]
+    assert conn.execute("SELECT name FROM sqlite_master WHERE name = 'upload_chunks'").fetchone() is None
+    conn.close()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import pytest
+from unittest.mock import MagicMock
+from prometheus_client import generate_latest
+
+# Testes do endpoint /metrics (Prometheus)
+
+mock_openai_response = MagicMock()
+mock_openai_response.choices = [MagicMock()]
+mock_openai_response.choices[0].message = MagicMock()
+mock_openai_response.choices[0].message.content = "Resposta medida."
+mock_openai_response.choices[0].message.tool_calls = None
+
+def test_metrics_endpoint(client):
+    """Testa se /metrics responde no formato do Prometheus."""
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    assert b"http_request_duration_seconds" in response.data
+
+@pytest.mark.usefixtures("auth_client")
+def test_metrics_record_route_and_openai(auth_client, mocker):
+    """Testa se uma mensagem enviada gera métricas da rota, da OpenAI e do SQLite."""
+    mocker.patch("src.main.client.chat.completions.create", return_value=mock_openai_response)
+    response = auth_client.post("/api/chat/send", json={"message": "Olá", "model": "gpt-4o", "session_id": None})
+    assert response.status_code == 200
+
+    body = auth_client.get("/metrics").get_data(as_text=True)
+    assert 'http_requests_total{method="POST",route="/api/chat/send",status="200"}' in body
+    assert 'openai_request_duration_seconds_count{call="first",model="gpt-4o",outcome="ok"}' in body
+    assert 'sqlite_query_duration_seconds_count{operation="INSERT"}' in body
+
+def test_metrics_requires_token(client, monkeypatch):
+    """Testa a proteção opcional por token."""
+    monkeypatch.setattr("src.main.METRICS_TOKEN", "segredo")
+    assert client.get("/metrics").status_code == 401
+    response = client.get("/metrics", headers={"Authorization": "Bearer segredo"})
+    assert response.status_code == 200
+
+@pytest.mark.usefixtures("auth_client")
+def test_metrics_unknown_model_is_other(auth_client, mocker):
+    """Testa se um modelo fora da lista não cria uma série própria (o nome vem do corpo da requisição)."""
+    mocker.patch("src.main.client.chat.completions.create", return_value=mock_openai_response)
+    auth_client.post("/api/chat/send", json={"message": "Olá", "model": "modelo-inventado-123", "session_id": None})
+
+    body = auth_client.get("/metrics").get_data(as_text=True)
+    assert 'openai_request_duration_seconds_count{call="first",model="other",outcome="ok"}' in body
+    assert "modelo-inventado-123" not in body
+
+def test_metrics_tool_host_outside_allowlist_is_other(app, mocker):
+    """Testa se hosts escolhidos pela IA fora de METRICS_TOOL_HOSTS viram "other"."""
+    from src.main import fazer_requisicao_http, http_cache, metric_host_label
+    response = MagicMock(status_code=200, text="{}", headers={})
+    mocker.patch("requests.Session.request", return_value=response)
+    http_cache.clear()
+
+    fazer_requisicao_http("https://host-aleatorio-42.example/x", method="FOO")
+
+    body = generate_latest().decode("utf-8")
+    assert "host-aleatorio-42" not in body
+    assert 'tool_http_request_duration_seconds_count{host="other",method="other",status="200"}' in body
+    assert metric_host_label("https://API.ClickUp.com/api/v2/task") == "api.clickup.com"
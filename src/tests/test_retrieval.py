@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+from io import BytesIO
+from unittest.mock import MagicMock
+
+import numpy as np
+
+from src.embeddings import KEY_DTYPE, KIND_HISTORY, KIND_UPLOAD, HashingEmbedder, VectorIndex
+from src.main import ChatTurn, RETRIEVAL_HEADER, build_chat_messages, index_user, retrieve_snippets, user_index
+
+# Testes da recuperação por embeddings (índice NumPy por usuário e busca top-k)
+
+def save_turn(user_id, session_id, *entries):
+    turn = ChatTurn(user_id, session_id, "gpt-4o")
+    for role, text in entries:
+        turn.add(role, **({"user_message": text} if role == "user" else {"ai_response": text}))
+    turn.flush()
+
+def test_hashing_embedder_is_deterministic():
+    """Testa se o embedder local é determinístico e aproxima textos parecidos."""
+    embedder = HashingEmbedder(128)
+    a, b, c = embedder.embed(["fatura do cartão de crédito", "fatura do cartão", "previsão do tempo amanhã"])
+    assert np.array_equal(a, HashingEmbedder(128).embed(["fatura do cartão de crédito"])[0])
+    assert np.isclose(np.linalg.norm(a), 1)
+    assert a @ b > a @ c
+
+def test_vector_index_append_and_search(tmp_path):
+    """Testa se o índice ignora chaves repetidas, guarda a posição indexada e respeita skip."""
+    index = VectorIndex(str(tmp_path / "idx"))
+    assert len(index) == 0
+    assert index.search(np.ones(3), 2) == []
+
+    keys = np.array([(KIND_HISTORY, 1, 0), (KIND_UPLOAD, 7, 0), (KIND_UPLOAD, 7, 1)], dtype=KEY_DTYPE)
+    vectors = np.eye(3, dtype=np.float32)
+    assert index.append(keys, vectors) == 3
+    assert index.append(keys[:1], vectors[:1]) == 0
+    assert len(index) == 3
+    assert index.high_water() == (1, (7, 1))
+
+    query = np.array([0.1, 0.2, 0.9], dtype=np.float32)
+    assert [key for _, key in index.search(query, 2)] == [(KIND_UPLOAD, 7, 1), (KIND_UPLOAD, 7, 0)]
+    assert [key for _, key in index.search(query, 1, skip={(KIND_UPLOAD, 7, 1)})] == [(KIND_UPLOAD, 7, 0)]
+    assert [key for _, key in index.search(query, 3, min_score=0.5)] == [(KIND_UPLOAD, 7, 1)]
+
+def test_vector_index_keeps_few_segments(tmp_path):
+    """Testa se cada append grava só o lote novo e se os segmentos são fundidos em O(log n)."""
+    index = VectorIndex(str(tmp_path / "idx"))
+    vectors = HashingEmbedder(16).embed([f"item {i}" for i in range(100)])
+    keys = np.array([(KIND_HISTORY, i, 0) for i in range(1, 101)], dtype=KEY_DTYPE)
+    for start in range(0, 100, 4):
+        index.append(keys[start:start + 4], vectors[start:start + 4])
+
+    assert len(index) == 100
+    assert len(index.segments()) <= 5
+    assert index.high_water() == (100, (0, -1))
+    assert index.search(vectors[41], 1)[0][1] == (KIND_HISTORY, 42, 0)
+
+def test_vector_index_reads_and_merges_legacy_files(tmp_path):
+    """Testa se keys.npy/vectors.npy de um índice antigo continuam valendo como primeiro segmento."""
+    directory = tmp_path / "idx"
+    directory.mkdir()
+    np.save(directory / "keys.npy", np.array([(KIND_HISTORY, 1, 0)], dtype=KEY_DTYPE))
+    np.save(directory / "vectors.npy", np.eye(2, dtype=np.float32)[:1])
+    index = VectorIndex(str(directory))
+
+    assert index.append(np.array([(KIND_HISTORY, 1, 0), (KIND_HISTORY, 2, 0)], dtype=KEY_DTYPE), np.eye(2, dtype=np.float32)) == 1
+    assert len(index) == 2
+    assert [key for _, key in index.search(np.array([1, 0], dtype=np.float32), 2)] == [(KIND_HISTORY, 1, 0), (KIND_HISTORY, 2, 0)]
+    assert not (directory / "keys.npy").exists() # Fundido com o segmento novo
+
+def test_index_user_is_incremental(app, mocker):
+    """Testa se só as mensagens novas são indexadas a cada execução."""
+    mocker.patch.dict(app.config, {"RETRIEVAL_ENABLED": True, "EMBEDDING_BATCH_SIZE": 2})
+    with app.test_request_context():
+        save_turn(1, "s", ("user", "um"), ("assistant", "dois"), ("user", "três"))
+        assert index_user(1) == 3
+        assert index_user(1) == 0
+        save_turn(1, "s", ("assistant", "quatro"))
+        assert index_user(1) == 1
+        assert len(user_index(1)) == 4
+        assert len(user_index(2)) == 0 # Índices separados por usuário
+
+def test_context_includes_retrieved_history(app, mocker):
+    """Testa se mensagens antigas parecidas com a pergunta entram, sem repetir o histórico enviado."""
+    mocker.patch.dict(app.config, {"RETRIEVAL_ENABLED": True, "RETRIEVAL_MIN_SCORE": 0.2})
+    with app.test_request_context():
+        save_turn(1, "antiga", ("user", "o número do meu contrato de aluguel é 4471"), ("assistant", "anotado"))
+        save_turn(1, "atual", ("user", "bom dia"))
+        index_user(1)
+        messages = build_chat_messages(1, "atual", "qual é o número do contrato de aluguel?", "gpt-4o", query="qual é o número do contrato de aluguel?")
+    assert messages[1]["role"] == "system"
+    assert messages[1]["content"].startswith(RETRIEVAL_HEADER)
+    assert "[Conversa anterior, usuário]:\no número do meu contrato de aluguel é 4471" in messages[1]["content"]
+    assert "bom dia" not in messages[1]["content"] # Já vai no histórico da sessão
+    assert messages[2:] == [
+        {"role": "user", "content": "bom dia"},
+        {"role": "user", "content": "qual é o número do contrato de aluguel?"},
+    ]
+
+def test_retrieval_skipped_without_index_or_on_error(app, mocker):
+    """Testa se a recuperação não chama o modelo sem índice e não derruba o turno se ele falhar."""
+    mocker.patch.dict(app.config, {"RETRIEVAL_ENABLED": True})
+    with app.test_request_context():
+        embed = mocker.patch.object(HashingEmbedder, "embed", side_effect=RuntimeError("fora do ar"))
+        assert retrieve_snippets(1, "qualquer coisa") == (None, 0)
+        assert not embed.called
+        embed.side_effect = None
+        embed.return_value = np.eye(1, 256, dtype=np.float32)
+        save_turn(1, "s", ("user", "algo"))
+        index_user(1)
+        embed.side_effect = RuntimeError("fora do ar")
+        assert retrieve_snippets(1, "algo") == (None, 0)
+
+def test_send_message_retrieves_chunks_beyond_file_budget(auth_client, app, mocker):
+    """Testa se um trecho relevante do fim de um arquivo grande chega à IA pela recuperação."""
+    mocker.patch.dict(app.config, {"RETRIEVAL_ENABLED": True, "RETRIEVAL_MIN_SCORE": 0.2, "UPLOAD_CHUNK_CHARS": 300, "FILE_CONTEXT_TOKEN_BUDGET": 100})
+    mocker.patch("src.main.schedule_indexing", return_value=False)
+    text = "".join(f"Item {i}: parafusos sextavados em estoque.\n" for i in range(200)) + "A senha do cofre da filial norte é girassol azul.\n"
+    upload = auth_client.post("/api/upload", data={"file": (BytesIO(text.encode("utf-8")), "estoque.txt")}, content_type="multipart/form-data").get_json()
+    with auth_client.session_transaction() as sess:
+        user_id = sess["user_id"]
+    with app.test_request_context():
+        assert index_user(user_id) == upload["chunks"]
+
+    response = MagicMock()
+    response.choices = [MagicMock()]
+    response.choices[0].message.content = "Girassol azul."
+    response.choices[0].message.tool_calls = None
+    mock_create = mocker.patch("src.main.client.chat.completions.create", return_value=response)
+    result = auth_client.post("/api/chat/send", json={"message": "qual a senha do cofre da filial norte?", "uploaded_file_path": upload["file_path"]})
+    assert result.status_code == 200
+    system_messages = [m["content"] for m in mock_create.call_args.kwargs["messages"] if m["role"] == "system"]
+    retrieved = [content for content in system_messages if content.startswith(RETRIEVAL_HEADER)]
+    assert len(retrieved) == 1
+    assert "girassol azul" in retrieved[0]
+    assert f"[Arquivo 'estoque.txt', trecho {upload['chunks']}]" in retrieved[0]
+    assert "trecho 1]" not in retrieved[0] # O início do arquivo já vai na mensagem do usuário
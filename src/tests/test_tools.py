@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import pytest
+from unittest.mock import MagicMock
+
+from src.main import fazer_requisicao_http, http_cache, http_sessions, get_http_session
+
+# Testes da ferramenta fazer_requisicao_http (sessão por host e cache de GET)
+
+def make_response(status_code=200, text='{"ok": true}', headers=None):
+    response = MagicMock()
+    response.status_code = status_code
+    response.text = text
+    response.content = text.encode("utf-8")
+    response.headers = headers or {}
+    response.raise_for_status = MagicMock()
+    return response
+
+@pytest.fixture
+def session_request(app, mocker):
+    """Mocka requests.Session.request, liga o cache (desligado por padrão) e limpa-o entre os testes."""
+    mocker.patch.dict(app.config, {"TOOL_HTTP_CACHE_TTL": 30})
+    http_cache.clear()
+    yield mocker.patch("requests.Session.request")
+    http_cache.clear()
+
+def test_sessions_are_shared_per_host(app):
+    """Testa se a mesma Session (pool keep-alive) é usada para o mesmo host."""
+    assert get_http_session("https://api.test/a") is get_http_session("https://api.test/b?x=1")
+    assert get_http_session("https://api.test/a") is not get_http_session("https://outra.test/a")
+
+def test_least_recently_used_sessions_are_closed(app, mocker):
+    """Testa se, acima de TOOL_HTTP_MAX_SESSIONS hosts, a Session menos usada é fechada e descartada."""
+    mocker.patch.dict(app.config, {"TOOL_HTTP_MAX_SESSIONS": 2})
+    http_sessions.clear()
+    first = get_http_session("https://a.test/")
+    close = mocker.spy(first, "close")
+    get_http_session("https://b.test/")
+    get_http_session("https://a.test/") # a.test volta a ser a mais recente
+    get_http_session("https://c.test/")
+
+    assert close.call_count == 0
+    assert get_http_session("https://a.test/") is first
+    get_http_session("https://b.test/")
+    get_http_session("https://d.test/")
+    assert close.call_count == 1
+    assert len(http_sessions) == 2
+    http_sessions.clear()
+
+def test_repeated_get_is_served_from_cache(session_request):
+    """Testa se um GET repetido dentro do TTL não vai ao upstream."""
+    session_request.return_value = make_response()
+
+    first = fazer_requisicao_http("https://api.test/itens", headers={"Authorization": "a"})
+    second = fazer_requisicao_http("https://api.test/itens", headers={"Authorization": "a"})
+
+    assert first == second == 'Status: 200\nResultado:\n{"ok": true}'
+    assert session_request.call_count == 1
+    # Outro token é outra entrada do cache
+    fazer_requisicao_http("https://api.test/itens", headers={"Authorization": "b"})
+    assert session_request.call_count == 2
+
+def test_stale_entry_is_revalidated_with_etag(app, session_request, mocker):
+    """Testa a revalidação com If-None-Match e o reaproveitamento do corpo no 304."""
+    mocker.patch.dict(app.config, {"TOOL_HTTP_CACHE_TTL": 0.01})
+    session_request.side_effect = [make_response(headers={"ETag": '"v1"'}), make_response(status_code=304, text="")]
+
+    fazer_requisicao_http("https://api.test/itens")
+    import time
+    time.sleep(0.02)
+    result = fazer_requisicao_http("https://api.test/itens")
+
+    assert result == 'Status: 200\nResultado:\n{"ok": true}'
+    assert session_request.call_args.kwargs["headers"] == {"If-None-Match": '"v1"'}
+
+def test_writes_and_no_store_are_not_cached(session_request):
+    """Testa se POST invalida o GET guardado e se respostas no-store não são guardadas."""
+    session_request.return_value = make_response()
+    fazer_requisicao_http("https://api.test/itens")
+    fazer_requisicao_http("https://api.test/itens", method="POST", payload={"nome": "x"})
+    fazer_requisicao_http("https://api.test/itens")
+    assert session_request.call_count == 3
+
+    session_request.return_value = make_response(headers={"Cache-Control": "no-store"})
+    fazer_requisicao_http("https://api.test/segredo")
+    fazer_requisicao_http("https://api.test/segredo")
+    assert session_request.call_count == 5
+
+def test_cache_is_off_by_default(app, mocker):
+    """Testa se, sem TOOL_HTTP_CACHE_TTL, todo GET vai ao upstream."""
+    http_cache.clear()
+    session_request = mocker.patch("requests.Session.request", return_value=make_response())
+
+    fazer_requisicao_http("https://api.test/itens")
+    fazer_requisicao_http("https://api.test/itens")
+
+    assert session_request.call_count == 2
+    assert len(http_cache) == 0
+
+def test_etag_is_revalidated_even_with_cache_off(app, mocker):
+    """Testa se, com TOOL_HTTP_CACHE_TTL=0, todo GET vai ao upstream, mas condicional e com o corpo reaproveitado no 304."""
+    http_cache.clear()
+    session_request = mocker.patch("requests.Session.request")
+    session_request.side_effect = [make_response(headers={"ETag": '"v1"'}), make_response(status_code=304, text="")]
+
+    fazer_requisicao_http("https://api.test/itens")
+    result = fazer_requisicao_http("https://api.test/itens")
+
+    assert result == 'Status: 200\nResultado:\n{"ok": true}'
+    assert session_request.call_count == 2
+    assert session_request.call_args.kwargs["headers"] == {"If-None-Match": '"v1"'}
+    http_cache.clear()
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+import os
+from io import BytesIO
+from unittest.mock import MagicMock
+
+from src import ingest
+from src.main import build_user_content, collect_upload_garbage, get_db
+
+# Testes da ingestão de uploads (extração e trechos gravados no envio)
+
+def upload(auth_client, content, name):
+    response = auth_client.post("/api/upload", data={"file": (BytesIO(content), name)}, content_type="multipart/form-data")
+    assert response.status_code == 200
+    return response.get_json()
+
+def test_upload_csv_cp1252(auth_client, app):
+    """Testa se um CSV em cp1252 é detectado e decodificado na ingestão."""
+    data = upload(auth_client, "nome;cidade\nJoão;São Paulo\n".encode("cp1252"), "clientes.csv")
+    assert data["file_type"] == "csv"
+    assert data["status"] == "ready"
+    assert data["chunks"] == 1
+    with app.app_context():
+        conn = get_db()
+        row = conn.execute("SELECT b.encoding, c.content FROM uploads u JOIN blobs b ON b.sha256 = u.sha256 JOIN blob_chunks c ON c.sha256 = u.sha256 WHERE u.file_path = ?", (data["file_path"],)).fetchone()
+        conn.close()
+    assert row["encoding"] == "cp1252"
+    assert "São Paulo" in row["content"]
+
+def test_upload_large_text_is_chunked(auth_client, app, mocker):
+    """Testa se um texto grande vira vários trechos e o contexto respeita o orçamento do arquivo."""
+    mocker.patch.dict(app.config, {"UPLOAD_CHUNK_CHARS": 500, "UPLOAD_CHUNK_OVERLAP": 50, "FILE_CONTEXT_TOKEN_BUDGET": 300})
+    text = "".join(f"linha {i} do relatório\n" for i in range(1000))
+    data = upload(auth_client, text.encode("utf-8"), "relatorio.txt")
+    assert data["chunks"] > 10
+    assert not data["truncated"]
+
+    with app.test_request_context():
+        with auth_client.session_transaction() as sess:
+            user_id = sess["user_id"]
+        content = build_user_content("Resuma", data["file_path"], user_id)
+    assert content.startswith("Resuma\n\n[Conteúdo do arquivo 'relatorio.txt' (trechos 1-")
+    assert "linha 0 do relatório\nlinha 1 do" in content
+    assert "linha 999" not in content
+    assert content.count("linha 1 do relatório\n") == 1 # Sem repetir a sobreposição dos trechos
+
+def test_upload_truncates_at_max_chars(auth_client, app, mocker):
+    """Testa se o texto extraído é limitado a UPLOAD_MAX_CHARS."""
+    mocker.patch.dict(app.config, {"UPLOAD_MAX_CHARS": 1000})
+    data = upload(auth_client, b"a " * 5000, "grande.txt")
+    assert data["truncated"]
+    with app.app_context():
+        conn = get_db()
+        assert conn.execute("SELECT char_count FROM uploads WHERE file_path = ?", (data["file_path"],)).fetchone()[0] == 1000
+        conn.close()
+
+def test_upload_binary_is_unsupported(auth_client, app):
+    """Testa se um arquivo binário é aceito, mas marcado como sem texto extraível."""
+    data = upload(auth_client, b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR", "imagem.png")
+    assert data["status"] == "unsupported"
+    assert data["chunks"] == 0
+    with app.test_request_context():
+        with auth_client.session_transaction() as sess:
+            content = build_user_content("O que é isso?", data["file_path"], sess["user_id"])
+    assert "[Não foi possível ler o arquivo 'imagem.png': Arquivo binário]" in content
+
+def test_send_message_reads_stored_chunks(auth_client, app, mocker):
+    """Testa se o envio de mensagem usa os trechos gravados, sem reler o arquivo do disco."""
+    data = upload(auth_client, b"conteudo guardado", "nota.txt")
+    os.remove(os.path.join(app.config["UPLOAD_FOLDER"], data["file_path"]))
+
+    response = MagicMock()
+    response.choices = [MagicMock()]
+    response.choices[0].message.content = "Ok."
+    response.choices[0].message.tool_calls = None
+    mock_create = mocker.patch("src.main.client.chat.completions.create", return_value=response)
+    result = auth_client.post("/api/chat/send", json={"message": "Leia", "model": "gpt-4o", "uploaded_file_path": data["file_path"]})
+    assert result.status_code == 200
+    sent = mock_create.call_args.kwargs["messages"][-1]["content"]
+    assert sent == "Leia\n\n[Conteúdo do arquivo 'nota.txt' (completo)]:\nconteudo guardado"
+
+def test_legacy_upload_is_ingested_on_first_use(auth_client, app):
+    """Testa se arquivos enviados antes da ingestão são processados no primeiro uso, só pelo dono."""
+    with auth_client.session_transaction() as sess:
+        user_id = sess["user_id"]
+    user_dir = os.path.join(app.config["UPLOAD_FOLDER"], str(user_id))
+    os.makedirs(user_dir, exist_ok=True)
+    with open(os.path.join(user_dir, "abc_antigo.txt"), "wb") as f:
+        f.write(b"texto antigo")
+    with app.test_request_context():
+        assert build_user_content("", f"{user_id}/abc_antigo.txt", user_id).endswith("texto antigo")
+        assert "não encontrado" in build_user_content("", f"{user_id}/abc_antigo.txt", user_id + 1)
+
+# Testes do armazenamento por conteúdo (blobs deduplicados por sha256)
+
+def blob_files(app):
+    root = os.path.join(app.config["UPLOAD_FOLDER"], ".blobs")
+    return [os.path.join(d, f) for d, _, files in os.walk(root) for f in files]
+
+def test_duplicate_upload_is_stored_and_extracted_once(auth_client, client, app, mocker):
+    """Testa se o mesmo conteúdo vira um único blob, com a extração reaproveitada entre usuários."""
+    iter_text = mocker.patch("src.main.iter_text", wraps=ingest.iter_text)
+    first = upload(auth_client, b"planilha de vendas", "vendas.csv")
+    again = upload(auth_client, b"planilha de vendas", "vendas.csv")
+    assert again["file_path"] == first["file_path"] # Mesmo arquivo do mesmo usuário: mesma referência
+
+    client.get("/logout")
+    client.post("/register", data={"username": "outro", "password": "password"})
+    client.post("/login", data={"username": "outro", "password": "password"})
+    other = upload(client, b"planilha de vendas", "copia.csv")
+    assert other["file_path"] != first["file_path"]
+    assert other["status"] == "ready" and other["chunks"] == first["chunks"]
+    assert iter_text.call_count == 1
+
+    assert len(blob_files(app)) == 1
+    folder = app.config["UPLOAD_FOLDER"]
+    assert os.path.samefile(os.path.join(folder, first["file_path"]), os.path.join(folder, other["file_path"]))
+    assert client.get(f"/uploads/{other['file_path']}").data == b"planilha de vendas"
+    with app.app_context():
+        conn = get_db()
+        assert conn.execute("SELECT COUNT(*) FROM blobs").fetchone()[0] == 1
+        assert conn.execute("SELECT COUNT(*) FROM uploads").fetchone()[0] == 2
+        conn.close()
+
+def test_delete_upload_releases_blob_with_last_reference(auth_client, app):
+    """Testa se o blob e a extração só são apagados quando a última referência sai."""
+    first = upload(auth_client, b"contrato assinado", "contrato.txt")
+    second = upload(auth_client, b"contrato assinado", "contrato-v2.txt")
+    assert auth_client.delete(f"/api/upload/{first['file_path']}").status_code == 200
+    assert auth_client.get(f"/uploads/{first['file_path']}").status_code == 404
+    assert len(blob_files(app)) == 1
+    assert auth_client.delete(f"/api/upload/{first['file_path']}").status_code == 404
+
+    assert auth_client.delete(f"/api/upload/{second['file_path']}").status_code == 200
+    assert blob_files(app) == []
+    with app.app_context():
+        conn = get_db()
+        assert conn.execute("SELECT COUNT(*) FROM blobs").fetchone()[0] == 0
+        assert conn.execute("SELECT COUNT(*) FROM blob_chunks").fetchone()[0] == 0
+        conn.close()
+
+def test_garbage_collection_dedupes_and_removes_orphans(auth_client, app):
+    """Testa se a coleta troca cópias por hardlinks e apaga blobs e temporários órfãos."""
+    first = upload(auth_client, b"relatorio anual", "relatorio.txt")
+    folder = app.config["UPLOAD_FOLDER"]
+    # Cópia gravada antes da deduplicação existir
+    copy_path = os.path.join(folder, first["file_path"].split("/")[0], "antigo_relatorio.txt")
+    with open(copy_path, "wb") as f:
+        f.write(b"relatorio anual")
+    with app.test_request_context():
+        with auth_client.session_transaction() as sess:
+            build_user_content("", f"{sess['user_id']}/antigo_relatorio.txt", sess["user_id"])
+    os.makedirs(os.path.join(folder, ".blobs", "ff"))
+    with open(os.path.join(folder, ".blobs", "ff", "ff" * 32), "wb") as f:
+        f.write(b"sobra")
+    os.makedirs(os.path.join(folder, ".tmp"), exist_ok=True)
+    with open(os.path.join(folder, ".tmp", "interrompido.part"), "wb") as f:
+        f.write(b"x")
+
+    with app.app_context():
+        stats = collect_upload_garbage(min_age_seconds=-1)
+    assert stats == {"relinked": 1, "bytes_freed": len(b"relatorio anual"), "blobs_removed": 1, "temp_removed": 1}
+    assert os.path.samefile(copy_path, os.path.join(folder, first["file_path"]))
+    assert len(blob_files(app)) == 1
+
+# Testes da entrega de /uploads (ETag, Range, cache e X-Accel-Redirect)
+
+def test_serve_upload_with_etag_and_range(auth_client):
+    """Testa ETag forte pelo sha256, Cache-Control immutable, 304 e Range."""
+    data = upload(auth_client, b"0123456789", "numeros.txt")
+    response = auth_client.get(f"/uploads/{data['file_path']}")
+    etag = response.headers["ETag"]
+    assert etag == '"84d89877f0d4041efb6bf91a16f0248f2fd573e6af05c19f96bedb9f882f7882"'
+    assert "immutable" in response.headers["Cache-Control"] and "private" in response.headers["Cache-Control"]
+    assert response.headers["Accept-Ranges"] == "bytes"
+
+    assert auth_client.get(f"/uploads/{data['file_path']}", headers={"If-None-Match": etag}).status_code == 304
+    partial = auth_client.get(f"/uploads/{data['file_path']}", headers={"Range": "bytes=2-5"})
+    assert partial.status_code == 206
+    assert partial.data == b"2345"
+    assert partial.headers["Content-Range"] == "bytes 2-5/10"
+
+def test_serve_upload_via_x_accel_redirect(auth_client, app, mocker):
+    """Testa se, com proxy configurado, o worker só devolve os headers para o nginx entregar o arquivo."""
+    mocker.patch.dict(app.config, {"UPLOADS_X_ACCEL_PREFIX": "/protected-uploads/"})
+    data = upload(auth_client, b"relatorio", "relatorio.txt")
+    response = auth_client.get(f"/uploads/{data['file_path']}")
+    assert response.status_code == 200
+    assert response.data == b""
+    assert response.headers["X-Accel-Redirect"] == f"/protected-uploads/{data['file_path']}"
+    assert response.mimetype == "text/plain"
+    not_modified = auth_client.get(f"/uploads/{data['file_path']}", headers={"If-None-Match": response.headers["ETag"]})
+    assert not_modified.status_code == 304
+    assert "X-Accel-Redirect" not in not_modified.headers
+
+def test_serve_upload_rejects_foreign_and_traversal_paths(auth_client):
+    """Testa se caminhos de outro usuário ou com ".." e "\\" são recusados."""
+    data = upload(auth_client, b"segredo", "segredo.txt")
+    user_id, name = data["file_path"].split("/")
+    assert auth_client.get(f"/uploads/{int(user_id) + 1}/{name}").status_code == 403
+    assert auth_client.get(f"/uploads/{user_id}/../{user_id}/{name}").status_code in (403, 404)
+    assert auth_client.get(f"/uploads/{user_id}/..%5C{name}").status_code == 403
+    assert auth_client.get(f"/uploads/{user_id}/.blobs").status_code == 404
@@ -0,0 +1,123 @@
+import os
+import sys
+import tempfile
+import uuid
+
+import pytest
+
+# The Notion proxy lives in src/main.py; import it as src.main from the repository root
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, project_root)
+
+# Point every store at throwaway files and lift the rate limit BEFORE importing the app
+state_dir = tempfile.mkdtemp()
+os.environ["NOTION_TOKEN_DB"] = os.path.join(state_dir, "notion_tokens.db")
+os.environ["NOTION_MIRROR_DB"] = os.path.join(state_dir, "notion_mirror.db")
+os.environ["NOTION_WRITE_QUEUE_DB"] = os.path.join(state_dir, "notion_jobs.db")
+os.environ["NOTION_RATE_LIMIT_DB"] = os.path.join(state_dir, "notion_rate_limits.db")
+os.environ["NOTION_QUERY_CACHE_DB"] = os.path.join(state_dir, "notion_query_cache.db")
+os.environ["NOTION_RATE_LIMIT_PER_SECOND"] = "1000"
+os.environ["NOTION_RATE_LIMIT_BURST"] = "1000"
+
+from src import main as notion_app
+
+
+class FakeNotionError(Exception):
+    """Stands in for notion_client's APIResponseError (status + response headers)."""
+
+    def __init__(self, status, headers=None):
+        super().__init__(f"Notion returned {status}")
+        self.status = status
+        self.headers = headers or {}
+
+
+class FakeNotion:
+    """Records the calls a test makes and answers them from canned data."""
+
+    def __init__(self):
+        self.calls = []
+        self.query_results = []
+        self.error = None # Raised by every call while set
+        self.clients = [] # Every FakeClient created, in order
+
+    def record(self, method, kwargs):
+        self.calls.append((method, kwargs))
+        if self.error:
+            raise self.error
+
+    def query(self, **kwargs):
+        self.record("databases.query", kwargs)
+        return {"object": "list", "results": list(self.query_results), "next_cursor": None, "has_more": False}
+
+    def create(self, **kwargs):
+        self.record("pages.create", kwargs)
+        return {"object": "page", "id": uuid.uuid4().hex, "parent": kwargs.get("parent"), "properties": kwargs.get("properties")}
+
+    def update(self, page_id, **kwargs):
+        self.record("pages.update", dict(kwargs, page_id=page_id))
+        return {"object": "page", "id": page_id, "parent": {"database_id": "db"}, "properties": kwargs.get("properties")}
+
+
+class DatabasesEndpoint:
+    def __init__(self, fake):
+        self.query = fake.query
+
+
+class PagesEndpoint:
+    def __init__(self, fake):
+        self.create = fake.create
+        self.update = fake.update
+
+
+class FakeClient:
+    """Replaces notion_client.Client; every client shares the test's FakeNotion."""
+
+    fake = None
+
+    def __init__(self, auth=None, client=None):
+        self.auth = auth
+        self.closed = False
+        self.databases = DatabasesEndpoint(self.fake)
+        self.pages = PagesEndpoint(self.fake)
+        self.fake.clients.append(self)
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def notion(monkeypatch):
+    fake = FakeNotion()
+    monkeypatch.setattr(FakeClient, "fake", fake)
+    monkeypatch.setattr(notion_app, "Client", FakeClient)
+    notion_app.notion_clients.clear()
+    yield fake
+    notion_app.notion_clients.clear()
+
+
+@pytest.fixture
+def client(notion):
+    notion_app.app.config["TESTING"] = True
+    return notion_app.app.test_client()
+
+
+@pytest.fixture
+def workspace_id():
+    # A fresh workspace per test keeps the shared stores and caches from leaking between tests
+    return f"ws-{uuid.uuid4().hex}"
+
+
+@pytest.fixture
+def authorize(workspace_id):
+    """Stores a token for a bot of the test's workspace and returns its request headers."""
+
+    def authorize(bot_id="bot-a"):
+        api_key = notion_app.notion_token_store.save({
+            "workspace_id": workspace_id,
+            "bot_id": bot_id,
+            "access_token": f"secret-{workspace_id}-{bot_id}",
+            "workspace_name": "Test",
+        })
+        return {"Authorization": f"Bearer {api_key}"}
+
+    return authorize
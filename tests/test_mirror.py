@@ -0,0 +1,70 @@
+import sqlite3
+
+from src import main as notion_app
+
+
+def page(page_id, edited="2024-05-01T10:00:00.000Z", **properties):
+    return {
+        "object": "page",
+        "id": page_id,
+        "created_time": "2024-05-01T09:00:00.000Z",
+        "last_edited_time": edited,
+        "parent": {"type": "database_id", "database_id": "db"},
+        "properties": properties,
+    }
+
+
+def title(text):
+    return {"type": "title", "title": [{"plain_text": text}]}
+
+
+def test_mirror_only_answers_the_bot_that_owns_it(client, notion, authorize):
+    headers_a, headers_b = authorize("bot-a"), authorize("bot-b")
+    notion.query_results = [page("p1", Name=title("Shared with bot A only"))]
+    assert client.post("/notion/databases/db/mirror", json={}, headers=headers_a).status_code == 200
+    notion.query_results = []
+
+    served = client.post("/notion/databases/db/query", json={"allow_stale": True}, headers=headers_a)
+    assert served.headers["X-Notion-Mirror"] == "hit"
+    assert [row["id"] for row in served.get_json()["results"]] == ["p1"]
+
+    other = client.post("/notion/databases/db/query", json={"allow_stale": True}, headers=headers_b)
+    assert "X-Notion-Mirror" not in other.headers
+    assert other.get_json()["results"] == []
+    assert client.get("/notion/databases/db/mirror", headers=headers_b).status_code == 404
+
+
+def test_writes_only_update_the_writing_bots_mirror(client, notion, authorize, workspace_id):
+    headers_a, headers_b = authorize("bot-a"), authorize("bot-b")
+    client.post("/notion/databases/db/mirror", json={}, headers=headers_a)
+    client.post("/notion/databases/db/mirror", json={}, headers=headers_b)
+
+    client.post("/notion/databases/db/items", json={"properties": {"Name": title("New")}}, headers=headers_a)
+
+    assert notion_app.notion_mirror.status(workspace_id, "bot-a", "db")["pages"] == 1
+    assert notion_app.notion_mirror.status(workspace_id, "bot-b", "db")["pages"] == 0
+
+
+def test_background_sync_uses_the_owning_bots_token(notion, authorize, workspace_id):
+    authorize("bot-a")
+    authorize("bot-b") # Authorized last, so it is the workspace's newest token
+    notion_app.notion_mirror.sync(lambda **kwargs: {"results": []}, workspace_id, "bot-a", "db")
+
+    notion_app.sync_mirrored_databases()
+
+    assert notion_app.notion_clients.get(f"secret-{workspace_id}-bot-a") is not None
+    assert notion_app.notion_clients.get(f"secret-{workspace_id}-bot-b") is None
+
+
+def test_mirrors_without_an_owner_are_dropped(tmp_path):
+    db_path = str(tmp_path / "mirror.db")
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE mirrored_databases (workspace_id TEXT NOT NULL, database_id TEXT NOT NULL, last_edited_cursor TEXT NULL, last_synced_at REAL NULL, PRIMARY KEY (workspace_id, database_id))")
+    conn.execute("INSERT INTO mirrored_databases (workspace_id, database_id) VALUES ('ws', 'db')")
+    conn.commit()
+    conn.close()
+
+    mirror = notion_app.NotionMirror(db_path)
+    assert mirror.registered() == []
+    mirror.sync(lambda **kwargs: {"results": [page("p1")]}, "ws", "bot-a", "db")
+    assert mirror.registered() == [("ws", "bot-a", "db")]
@@ -0,0 +1,176 @@
+import pytest
+
+from src import main as notion_app
+from src.main import MirrorUnsupported, NotionMirror
+
+
+def page(page_id, created, edited, name, status, tags, points, done, due):
+    return {
+        "object": "page",
+        "id": page_id,
+        "created_time": created,
+        "last_edited_time": edited,
+        "parent": {"type": "database_id", "database_id": "db"},
+        "properties": {
+            "Name": {"type": "title", "title": [{"plain_text": name}]},
+            "Status": {"type": "select", "select": {"name": status} if status else None},
+            "Tags": {"type": "multi_select", "multi_select": [{"name": tag} for tag in tags]},
+            "Points": {"type": "number", "number": points},
+            "Done": {"type": "checkbox", "checkbox": done},
+            "Due": {"type": "date", "date": {"start": due} if due else None},
+        },
+    }
+
+
+PAGES = [
+    page("p1", "2024-05-01T09:00:00.000Z", "2024-05-01T10:00:00.000Z", "Alpha task", "Done", ["red", "blue"], 5, True, "2024-05-10"),
+    page("p2", "2024-05-02T09:00:00.000Z", "2024-05-02T10:00:00.000Z", "Beta", "Todo", ["blue"], 12, False, "2024-05-12T15:30:00.000+02:00"),
+    page("p3", "2024-05-03T09:00:00.000Z", "2024-05-03T10:00:00.000Z", "gamma 50%_off", None, [], None, False, None),
+]
+
+
+@pytest.fixture
+def mirror(tmp_path):
+    mirror = NotionMirror(str(tmp_path / "mirror.db"))
+    mirror.sync(lambda **kwargs: {"results": PAGES}, "ws", "bot", "db")
+    return mirror
+
+
+def ids(mirror, filter_data=None, sorts_data=None):
+    return [row["id"] for row in mirror.query("ws", "bot", "db", filter_data, sorts_data)["results"]]
+
+
+def prop(name, prop_type, operator, value=True):
+    return {"property": name, prop_type: {operator: value}}
+
+
+@pytest.mark.parametrize("filter_data, expected", [
+    # Text
+    (prop("Name", "title", "equals", "Beta"), {"p2"}),
+    (prop("Name", "title", "does_not_equal", "Beta"), {"p1", "p3"}),
+    (prop("Name", "title", "contains", "TA"), {"p1", "p2"}),
+    (prop("Name", "title", "does_not_contain", "ta"), {"p3"}),
+    (prop("Name", "title", "contains", "50%_"), {"p3"}),
+    (prop("Name", "title", "contains", "%"), {"p3"}),
+    (prop("Name", "title", "starts_with", "alp"), {"p1"}),
+    (prop("Name", "title", "ends_with", "off"), {"p3"}),
+    (prop("Status", "select", "equals", "Done"), {"p1"}),
+    (prop("Status", "select", "does_not_equal", "Done"), {"p2", "p3"}),
+    (prop("Status", "select", "is_empty"), {"p3"}),
+    (prop("Status", "select", "is_not_empty"), {"p1", "p2"}),
+    # Lists
+    (prop("Tags", "multi_select", "contains", "blue"), {"p1", "p2"}),
+    (prop("Tags", "multi_select", "does_not_contain", "red"), {"p2", "p3"}),
+    (prop("Tags", "multi_select", "is_empty"), {"p3"}),
+    # Numbers
+    (prop("Points", "number", "equals", 5), {"p1"}),
+    (prop("Points", "number", "does_not_equal", 5), {"p2", "p3"}),
+    (prop("Points", "number", "greater_than", 5), {"p2"}),
+    (prop("Points", "number", "less_than", 12), {"p1"}),
+    (prop("Points", "number", "greater_than_or_equal_to", 12), {"p2"}),
+    (prop("Points", "number", "less_than_or_equal_to", 5), {"p1"}),
+    (prop("Points", "number", "is_empty"), {"p3"}),
+    # Checkboxes
+    (prop("Done", "checkbox", "equals", True), {"p1"}),
+    (prop("Done", "checkbox", "equals", False), {"p2", "p3"}),
+    (prop("Done", "checkbox", "does_not_equal", True), {"p2", "p3"}),
+    (prop("Done", "checkbox", "does_not_equal", False), {"p1"}),
+    # Dates (p2 is 2024-05-12T13:30:00Z)
+    (prop("Due", "date", "equals", "2024-05-10"), {"p1"}),
+    (prop("Due", "date", "equals", "2024-05-12"), {"p2"}),
+    (prop("Due", "date", "before", "2024-05-12"), {"p1"}),
+    (prop("Due", "date", "after", "2024-05-10"), {"p2"}),
+    (prop("Due", "date", "on_or_before", "2024-05-12"), {"p1", "p2"}),
+    (prop("Due", "date", "on_or_after", "2024-05-12"), {"p2"}),
+    (prop("Due", "date", "after", "2024-05-12T13:00:00Z"), {"p2"}),
+    (prop("Due", "date", "before", "2024-05-12T15:00:00+02:00"), {"p1"}),
+    (prop("Due", "date", "is_empty"), {"p3"}),
+    # Timestamps
+    ({"timestamp": "last_edited_time", "last_edited_time": {"on_or_after": "2024-05-02"}}, {"p2", "p3"}),
+    ({"timestamp": "created_time", "created_time": {"before": "2024-05-02T09:00:00Z"}}, {"p1"}),
+])
+def test_filter_operators(mirror, filter_data, expected):
+    assert set(ids(mirror, filter_data)) == expected
+
+
+@pytest.mark.parametrize("filter_data, expected", [
+    ({"and": [prop("Tags", "multi_select", "contains", "blue"), prop("Points", "number", "greater_than", 5)]}, {"p2"}),
+    ({"or": [prop("Status", "select", "equals", "Done"), prop("Name", "title", "ends_with", "off")]}, {"p1", "p3"}),
+    ({"and": [
+        prop("Done", "checkbox", "equals", False),
+        {"or": [prop("Tags", "multi_select", "contains", "red"), prop("Points", "number", "greater_than", 10)]},
+    ]}, {"p2"}),
+    ({"or": [
+        {"and": [prop("Done", "checkbox", "equals", True), prop("Points", "number", "equals", 5)]},
+        prop("Status", "select", "is_empty"),
+    ]}, {"p1", "p3"}),
+    ({"and": []}, {"p1", "p2", "p3"}),
+])
+def test_compound_filters(mirror, filter_data, expected):
+    assert set(ids(mirror, filter_data)) == expected
+
+
+@pytest.mark.parametrize("filter_data", [
+    prop("Name", "title", "is_relative", "x"),
+    prop("Points", "number", "contains", 5),
+    prop("Done", "checkbox", "equals", "yes"),
+    prop("Due", "date", "past_week", {}),
+    prop("Total", "formula", "equals", 3),
+    {"timestamp": "last_edited_by", "last_edited_by": {"equals": "x"}},
+    {"or": [prop("Points", "number", "equals", 5), prop("Total", "rollup", "equals", 3)]},
+])
+def test_unsupported_filters_fall_back_to_notion(mirror, filter_data):
+    with pytest.raises(MirrorUnsupported):
+        mirror.query("ws", "bot", "db", filter_data)
+
+
+def test_default_order_is_newest_first(mirror):
+    assert ids(mirror) == ["p3", "p2", "p1"]
+
+
+@pytest.mark.parametrize("direction, expected", [
+    ("ascending", ["p1", "p2", "p3"]),
+    ("descending", ["p2", "p1", "p3"]),
+])
+def test_empty_values_sort_last(mirror, direction, expected):
+    assert ids(mirror, sorts_data=[{"property": "Points", "direction": direction}]) == expected
+    assert ids(mirror, sorts_data=[{"property": "Due", "direction": direction}]) == expected
+
+
+def test_pages_with_cursor(mirror):
+    first = mirror.query("ws", "bot", "db", page_size=2)
+    second = mirror.query("ws", "bot", "db", start_cursor=first["next_cursor"], page_size=2)
+
+    assert [row["id"] for row in first["results"]] == ["p3", "p2"]
+    assert first["has_more"] and first["next_cursor"] == "mirror:2"
+    assert [row["id"] for row in second["results"]] == ["p1"]
+    assert not second["has_more"]
+    with pytest.raises(MirrorUnsupported):
+        mirror.query("ws", "bot", "db", start_cursor="notion-cursor")
+
+
+def test_incremental_sync_keeps_archived_pages_until_a_full_sync(mirror):
+    mirror.sync(lambda **kwargs: {"results": PAGES[:2]}, "ws", "bot", "db")
+    assert set(ids(mirror)) == {"p1", "p2", "p3"}
+
+    mirror.sync(lambda **kwargs: {"results": PAGES[:2]}, "ws", "bot", "db", full=True)
+    assert set(ids(mirror)) == {"p1", "p2"}
+
+
+def test_background_sync_runs_full_syncs_periodically(notion, authorize, workspace_id, monkeypatch, tmp_path):
+    authorize("bot")
+    mirror = NotionMirror(str(tmp_path / "mirror.db"))
+    monkeypatch.setattr(notion_app, "notion_mirror", mirror)
+    notion.query_results = PAGES
+    mirror.sync(lambda **kwargs: {"results": PAGES}, workspace_id, "bot", "db")
+    notion.query_results = PAGES[:2] # p3 was archived in Notion
+
+    monkeypatch.setattr(notion_app, "NOTION_MIRROR_FULL_SYNC_INTERVAL", 3600)
+    notion_app.sync_mirrored_databases()
+    assert "filter" in notion.calls[-1][1] # Incremental
+    assert mirror.status(workspace_id, "bot", "db")["pages"] == 3
+
+    monkeypatch.setattr(notion_app, "NOTION_MIRROR_FULL_SYNC_INTERVAL", 0.001)
+    notion_app.sync_mirrored_databases()
+    assert "filter" not in notion.calls[-1][1]
+    assert mirror.status(workspace_id, "bot", "db")["pages"] == 2
@@ -0,0 +1,50 @@
+import json
+
+from src import main as notion_app
+
+
+def test_client_is_reused_per_token(notion):
+    first = notion_app.lease_notion_client("token-a")
+    notion_app.release_notion_client(first)
+
+    assert notion_app.get_cached_notion_client("token-a") is first
+    assert notion_app.get_cached_notion_client("token-b") is not first
+
+
+def test_evicted_client_is_closed_after_its_last_lease(notion):
+    first = notion_app.lease_notion_client("token")
+    second = notion_app.lease_notion_client("token")
+    assert second is first
+
+    notion_app.notion_clients.clear() # LRU or idle eviction
+    assert not first.closed
+    notion_app.release_notion_client(first)
+    assert not first.closed
+    notion_app.release_notion_client(second)
+    assert first.closed
+
+
+def test_unleased_client_is_closed_on_eviction(notion):
+    client = notion_app.lease_notion_client("token")
+    notion_app.release_notion_client(client)
+    assert not client.closed
+
+    notion_app.notion_clients.clear()
+    assert client.closed
+
+
+def test_client_stays_open_for_the_whole_stream(client, notion, authorize, monkeypatch):
+    states = []
+
+    def query(**kwargs):
+        notion_app.notion_clients.clear() # Evicted while the export is still running
+        states.append(notion.clients[0].closed)
+        return {"results": [{"object": "page", "id": str(len(states))}], "has_more": len(states) < 3, "next_cursor": "next"}
+
+    monkeypatch.setattr(notion, "query", query)
+    response = client.post("/notion/databases/db/query?stream=ndjson", json={}, headers=authorize())
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+    assert lines[-1]["rows"] == 3
+    assert states == [False, False, False]
+    assert notion.clients[0].closed
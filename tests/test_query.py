@@ -0,0 +1,37 @@
+import json
+
+
+def query(client, headers, database_id="db", **body):
+    return client.post(f"/notion/databases/{database_id}/query", json=body, headers=headers)
+
+
+def test_invalid_page_size_is_rejected(client, notion, authorize):
+    headers = authorize()
+    for page_size in ("10", 0, -5, True, 2.5):
+        response = query(client, headers, page_size=page_size)
+        assert response.status_code == 400
+        assert "page_size" in response.get_json()["error"]
+    assert notion.calls == []
+
+
+def test_large_page_size_is_capped(client, notion, authorize):
+    response = query(client, authorize(), page_size=500)
+
+    assert response.status_code == 200
+    assert notion.calls[0][1]["page_size"] == 100
+
+
+def test_streamed_page_size_is_validated_too(client, notion, authorize):
+    response = client.post("/notion/databases/db/query?stream=ndjson", json={"page_size": "all"}, headers=authorize())
+
+    assert response.status_code == 400
+    assert notion.calls == []
+
+
+def test_stream_ends_with_summary(client, notion, authorize):
+    notion.query_results = [{"object": "page", "id": "p1"}, {"object": "page", "id": "p2"}]
+    response = client.post("/notion/databases/db/query?stream=ndjson", json={"page_size": 10}, headers=authorize())
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+    assert [line["id"] for line in lines[:-1]] == ["p1", "p2"]
+    assert lines[-1] == {"object": "summary", "rows": 2, "has_more": False, "next_cursor": None}
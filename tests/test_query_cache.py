@@ -0,0 +1,68 @@
+from src.main import NotionQueryCache
+
+
+def query(client, headers, database_id="db", **body):
+    return client.post(f"/notion/databases/{database_id}/query", json=body, headers=headers)
+
+
+def test_repeated_query_is_served_from_cache(client, notion, authorize):
+    headers = authorize()
+    first = query(client, headers, filter={"property": "Done", "checkbox": {"equals": True}})
+    second = query(client, headers, filter={"property": "Done", "checkbox": {"equals": True}})
+
+    assert first.headers["X-Cache"] == "MISS"
+    assert second.headers["X-Cache"] == "HIT"
+    assert second.get_json() == first.get_json()
+    assert len(notion.calls) == 1
+
+
+def test_no_cache_header_skips_lookup(client, notion, authorize):
+    headers = authorize()
+    query(client, headers)
+    response = query(client, dict(headers, **{"Cache-Control": "no-cache"}))
+
+    assert response.headers["X-Cache"] == "MISS"
+    assert len(notion.calls) == 2
+
+
+def test_write_invalidates_cached_queries(client, notion, authorize):
+    headers = authorize()
+    query(client, headers)
+    created = client.post("/notion/databases/db/items", json={"properties": {}}, headers=headers)
+    assert created.status_code == 201
+
+    response = query(client, headers)
+    assert response.headers["X-Cache"] == "MISS"
+
+
+def test_write_by_one_bot_invalidates_the_other_bots_entries(client, notion, authorize):
+    headers_a, headers_b = authorize("bot-a"), authorize("bot-b")
+    query(client, headers_b)
+    client.post("/notion/databases/db/items", json={"properties": {}}, headers=headers_a)
+
+    assert query(client, headers_b).headers["X-Cache"] == "MISS"
+
+
+def test_bots_of_one_workspace_do_not_share_entries(client, notion, authorize):
+    headers_a, headers_b = authorize("bot-a"), authorize("bot-b")
+    notion.query_results = [{"object": "page", "id": "only-shared-with-bot-a"}]
+    query(client, headers_a)
+    notion.query_results = []
+
+    response = query(client, headers_b)
+    assert response.headers["X-Cache"] == "MISS"
+    assert response.get_json()["results"] == []
+
+
+
+def test_write_in_one_worker_invalidates_the_others(tmp_path):
+    db_path = str(tmp_path / "query_cache.db")
+    # One cache per worker process, sharing the generations file
+    worker_a = NotionQueryCache(max_size=16, ttl=60, max_entry_bytes=1024, db_path=db_path)
+    worker_b = NotionQueryCache(max_size=16, ttl=60, max_entry_bytes=1024, db_path=db_path)
+    worker_b.set(worker_b.key("ws", "bot", "db", {}), b"stale")
+    assert worker_b.get(worker_b.key("ws", "bot", "db", {})) == b"stale"
+
+    worker_a.invalidate("ws", "db")
+
+    assert worker_b.get(worker_b.key("ws", "bot", "db", {})) is None
@@ -0,0 +1,171 @@
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from conftest import FakeNotionError
+from src import main as notion_app
+from src.main import RATE_LIMIT_SCHEMA, NotionRateLimiter, SharedStateDB, SQLiteTokenBucket, retry_after_seconds
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Records sleeps instead of waiting."""
+    sleeps = []
+    monkeypatch.setattr(notion_app.time, "sleep", sleeps.append)
+    return sleeps
+
+
+@pytest.fixture
+def limiter(tmp_path):
+    return NotionRateLimiter(rate=10, burst=10, max_retries=2, base_delay=0.5, max_delay=30, db_path=str(tmp_path / "limits.db"))
+
+
+def failing(*errors, result="ok"):
+    """A Notion call that raises the given errors in turn, then returns result."""
+    calls = []
+
+    def call():
+        calls.append(1)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return result
+
+    call.calls = calls
+    return call
+
+
+def test_bucket_is_shared_between_workers(tmp_path, sleeps):
+    db_path = str(tmp_path / "limits.db")
+    # One SharedStateDB per worker process, all on the same file
+    worker_a = SQLiteTokenBucket(SharedStateDB(db_path, RATE_LIMIT_SCHEMA), "ws", rate=2, capacity=2)
+    worker_b = SQLiteTokenBucket(SharedStateDB(db_path, RATE_LIMIT_SCHEMA), "ws", rate=2, capacity=2)
+
+    assert worker_a.acquire() == 0
+    assert worker_a.acquire() == 0
+    assert worker_b.acquire() == pytest.approx(0.5, abs=0.05)
+    assert SQLiteTokenBucket(worker_a.shared_db, "other-ws", rate=2, capacity=2).acquire() == 0
+
+
+def test_penalty_holds_back_every_worker(tmp_path, sleeps):
+    db_path = str(tmp_path / "limits.db")
+    SQLiteTokenBucket(SharedStateDB(db_path, RATE_LIMIT_SCHEMA), "ws", rate=2, capacity=2).penalize(3)
+
+    assert SQLiteTokenBucket(SharedStateDB(db_path, RATE_LIMIT_SCHEMA), "ws", rate=2, capacity=2).acquire() == pytest.approx(3.5, abs=0.05)
+
+
+def test_429_waits_for_retry_after(limiter, sleeps):
+    call = failing(FakeNotionError(429, {"retry-after": "2"}))
+
+    assert limiter.call("ws", call) == "ok"
+    assert len(call.calls) == 2
+    assert sleeps == [pytest.approx(2.1, abs=0.05)] # Penalty plus the reserved token
+    assert limiter.snapshot()["rate_limited"] == 1
+
+
+def test_retry_after_is_capped(limiter, sleeps):
+    limiter.max_delay = 5
+    call = failing(FakeNotionError(429, {"retry-after": "120"}))
+
+    limiter.call("ws", call)
+    assert sleeps[0] < 6
+
+
+def test_retry_after_http_date():
+    when = datetime.now(timezone.utc) + timedelta(seconds=30)
+    error = FakeNotionError(429, {"retry-after": format_datetime(when, usegmt=True)})
+
+    assert retry_after_seconds(error) == pytest.approx(30, abs=2)
+    assert retry_after_seconds(FakeNotionError(429, {"retry-after": "soon"})) is None
+    assert retry_after_seconds(FakeNotionError(429)) is None
+
+
+def test_server_error_is_not_retried_for_creates(limiter, sleeps):
+    call = failing(FakeNotionError(502))
+
+    with pytest.raises(FakeNotionError):
+        limiter.call("ws", call, idempotent=False)
+    assert len(call.calls) == 1
+    assert limiter.snapshot()["retries"] == 0
+
+
+def test_server_error_is_retried_for_idempotent_calls(limiter, sleeps):
+    call = failing(FakeNotionError(503), FakeNotionError(500))
+
+    assert limiter.call("ws", call) == "ok"
+    assert len(call.calls) == 3
+    assert limiter.snapshot()["backoff_seconds"] > 0
+
+
+def test_429_is_retried_even_for_creates(limiter, sleeps):
+    call = failing(FakeNotionError(429, {"retry-after": "1"}))
+
+    assert limiter.call("ws", call, idempotent=False) == "ok"
+
+
+def test_client_errors_are_not_retried(limiter, sleeps):
+    call = failing(FakeNotionError(400))
+
+    with pytest.raises(FakeNotionError):
+        limiter.call("ws", call)
+    assert len(call.calls) == 1
+
+
+def test_429_is_passed_on_after_the_last_retry(client, notion, authorize, monkeypatch, sleeps):
+    monkeypatch.setattr(notion_app.notion_limiter, "max_retries", 1)
+    notion.error = FakeNotionError(429, {"retry-after": "7"})
+
+    response = client.post("/notion/databases/db/items", json={"properties": {}}, headers=authorize())
+
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "7"
+    assert len(notion.calls) == 2
+
+
+def test_429_is_reported_per_item_in_batches(client, notion, authorize, monkeypatch, sleeps):
+    monkeypatch.setattr(notion_app.notion_limiter, "max_retries", 0)
+    notion.error = FakeNotionError(429, {"retry-after": "1"})
+
+    response = client.post("/notion/databases/db/items:batch", json={"items": [{"properties": {}}]}, headers=authorize())
+
+    assert response.status_code == 207
+    assert response.get_json()["results"][0]["status"] == 429
+
+
+def test_server_error_on_create_is_a_500(client, notion, authorize, sleeps):
+    notion.error = FakeNotionError(502)
+
+    response = client.post("/notion/databases/db/items", json={"properties": {}}, headers=authorize())
+
+    assert response.status_code == 500
+    assert len(notion.calls) == 1
+
+
+def test_shared_db_reuses_one_connection_with_normal_sync(tmp_path):
+    shared_db = SharedStateDB(str(tmp_path / "limits.db"), RATE_LIMIT_SCHEMA)
+    bucket = SQLiteTokenBucket(shared_db, "ws", rate=100, capacity=100)
+    bucket.acquire()
+    conn = shared_db._conn
+    bucket.acquire()
+
+    assert shared_db._conn is conn
+    assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1 # NORMAL
+
+
+def test_shared_db_runs_in_gevent_threadpool_when_patched(tmp_path, monkeypatch):
+    applied = []
+
+    class FakeThreadpool:
+        def apply(self, func, args=()):
+            applied.append(func)
+            return func(*args)
+
+    class FakeHub:
+        threadpool = FakeThreadpool()
+
+    monkeypatch.setattr(notion_app.gevent.monkey, "is_module_patched", lambda name: True)
+    monkeypatch.setattr(notion_app.gevent, "get_hub", FakeHub)
+    shared_db = SharedStateDB(str(tmp_path / "limits.db"), RATE_LIMIT_SCHEMA)
+
+    assert shared_db.transaction(lambda conn: conn.execute("SELECT 1").fetchone()[0]) == 1
+    assert len(applied) == 1
@@ -0,0 +1,123 @@
+import sqlite3
+import time
+
+import pytest
+
+from src import main as notion_app
+from src.main import NotionWriteQueue
+
+
+@pytest.fixture
+def queue(tmp_path, monkeypatch):
+    queue = NotionWriteQueue(str(tmp_path / "jobs.db"), coalesce_seconds=0, stale_seconds=60, retention_seconds=60)
+    # Tests drive claim()/run_job() themselves instead of a background drainer
+    monkeypatch.setattr(queue, "ensure_drainer", lambda: None)
+    monkeypatch.setattr(notion_app, "notion_write_queue", queue)
+    return queue
+
+
+def test_updates_to_a_pending_page_are_coalesced(queue):
+    first_id, first_coalesced = queue.enqueue("ws", "bot-a", "page", {"Name": "a", "Points": 1})
+    second_id, second_coalesced = queue.enqueue("ws", "bot-a", "page", {"Points": 2})
+
+    assert (first_coalesced, second_coalesced) == (False, True)
+    assert second_id == first_id
+    job = queue.get("ws", "bot-a", first_id)
+    assert job["properties"] == {"Name": "a", "Points": 2}
+    assert job["requests"] == 2
+
+
+def test_updates_from_different_bots_are_not_merged(queue):
+    job_a, _ = queue.enqueue("ws", "bot-a", "page", {"Points": 1})
+    job_b, coalesced = queue.enqueue("ws", "bot-b", "page", {"Points": 2})
+
+    assert not coalesced
+    assert job_b != job_a
+    assert queue.get("ws", "bot-a", job_b) is None
+
+
+def test_claimed_job_is_not_run_twice_and_blocks_its_page(queue):
+    job_id, _ = queue.enqueue("ws", "bot-a", "page", {"Points": 1})
+    claimed = queue.claim()
+
+    assert claimed["id"] == job_id
+    assert claimed["bot_id"] == "bot-a"
+    assert queue.get("ws", "bot-a", job_id)["status"] == "running"
+    # A new update starts a new job, which waits for the running one
+    next_id, coalesced = queue.enqueue("ws", "bot-a", "page", {"Points": 2})
+    assert not coalesced and next_id != job_id
+    assert queue.claim() is None
+
+
+def test_stale_running_job_is_claimed_again(queue):
+    job_id, _ = queue.enqueue("ws", "bot-a", "page", {"Points": 1})
+    queue.claim()
+    assert queue.claim() is None
+
+    queue.stale_seconds = 0 # The worker that claimed it died
+    time.sleep(0.01)
+    assert queue.claim()["id"] == job_id
+
+
+def test_job_runs_with_the_token_of_the_bot_that_queued_it(queue, notion, authorize, workspace_id):
+    authorize("bot-a")
+    authorize("bot-b") # Newest token of the workspace
+    job_id, _ = queue.enqueue(workspace_id, "bot-a", "page", {"Points": {"number": 3}})
+
+    queue.run_job(queue.claim())
+
+    assert notion.calls == [("pages.update", {"page_id": "page", "properties": {"Points": {"number": 3}}})]
+    assert notion_app.notion_clients.get(f"secret-{workspace_id}-bot-a") is not None
+    assert notion_app.notion_clients.get(f"secret-{workspace_id}-bot-b") is None
+    job = queue.get(workspace_id, "bot-a", job_id)
+    assert job["status"] == "done"
+    assert job["result"]["id"] == "page"
+
+
+def test_job_without_a_token_fails(queue, notion, workspace_id):
+    job_id, _ = queue.enqueue(workspace_id, "bot-gone", "page", {"Points": 1})
+
+    queue.run_job(queue.claim())
+
+    job = queue.get(workspace_id, "bot-gone", job_id)
+    assert job["status"] == "failed"
+    assert "No Notion token" in job["error"]
+    assert notion.calls == []
+
+
+def test_status_endpoint_is_scoped_to_the_bot(client, queue, authorize):
+    headers_a, headers_b = authorize("bot-a"), authorize("bot-b")
+    response = client.patch("/notion/pages/page?async=1", json={"properties": {"Points": {"number": 1}}}, headers=headers_a)
+    assert response.status_code == 202
+    status_url = response.get_json()["status_url"]
+    assert response.headers["Location"] == status_url
+
+    assert client.get(status_url, headers=headers_a).get_json()["status"] == "pending"
+    assert client.get(status_url, headers=headers_b).status_code == 404
+    assert client.get(status_url).status_code == 401
+
+    queue.run_job(queue.claim())
+    job = client.get(status_url, headers=headers_a).get_json()
+    assert job["status"] == "done"
+    assert job["requests"] == 1
+
+
+def test_queue_from_before_bot_ids_is_upgraded(tmp_path):
+    db_path = str(tmp_path / "jobs.db")
+    conn = sqlite3.connect(db_path)
+    conn.executescript("""
+    CREATE TABLE notion_write_jobs (
+        id TEXT PRIMARY KEY, workspace_id TEXT NOT NULL, page_id TEXT NOT NULL, properties TEXT NOT NULL,
+        status TEXT NOT NULL, requests INTEGER NOT NULL DEFAULT 1, result TEXT NULL, error TEXT NULL,
+        created_at REAL NOT NULL, due_at REAL NOT NULL, updated_at REAL NOT NULL
+    );
+    CREATE UNIQUE INDEX idx_notion_write_jobs_pending_page ON notion_write_jobs (workspace_id, page_id) WHERE status = 'pending';
+    INSERT INTO notion_write_jobs VALUES ('old', 'ws', 'page', '{}', 'pending', 1, NULL, NULL, 0, 0, 0);
+    """)
+    conn.close()
+
+    queue = NotionWriteQueue(db_path, coalesce_seconds=0, stale_seconds=60, retention_seconds=60)
+    queue.ensure_drainer = lambda: None
+    _, coalesced = queue.enqueue("ws", "bot-a", "page", {})
+    assert not coalesced
+    assert queue.claim()["bot_id"] is None # The legacy job, which run_job will fail